@@ -0,0 +1,66 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Measures DBConnection.write_message throughput with a synthetic file_rw-like event stream,
+once with a commit per message and once in write-behind mode.
+
+usage: python benchmarks/bench_db_write.py [events]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from winstrument.db_connection import DBConnection
+from winstrument.data.module_message import ModuleMessage
+
+
+def synthetic_stream(count):
+    for i in range(count):
+        yield ModuleMessage("file_rw", "C:\\Windows\\System32\\notepad.exe",
+                            {"function": "ReadFile", "fh": hex(0x100 + i % 64), "bytes": 4096})
+
+
+def run(count, **db_options):
+    """
+    Write count synthetic messages and return events per second, including the final flush.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = DBConnection(os.path.join(tmpdir, "bench.sqlite3"), **db_options)
+        start = time.perf_counter()
+        for message in synthetic_stream(count):
+            db.write_message(message)
+        db.flush()
+        elapsed = time.perf_counter() - start
+        stored = len(db.read_messages("file_rw"))
+        db.close()
+    assert stored == count, f"expected {count} rows, found {stored}"
+    return count / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    baseline = run(count)
+    batched = run(count, write_behind=True)
+    print(f"events:             {count}")
+    print(f"commit per message: {baseline:12.0f} events/s")
+    print(f"write-behind:       {batched:12.0f} events/s")
+    print(f"speedup:            {batched / baseline:12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
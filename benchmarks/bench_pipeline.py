@@ -0,0 +1,351 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Drives the host pipeline with synthetic message streams through fake Frida sessions, including parsing each message's JSON:
+BaseInstrumentation dispatch, each module's on_message and on_finish, DBConnection, and every formatter in utils.get_formatters.
+Reports throughput, latency percentiles and peak traced memory per module and per formatter.
+Module latency is the time to dispatch each message. Formatter latency is the time from reading each row from the database until its
+output is written, so formatters that build their whole output before writing any of it show it as latency.
+Memory is measured in a separate pass with tracemalloc, so it doesn't inflate the timings.
+Where pywin32 isn't installed (e.g. on Linux) it is replaced with the stand-ins in fake_pywin32.py, which return canned lookups.
+Modules whose imports are still unavailable are reported as skipped.
+
+usage: python benchmarks/bench_pipeline.py [--events N] [--batch N] [--write-behind] [--binary] [--json FILE]
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import winstrument.utils as utils
+from winstrument.db_connection import DBConnection
+from winstrument.data.module_message import timestamp_now
+from winstrument.records import TYPE_FORMATS, NULL_STRING
+from winstrument.base_module import BaseInstrumentation
+from fake_frida import FakeSession
+import fake_pywin32
+
+TARGET = "C:\\Program Files\\Target\\target.exe"
+
+
+def generic_events(count):
+    for i in range(count):
+        yield {"function": "SyntheticCall", "index": i, "value": f"value-{i % 100}"}
+
+
+def file_rw_events(count):
+    #one CreateFile per 20 events, the rest are the summaries the agent sends
+    handles = []
+    for i in range(count):
+        if i % 20 == 0:
+            fh = hex(0x100 + i)
+            handles.append(fh)
+            yield {"function": "CreateFileW", "path": f"C:\\Users\\user\\AppData\\Local\\Temp\\file{i}.tmp", "mode": "0xc0000000", "fh": fh}
+        else:
+            counts = {fh: {"read": 4096, "written": 512, "read_function": "ReadFile", "written_function": "WriteFile"} for fh in handles[-8:]}
+            yield {"function": "summary", "handles": counts}
+
+
+def socket_events(count):
+    #each socket reports three flow_updates while open, then its flow when closed
+    for i in range(count):
+        yield {"function": "flow" if i % 4 == 3 else "flow_update", "fd": 0x100 + i // 4, "connect": 1 if i % 4 == 0 else 0, "send": 10, "recv": 12,
+               "bytes_sent": 1400, "bytes_received": 9000, "first_seen": 1571400000000000 + i * 1000, "last_seen": 1571400000500000 + i * 1000,
+               "type": "tcp", "address": f"10.0.{i // 4 % 256}.1", "port": 443}
+
+
+def registry_events(count):
+    for i in range(count):
+        yield {"function": "RegOpenKeyExW", "hkey": "0x80000001", "subkey": f"Software\\Vendor\\Product\\Key{i % 50}"}
+
+
+def com_hijack_events(count):
+    for i in range(count):
+        yield {"function": "RegOpenKeyExW", "subkey": f"Software\\Classes\\CLSID\\{{00000000-0000-0000-0000-{i % 40:012d}}}"}
+
+
+def process_events(count):
+    for i in range(count):
+        yield {"function": "CreateProcessW", "application": "C:\\Windows\\System32\\cmd.exe", "args": f"/c job{i % 30}.bat"}
+
+
+def dlls_events(count):
+    for i in range(count):
+        yield {"function": "LoadLibraryW", "lib_filename": f"plugin{i % 200}.dll"}
+
+
+def impersonate_events(count):
+    for i in range(count):
+        yield {"function": "ImpersonateLoggedOnUser", "token": 0x2a0}
+
+
+EVENT_GENERATORS = {
+    "file_rw": file_rw_events,
+    "socket": socket_events,
+    "registry": registry_events,
+    "com_hijack": com_hijack_events,
+    "process": process_events,
+    "dlls": dlls_events,
+    "impersonate": impersonate_events,
+}
+
+
+#Layouts from the module scripts, for --binary. See defineRecord calls in js/file_rw.js and js/socket.js
+RECORD_LAYOUTS = {
+    "handle_summary": [("fh", "str"), ("read", "int"), ("written", "int"), ("read_function", "str"), ("written_function", "str")],
+    "flow": [("fd", "int"), ("connect", "u32"), ("send", "u32"), ("recv", "u32"), ("bytes_sent", "int"), ("bytes_received", "int"),
+        ("first_seen", "int"), ("last_seen", "int"), ("type", "str"), ("address", "str"), ("port", "u16")],
+}
+RECORD_LAYOUTS["flow_update"] = RECORD_LAYOUTS["flow"]
+
+
+class RecordPacker:
+    """
+    Packs events into binary record messages the way js/lib/records.js does, interning strings across messages
+    """
+    def __init__(self):
+        self._strings = {}
+
+    def pack(self, name, events):
+        fields = RECORD_LAYOUTS[name]
+        record_struct = struct.Struct("<d" + "".join(TYPE_FORMATS[field_type] for _, field_type in fields))
+        new_strings = {}
+        data = bytearray()
+        now = timestamp_now()
+        for event in events:
+            values = [now]
+            for field, field_type in fields:
+                value = event.get(field)
+                if field_type == "str" and value is not None:
+                    if value not in self._strings:
+                        string_id = len(self._strings)
+                        self._strings[value] = string_id
+                        new_strings[string_id] = value
+                    value = self._strings[value]
+                elif field_type == "str":
+                    value = NULL_STRING
+                values.append(value or 0)
+            data += record_struct.pack(*values)
+        payload = {"records": {"layout": name, "fields": [field for field, _ in fields], "types": [field_type for _, field_type in fields],
+            "count": len(events)}, "strings": new_strings, "strings_reset": False}
+        return payload, bytes(data)
+
+
+def make_messages(payloads, batch, binary):
+    """
+    Group payloads into the messages the agent would send: JSON batches, plus binary records for events with a layout if binary is set.
+    Returns a list of (JSON message str, data bytes or None). The JSON is parsed during the benchmark, as frida-python does for every message.
+    """
+    if binary:
+        packer = RecordPacker()
+        expanded = []
+        for payload in payloads:
+            if payload["function"] == "summary": #file_rw sends one record per handle in binary mode
+                expanded += [dict(counts, function="handle_summary", fh=fh) for fh, counts in payload["handles"].items()]
+            else:
+                expanded.append(payload)
+        payloads = expanded
+    messages = []
+    for i in range(0, len(payloads), batch):
+        chunk = payloads[i:i + batch]
+        if binary:
+            records = [payload for payload in chunk if payload["function"] in RECORD_LAYOUTS]
+            chunk = [payload for payload in chunk if payload["function"] not in RECORD_LAYOUTS]
+            for name in RECORD_LAYOUTS:
+                layout_records = [record for record in records if record["function"] == name]
+                if layout_records:
+                    messages.append(packer.pack(name, layout_records))
+        if chunk:
+            messages.append(({"batch": chunk, "times": [timestamp_now()] * len(chunk)}, None))
+    return [(json.dumps({"type": "send", "payload": payload}), data) for payload, data in messages]
+
+
+class GenericModule(BaseInstrumentation):
+    """
+    BaseInstrumentation with the default on_message, to measure the framework on its own
+    """
+    modulename = "synthetic"
+
+    def get_script_source(self):
+        return "" #there is no agent script, events come from the generators above
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def latency_stats(latencies_ns):
+    latencies_ns.sort()
+    return {f"p{int(p * 100)}_us": percentile(latencies_ns, p) / 1000 for p in (0.5, 0.95, 0.99)}
+
+
+def get_module_classes():
+    """
+    Returns a list of (modulename, class or None, reason) for every module in winstrument.modules
+    """
+    import winstrument.modules
+    results = [(GenericModule.modulename, GenericModule, None)]
+    for name in sorted(winstrument.modules.__all__):
+        try:
+            importlib.import_module(f"winstrument.modules.{name}")
+        except ImportError as e:
+            results.append((name, None, f"skipped: {e}"))
+    for moduleclass in BaseInstrumentation.__subclasses__():
+        if moduleclass is not GenericModule:
+            results.append((moduleclass.modulename, moduleclass, None))
+    return sorted(results, key=lambda result: result[0])
+
+
+def run_module(moduleclass, db, payloads, batch, binary=False, trace=False):
+    """
+    Feed payloads to a fresh instrumentation of moduleclass in batches, as the agent-side batching would, then finalize it.
+    Returns (elapsed seconds, list of per-message dispatch latencies in ns, peak traced bytes or None)
+    """
+    session = FakeSession()
+    instrumentation = moduleclass(session, TARGET, db, pid=session.pid, session_id=1, run_id="bench")
+    instrumentation.load_script()
+    script = session.scripts[0]
+    messages = make_messages(payloads, batch, binary)
+
+    latencies = []
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for raw_message, data in messages:
+        dispatch_start = time.perf_counter_ns()
+        script.deliver_raw(raw_message, data)
+        latencies.append(time.perf_counter_ns() - dispatch_start)
+    instrumentation.finalize()
+    db.flush()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, latencies, peak
+
+
+def bench_module(moduleclass, db, events, batch, binary):
+    """
+    Time one pass over the module's synthetic events, then measure peak memory in a second pass, since tracing slows dispatch down
+    """
+    generator = EVENT_GENERATORS.get(moduleclass.modulename, generic_events)
+    elapsed, latencies, _ = run_module(moduleclass, db, list(generator(events)), batch, binary)
+    _, _, peak = run_module(moduleclass, db, list(generator(events)), batch, binary, trace=True)
+    result = {"events": events, "events_per_s": events / elapsed, "peak_kb": peak / 1024}
+    result.update(latency_stats(latencies))
+    return result
+
+
+def timed_rows(messages, read_times):
+    """
+    Yield messages, appending the time each one is read to read_times
+    """
+    for message in messages:
+        read_times.append(time.perf_counter_ns())
+        yield message
+
+
+def bench_formatter(formatter, db, modulename):
+    """
+    Format every stored message for modulename, streaming where the formatter supports it, as print_saved_output does
+    """
+    def run(output, read_times=None):
+        messages = db.iter_messages(modulename)
+        if read_times is not None:
+            messages = timed_rows(messages, read_times)
+        if formatter.writer:
+            formatter.writer(messages, output)
+        else:
+            output.write(formatter.function(list(messages)) + "\n")
+
+    output = io.StringIO()
+    read_times = []
+    start = time.perf_counter()
+    run(output, read_times)
+    elapsed = time.perf_counter() - start
+    end = time.perf_counter_ns()
+    if formatter.writer:
+        #a streaming writer has written a row by the time it asks for the next one
+        latencies = [written - read for read, written in zip(read_times, read_times[1:] + [end])]
+    else:
+        latencies = [end - read for read in read_times]
+    tracemalloc.start()
+    run(io.StringIO())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(read_times)
+    result = {"rows": rows, "rows_per_s": rows / elapsed if elapsed else 0, "peak_kb": peak / 1024, "output_kb": len(output.getvalue()) / 1024}
+    result.update(latency_stats(latencies))
+    return result
+
+
+def print_table(title, results, columns):
+    print(title)
+    header = ["name"] + columns
+    print("  ".join(f"{column:>14}" for column in header))
+    for name, result in results.items():
+        if "skipped" in result:
+            print(f"{name:>14}  {result['skipped']}")
+            continue
+        print("  ".join([f"{name:>14}"] + [f"{result[column]:>14.1f}" for column in columns]))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000, help="events generated per module")
+    parser.add_argument("--batch", type=int, default=64, help="events per agent batch")
+    parser.add_argument("--write-behind", action="store_true", help="use DBConnection write-behind mode")
+    parser.add_argument("--binary", action="store_true", help="send file_rw summaries and socket flows as binary records, as with the binary setting")
+    parser.add_argument("--json", metavar="FILE", help="also write results to FILE as JSON")
+    args = parser.parse_args()
+
+    fake_pywin32.install()
+    module_results = {}
+    formatter_results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = DBConnection(os.path.join(tmpdir, "bench.sqlite3"), write_behind=args.write_behind)
+        for modulename, moduleclass, reason in get_module_classes():
+            if moduleclass is None:
+                module_results[modulename] = {"skipped": reason}
+                continue
+            module_results[modulename] = bench_module(moduleclass, db, args.events, args.batch, args.binary)
+
+        #the generic module stores one row per event, so it gives the formatters the largest input
+        for formatter in utils.get_formatters():
+            formatter_results[formatter.name] = bench_formatter(formatter, db, GenericModule.modulename)
+        db.close()
+
+    print_table("Modules (dispatch latency is per message)", module_results, ["events_per_s", "p50_us", "p95_us", "p99_us", "peak_kb"])
+    print_table("Formatters (latency is per row)", formatter_results, ["rows_per_s", "p50_us", "p95_us", "p99_us", "peak_kb", "output_kb"])
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump({"args": vars(args), "modules": module_results, "formatters": formatter_results}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
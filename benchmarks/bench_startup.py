@@ -0,0 +1,79 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Measures how long Winstrument takes to start, for scripted invocations that open the tool many times.
+Each scenario runs in a fresh interpreter, with APPDATA pointed at a temporary directory so real settings and output are untouched.
+Also reports which dependencies that are only needed to run a target were imported by the end of each scenario. None should be, until a run starts.
+
+usage: python benchmarks/bench_startup.py [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEAVY_MODULES = ["frida", "frida_tools", "sqlite3", "tabulate", "winstrument.base_module", "winstrument.db_connection"]
+
+REPORT_IMPORTS = f"""
+import json, sys
+print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))
+"""
+
+SCENARIOS = {
+    "import": "import winstrument.winstrument",
+    "construct": "from winstrument.winstrument import Winstrument\napp = Winstrument()",
+    "list+set": "from winstrument.winstrument import Winstrument\napp = Winstrument()\napp.get_available_modules()\n"
+        "app.settings_controller.set_setting(app.CORE_MODNAME, 'verbosity', 1)\napp.quit()",
+    "cli list": "import sys\nsys.argv = ['winstrument', 'list', 'quit']\nfrom winstrument.cmdline import main\ntry:\n    main()\nexcept SystemExit:\n    pass",
+}
+
+
+def run_scenario(code, env):
+    """
+    Returns (seconds, list of heavy modules imported), or raises CalledProcessError if the scenario fails
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code + "\n" + REPORT_IMPORTS], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with tempfile.TemporaryDirectory() as appdata:
+        env = dict(os.environ, APPDATA=appdata, appdata=appdata)
+        baseline = [run_scenario("pass", env)[0] for _ in range(runs)]
+        print(f"{'scenario':>10}  {'median ms':>10}  {'min ms':>8}  {'over python ms':>14}  heavy imports")
+        print(f"{'python':>10}  {statistics.median(baseline) * 1000:>10.1f}  {min(baseline) * 1000:>8.1f}  {0:>14.1f}")
+        for name, code in SCENARIOS.items():
+            try:
+                results = [run_scenario(code, env) for _ in range(runs)]
+            except subprocess.CalledProcessError as e:
+                error = e.stderr.strip().splitlines()[-1] if e.stderr.strip() else f"exit code {e.returncode}"
+                print(f"{name:>10}  failed: {error}")
+                continue
+            times = [elapsed for elapsed, _ in results]
+            median = statistics.median(times)
+            print(f"{name:>10}  {median * 1000:>10.1f}  {min(times) * 1000:>8.1f}  {(median - statistics.median(baseline)) * 1000:>14.1f}  {', '.join(results[-1][1]) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
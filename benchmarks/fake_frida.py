@@ -0,0 +1,83 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Stand-ins for Frida session and script objects, so the host side of Winstrument can be driven without a target process.
+"""
+
+
+import json
+
+
+class FakeScript:
+    """
+    Records the handlers registered by an instrumentation and lets a benchmark deliver messages to them as Frida would
+    """
+    def __init__(self, source):
+        self.source = source
+        self.handlers = {}
+        self.loaded = False
+
+    def on(self, signal, callback):
+        self.handlers.setdefault(signal, []).append(callback)
+
+    def load(self):
+        self.loaded = True
+
+    def unload(self):
+        self.loaded = False
+
+    def post(self, message, data=None):
+        pass
+
+    def deliver(self, payload, data=None):
+        """
+        Deliver payload as if the agent had called send(payload, data)
+        """
+        message = {"type": "send", "payload": payload}
+        for callback in self.handlers.get("message", []):
+            callback(message, data)
+
+    def deliver_raw(self, raw_message, data=None):
+        """
+        Deliver a message serialized as JSON, parsing it on the host the way frida-python does
+        raw_message - str, JSON of {"type": "send", "payload": ...}
+        """
+        for callback in self.handlers.get("message", []):
+            callback(json.loads(raw_message), data)
+
+
+class FakeSession:
+    """
+    Minimal Frida session. Scripts are created from source; compile_script is deliberately absent so the source path is used.
+    """
+    def __init__(self, pid=1234):
+        self.pid = pid
+        self.scripts = []
+        self.handlers = {}
+
+    def create_script(self, source):
+        script = FakeScript(source)
+        self.scripts.append(script)
+        return script
+
+    def on(self, signal, callback):
+        self.handlers.setdefault(signal, []).append(callback)
+
+    def enable_child_gating(self):
+        pass
+
+    def detach(self):
+        for callback in self.handlers.get("detached", []):
+            callback("application-requested")
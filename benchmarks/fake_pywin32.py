@@ -0,0 +1,94 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Stand-ins for the pywin32 modules used by the dlls, impersonate, process and registry modules, so their host side can be benchmarked
+on platforms without pywin32. Lookups return canned answers: every directory has the same ACL, and every SID is BUILTIN\\Users.
+"""
+
+
+import sys
+import types
+
+#the constants the modules use, with their values from the Windows headers
+WIN32CON = {"HKEY_CLASSES_ROOT": 0x80000000, "HKEY_CURRENT_USER": 0x80000001, "HKEY_LOCAL_MACHINE": 0x80000002, "HKEY_USERS": 0x80000003,
+    "HKEY_CURRENT_CONFIG": 0x80000005}
+NTSECURITYCON = {"FILE_ADD_FILE": 0x2, "FILE_APPEND_DATA": 0x4, "FILE_ADD_SUBDIRECTORY": 0x4, "FILE_READ_EA": 0x8, "FILE_WRITE_EA": 0x10,
+    "FILE_EXECUTE": 0x20, "FILE_TRAVERSE": 0x20, "FILE_DELETE_CHILD": 0x40, "FILE_READ_ATTRIBUTES": 0x80, "FILE_WRITE_ATTRIBUTES": 0x100,
+    "FILE_ALL_ACCESS": 0x1f01ff, "FILE_GENERIC_READ": 0x120089, "FILE_GENERIC_WRITE": 0x120116, "FILE_GENERIC_EXECUTE": 0x1200a0}
+WIN32SECURITY = {"OBJECT_INHERIT_ACE": 0x1, "CONTAINER_INHERIT_ACE": 0x2, "NO_PROPAGATE_INHERIT_ACE": 0x4, "INHERIT_ONLY_ACE": 0x8,
+    "INHERITED_ACE": 0x10, "OWNER_SECURITY_INFORMATION": 0x1, "DACL_SECURITY_INFORMATION": 0x4, "TokenUser": 1}
+
+
+class FakeError(Exception):
+    """
+    pywintypes.error
+    """
+
+
+class FakeACL:
+    #((type, flags), mask, sid) like the ACEs pywin32 returns: full control for SYSTEM, read and execute for Users
+    ACES = [((0, 0x3), 0x1f01ff, "S-1-5-18"), ((0, 0x3), 0x1200a9, "S-1-5-32-545")]
+
+    def GetAceCount(self):
+        return len(self.ACES)
+
+    def GetAce(self, index):
+        return self.ACES[index]
+
+
+class FakeSecurityDescriptor:
+    def GetSecurityDescriptorDacl(self):
+        return FakeACL()
+
+
+def _reg_enum_value(hkey, index):
+    raise FakeError("no more data") #KnownDLLs is empty
+
+
+def _module(name, constants, **functions):
+    module = types.ModuleType(name)
+    module.__dict__.update(constants)
+    module.__dict__.update(functions)
+    return module
+
+
+def install():
+    """
+    Add the stand-ins to sys.modules for every pywin32 module that can't be imported. Returns the names of the modules replaced.
+    """
+    fakes = {
+        "pywintypes": _module("pywintypes", {}, error=FakeError),
+        "win32con": _module("win32con", WIN32CON),
+        "ntsecuritycon": _module("ntsecuritycon", NTSECURITYCON),
+        "win32api": _module("win32api", {},
+            GetDomainName=lambda: "BENCH",
+            GetUserName=lambda: "user",
+            GetSystemDirectory=lambda: "C:\\Windows\\System32",
+            GetWindowsDirectory=lambda: "C:\\Windows",
+            RegOpenKeyEx=lambda hkey, subkey: 0,
+            RegEnumValue=_reg_enum_value),
+        "win32security": _module("win32security", WIN32SECURITY,
+            GetFileSecurity=lambda path, info: FakeSecurityDescriptor(),
+            GetTokenInformation=lambda token, info: ("S-1-5-32-545", 0),
+            LookupAccountSid=lambda system, sid: ("Users", "BUILTIN", 4)),
+    }
+    replaced = []
+    for name, module in fakes.items():
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = module
+            replaced.append(name)
+    return replaced
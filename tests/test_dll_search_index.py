@@ -0,0 +1,87 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+from unittest import mock
+from winstrument.dll_search_index import DLLSearchIndex
+
+class DLLSearchIndexTest(unittest.TestCase):
+    """
+    DLLSearchIndex has no Windows dependencies, so it is tested against a synthetic search path in a temporary directory
+    """
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.dirs = [os.path.join(self._tempdir.name, name) for name in ("app", "system", "windows")]
+        for dirpath in self.dirs:
+            os.mkdir(dirpath)
+        self._touch("system", "Foo.dll")
+        self._touch("windows", "foo.dll")
+        self._touch("windows", "bar.dll")
+        self.index = DLLSearchIndex(self.dirs + [self.dirs[1], os.path.join(self._tempdir.name, "missing")],
+                                    known_dlls=["Kernel32.dll"], known_dlls_dir=self.dirs[1])
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def _touch(self, dirname, filename):
+        open(os.path.join(self._tempdir.name, dirname, filename), "w").close()
+
+    def test_duplicate_dirs_ignored(self):
+        self.assertEqual(self.index.get_search_dirs(), self.dirs + [os.path.join(self._tempdir.name, "missing")])
+
+    def test_resolve_first_match_case_insensitive(self):
+        self.assertEqual(self.index.resolve("FOO.DLL"), self.dirs[1])
+        self.assertEqual(self.index.resolve("bar.dll"), self.dirs[2])
+
+    def test_searched_dirs(self):
+        self.assertEqual(self.index.searched_dirs("foo.dll"), self.dirs[:2])
+        self.assertEqual(self.index.searched_dirs("nothere.dll"), self.index.get_search_dirs())
+
+    def test_known_dlls_bypass_search(self):
+        self.assertTrue(self.index.is_known_dll("kernel32.DLL"))
+        self.assertEqual(self.index.resolve("kernel32.dll"), self.dirs[1])
+        self.assertEqual(self.index.searched_dirs("kernel32.dll"), [])
+
+    def test_missing_dll(self):
+        self.assertIsNone(self.index.resolve("nothere.dll"))
+
+    def test_dll_created_after_listing(self):
+        self._touch("windows", "late.dll")
+        self.assertEqual(self.index.resolve("late.dll"), self.dirs[2])
+        self.assertEqual(self.index.searched_dirs("late.dll"), self.dirs)
+
+    def test_repeated_miss_is_cached(self):
+        self.assertIsNone(self.index.resolve("nothere.dll"))
+        with mock.patch("os.path.exists") as exists, mock.patch("os.stat") as stat, mock.patch("os.listdir") as listdir:
+            self.assertIsNone(self.index.resolve("nothere.dll"))
+            self.assertEqual(self.index.searched_dirs("nothere.dll"), self.index.get_search_dirs())
+        exists.assert_not_called()
+        stat.assert_not_called()
+        listdir.assert_not_called()
+
+    def test_cached_miss_updated_by_refresh(self):
+        self.assertIsNone(self.index.resolve("late.dll"))
+        self._touch("app", "late.dll")
+        self.assertIsNone(self.index.resolve("other.dll")) #re-lists the modified directory
+        self.assertEqual(self.index.resolve("late.dll"), self.dirs[0])
+
+    def test_relative_path(self):
+        os.mkdir(os.path.join(self.dirs[2], "sub"))
+        self._touch(os.path.join("windows", "sub"), "baz.dll")
+        self.assertEqual(self.index.resolve(os.path.join("sub", "baz.dll")), self.dirs[2])
+
+if __name__ == "__main__":
+    unittest.main()
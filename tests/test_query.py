@@ -0,0 +1,120 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+import unittest
+from winstrument.db_connection import DBConnection
+from winstrument.data.module_message import ModuleMessage
+from winstrument.query import QueryError, parse_query, tokenize
+
+class TokenizeTest(unittest.TestCase):
+    def test_doubled_quotes(self):
+        self.assertEqual(tokenize("'it''s'"), [("string", "it's")])
+        self.assertEqual(tokenize('"say ""hi"""'), [("string", 'say "hi"')])
+
+    def test_backslash_escapes(self):
+        self.assertEqual(tokenize(r"'it\'s'"), [("string", "it's")])
+        self.assertEqual(tokenize(r"'C:\\dir'"), [("string", "C:\\dir")])
+
+    def test_other_backslashes_kept(self):
+        self.assertEqual(tokenize(r"'%\Temp\%'"), [("string", "%\\Temp\\%")])
+
+    def test_keywords_fields_and_numbers(self):
+        self.assertEqual(tokenize("WHERE Path in (1, 2.5) and `odd key` is null"),
+            [("word", "where"), ("field", "Path"), ("word", "in"), ("op", "("), ("number", 1), ("op", ","), ("number", 2.5), ("op", ")"),
+             ("word", "and"), ("field", "odd key"), ("word", "is"), ("word", "null")])
+
+    def test_unexpected_character(self):
+        with self.assertRaisesRegex(QueryError, "Unexpected character at ';'"):
+            tokenize("where a = 1 ;")
+
+class ParseTest(unittest.TestCase):
+    def test_conditions(self):
+        query = parse_query("where path like '%.dll' and mode not in ('a', 'b') or fh is not null")
+        self.assertEqual(query.where, ("or",
+            ("and", ("like", ("field", "path"), ("string", "%.dll"), False),
+                ("in", ("field", "mode"), [("string", "a"), ("string", "b")], True)),
+            ("is", ("field", "fh"), True)))
+
+    def test_group_and_order_by_count(self):
+        query = parse_query("group by path order by count desc limit 5")
+        self.assertEqual(query.group_by, ["path"])
+        self.assertEqual(query.order_by, [("count", True)])
+        self.assertEqual(query.limit, 5)
+        self.assertTrue(query.aggregated)
+
+    def test_limit_validation(self):
+        for limit in ("-1", "1.5", "x"):
+            with self.assertRaisesRegex(QueryError, f"Invalid limit '{limit}'"):
+                parse_query(f"limit {limit}")
+
+    def test_errors(self):
+        errors = {
+            "where": "Unexpected end of query",
+            "group path": "Expected 'by' but found 'path'",
+            "order by count(*)": "Ordering by an aggregate needs group by",
+            "select sum(*)": "Expected a field name but found '\\*'",
+            "where a like 'x' 2": "Unexpected '2'",
+        }
+        for text, message in errors.items():
+            with self.assertRaisesRegex(QueryError, message, msg=text):
+                parse_query(text)
+
+    def test_invalid_time(self):
+        with self.assertRaisesRegex(QueryError, "Invalid time 'yesterday'"):
+            parse_query("where time < 'yesterday'").compile("file_rw")
+
+class QueryDatabaseTest(unittest.TestCase):
+    """
+    Queries compiled to SQL and run against a temporary database
+    """
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.db = DBConnection(os.path.join(self._tempdir.name, "test.sqlite3"))
+        rows = [("C:\\Users\\user\\AppData\\Local\\Temp\\a.tmp", 100), ("C:\\Users\\user\\AppData\\Local\\Temp\\a.tmp", 50),
+                ("C:\\Users\\user\\AppData\\Local\\Temp\\b.tmp", 10), ("C:\\Windows\\win.ini", 20)]
+        for path, numbytes in rows:
+            self.db.write_message(ModuleMessage("file_rw", "C:\\target.exe", {"path": path, "bytes": numbytes, "fh": None}, run_id="run"))
+
+    def tearDown(self):
+        self.db.close()
+        self._tempdir.cleanup()
+
+    def query(self, text):
+        return [message.data for message in self.db.iter_query("file_rw", parse_query(text))]
+
+    def test_request_example(self):
+        self.assertEqual(self.query(r"where path like '%\Temp\%' group by path"), [
+            {"path": "C:\\Users\\user\\AppData\\Local\\Temp\\a.tmp", "count(*)": 2},
+            {"path": "C:\\Users\\user\\AppData\\Local\\Temp\\b.tmp", "count(*)": 1}])
+
+    def test_order_by_count(self):
+        self.assertEqual([row["path"] for row in self.query("group by path order by count desc, path limit 2")],
+            ["C:\\Users\\user\\AppData\\Local\\Temp\\a.tmp", "C:\\Users\\user\\AppData\\Local\\Temp\\b.tmp"])
+
+    def test_in_and_is_null(self):
+        self.assertEqual(self.query("select bytes where bytes in (10, 20) and fh is null order by bytes"), [{"bytes": 10}, {"bytes": 20}])
+        self.assertEqual(self.query("select bytes where fh is not null"), [])
+
+    def test_aggregates(self):
+        self.assertEqual(self.query("select count(*), sum(bytes), max(bytes) where 15 < bytes"), [{"count(*)": 3, "sum(bytes)": 170, "max(bytes)": 100}])
+
+    def test_count_without_matches(self):
+        messages = list(self.db.iter_query("file_rw", parse_query("select count(*) where 1000 < bytes")))
+        self.assertEqual([message.data for message in messages], [{"count(*)": 0}])
+        self.assertIsNone(messages[0].last_time)
+
+if __name__ == "__main__":
+    unittest.main()
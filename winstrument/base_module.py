@@ -15,33 +15,156 @@
 import frida, sys
 import os
 import collections
+import queue
+import threading
+import time
+import traceback
+import json
+import struct
 from tabulate import tabulate
 import toml
 import winstrument.utils as utils
 from winstrument.data.module_message import ModuleMessage
+from winstrument.metrics import merge_hook_profile
+from winstrument.records import RecordDecoder
+
+#Shared agent-side helpers from modules/js/lib, prepended to every module script in this order
+AGENT_LIBS = ["clock", "batch", "sampling", "records", "profiler"]
+
+JS_PATH = os.path.join(os.path.dirname(__file__),"modules","js")
+
+#Script sources and compiled bytecode are cached for the life of the process, so each is only read and compiled once
+#no matter how many sessions it is loaded into
+_script_cache_lock = threading.Lock()
+_source_cache = {} #path -> file contents
+_bytecode_cache = {} #script source -> compiled bytecode, or None if the runtime can't precompile
+
+#Queued for the executor worker by flush_partial, so on_flush runs in order with the messages around it
+_FLUSH_PARTIAL = object()
+#one message in this many has its JSON payload serialized to measure its size, see BaseInstrumentation._estimate_payload_size
+PAYLOAD_SIZE_SAMPLE = 64
+
+def read_script_file(path):
+    """
+    Returns the contents of the JS file at path, reading it from disk only the first time
+    path - str
+    """
+    with _script_cache_lock:
+        source = _source_cache.get(path)
+    if source is None:
+        with open(path,'r') as scriptfile:
+            source = scriptfile.read()
+        with _script_cache_lock:
+            _source_cache[path] = source
+    return source
+
+def create_script(session, source):
+    """
+    Create a Frida script in session from source. The source is compiled to bytecode once and the bytecode is reused for every later session.
+    Falls back to creating the script from source if the Frida runtime doesn't support precompiling.
+    session - Frida session
+    source - str, JS source
+    Returns a Frida script object, not yet loaded
+    """
+    with _script_cache_lock:
+        cached = source in _bytecode_cache
+        bytecode = _bytecode_cache.get(source)
+    if not cached:
+        try:
+            bytecode = session.compile_script(source)
+        except (AttributeError, frida.NotSupportedError): #older Frida, or a runtime without bytecode support
+            bytecode = None
+        with _script_cache_lock:
+            _bytecode_cache[source] = bytecode
+    if bytecode is None:
+        return session.create_script(source)
+    return session.create_script_from_bytes(bytecode)
 
 class BaseInstrumentation:
     modulename = "base_module"
-    def __init__(self, session, path, db, settings={}):
+    #If True, messages are handled on a dedicated worker thread instead of Frida's message thread, in the order they arrived.
+    #Enable for modules whose on_message does slow work. Can be overridden per module with the "executor" setting.
+    use_executor = False
+    #If True, identical messages are stored once with an occurrence count and first/last seen times instead of once per occurrence.
+    #Set by modules whose targets often repeat the same call in a loop, such as registry, process and com_hijack.
+    #Can be overridden per module with the "dedup" setting.
+    dedup_output = False
+    #Maximum number of messages waiting for the worker. When full, Frida's message thread blocks until the worker catches up.
+    executor_queue_size = 10000
+
+    def __init__(self, session, path, db, settings={}, pid=None, session_id=None, run_id=None, shared=None, recorder=None, metrics=None):
+        """
+        session - Frida session for the target process
+        path - str, path of the target process
+        db - DBConnection to write output to
+        settings - dict of settings for this module
+        pid - int, PID of the target process
+        session_id - int, index of the session within the run
+        run_id - str, unique ID of the run
+        shared - dict shared by every instrumentation in the run, for state such as caches that is worth reusing across processes
+        recorder - Recorder to save every raw message to, or None. See recorder.py
+        metrics - MetricsRegistry to report message counts and handler timings to, or None. See metrics.py
+        """
         self._settings = settings
         self._session = session
         self._db = db
         self._script = None
         self._processpath = path
+        self._pid = pid
+        self._session_id = session_id
+        self._run_id = run_id
+        self._shared = shared if shared is not None else {}
+        self._recorder = recorder
+        self._metrics = metrics
         self._output = []
-        self._messages = []
+        self._dedup = self.get_setting_boolean("dedup", self.dedup_output)
+        self._suppressed = collections.Counter() #events dropped by agent-side sampling, by reason
+        self._hook_profiles = {} #hook name -> totals reported by js/lib/profiler.js, when the profile setting is on
+        self._event_time = None #agent-side timestamp of the event being handled, see _handle_message
+        self._record_decoder = None #decodes binary records from js/lib/records.js, created when the first arrives
+        #messages seen, and the JSON bytes and events in those measured, for _estimate_payload_size
+        self._payload_messages = 0
+        self._payload_sampled_bytes = 0
+        self._payload_sampled_events = 0
+        self._queue = None
+        self._worker = None
+        self._handler_lock = threading.Lock() #keeps flush_partial from running in the middle of a message outside executor mode
+        if self.get_setting_boolean("executor", self.use_executor):
+            self._queue = queue.Queue(maxsize=self.executor_queue_size)
+            self._worker = threading.Thread(target=self._worker_loop, name=f"winstrument-{self.modulename}", daemon=True)
+            self._worker.start()
+
+    def get_setting_boolean(self, key, default=False):
+        """
+        Returns the module setting with the given key interpreted as a boolean, or default if it is unset or not a boolean
+        """
+        val = str(self._settings.get(key, "")).lower()
+        if val == "yes" or val == "true":
+            return True
+        elif val == "no" or val == "false":
+            return False
+        return default
 
+    def get_setting_int(self, key, default=None):
+        """
+        Returns the module setting with the given key as an int, or default if it is unset or not a number
+        """
+        try:
+            return int(self._settings.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
     def write_message(self, message):
         """
-        Writes the specified message dict to the database and stores in it in _messages as a ModuleMessage data object
+        Writes the specified message dict to the database as a ModuleMessage data object. Messages aren't kept in memory, see get_output
+        When called while handling an event from the agent, the message is stamped with the time the event was emitted in the target,
+        otherwise with the current time.
         Params:
             message - dict of key, value pairs
         No return
          """
-        modulemessage = ModuleMessage(self.modulename, self._processpath, message)
-        self._db.write_message(modulemessage)
-        self._messages.append(modulemessage)
+        modulemessage = ModuleMessage(self.modulename, self._processpath, message, time=self._event_time, pid=self._pid, session=self._session_id, run_id=self._run_id)
+        self._db.write_message(modulemessage, dedup=self._dedup)
 
     def get_name(self):
         return self.modulename
@@ -50,18 +173,42 @@ class BaseInstrumentation:
         """
         Load the associated JS file for this moudle into the Frida session, then hook any callbacks etc, and start the script
         """
-        with open(os.path.join(os.path.dirname(__file__),"modules","js",f"{self.modulename}.js"),'r') as scriptfile:
-            self._script = self._session.create_script(scriptfile.read())
+        self._script = create_script(self._session, self.get_script_source())
         self.register_callbacks()
         self._script.load()
         self.on_load()
 
+    def get_agent_config(self):
+        """
+        Returns the dict made available to the injected JS as AGENT_CONFIG.
+        By default this holds the volume controls used by js/lib/sampling.js, read from the module's settings:
+        sample (1 in N sampling), rate_limit and rate_burst (token bucket, events per second), dedup_ms (identical event window),
+        profile, which enables the hook profiler in js/lib/profiler.js, and binary, which makes js/lib/records.js send packed binary records.
+        Override in subclasses to pass module specific options, extending the dict from super().
+        """
+        return {"sample": self.get_setting_int("sample", 1),
+            "rate_limit": self.get_setting_int("rate_limit", 0),
+            "rate_burst": self.get_setting_int("rate_burst", 0),
+            "dedup_ms": self.get_setting_int("dedup_ms", 0),
+            "profile": self.get_setting_boolean("profile", False),
+            "binary": self.get_setting_boolean("binary", False)}
+
+    def get_script_source(self):
+        """
+        Returns the JS source to inject for this module: the AGENT_CONFIG declaration, the shared agent libraries, then modules/js/<modulename>.js
+        """
+        sources = [f"var AGENT_CONFIG = {json.dumps(self.get_agent_config())};"]
+        sources += [read_script_file(os.path.join(JS_PATH,"lib",f"{lib}.js")) for lib in AGENT_LIBS]
+        sources.append(read_script_file(os.path.join(JS_PATH,f"{self.modulename}.js")))
+        return "\n".join(sources)
+
     def get_output(self):
         """
         Returns a list of ModuleMessage objects
-        Each object represents a single message sent by the module
+        Each object represents a single message written by this instrumentation, read back from the database
         """
-        return self._messages
+        run_ids = [self._run_id] if self._run_id is not None else None
+        return list(self._db.iter_messages(self.modulename, run_ids, pid=self._pid))
 
     def on_load(self):
         """
@@ -79,16 +226,229 @@ class BaseInstrumentation:
         else:
             self.write_message(message["payload"])
 
+    def _dispatch_message(self, message, data):
+        """
+        Handler for frida's 'message' event. Handles the message now, or queues it for the worker thread in executor mode.
+        """
+        if self._recorder is not None:
+            self._recorder.record(self.modulename, message, data)
+        if self._metrics is not None:
+            self._metrics.increment(self.modulename, "messages")
+            self._metrics.increment(self.modulename, "payload_bytes", self._estimate_payload_size(message, data))
+        if self._queue is not None:
+            self._queue.put((message, data))
+            if self._metrics is not None:
+                self._metrics.set_gauge(self.modulename, "queue_depth", self._queue.qsize())
+        else:
+            with self._handler_lock:
+                self._handle_message(message, data)
+
+    def _estimate_payload_size(self, message, data):
+        """
+        Approximate size in bytes of a message as it crossed from the target, for the payload_bytes metric.
+        Binary data is counted exactly. Serializing every JSON payload again would cost the message thread as much as handling it,
+        so only one message in PAYLOAD_SIZE_SAMPLE is measured, and the rest are estimated from the mean size per event of those.
+        """
+        payload = message.get("payload")
+        events = len(payload["batch"]) if isinstance(payload, dict) and isinstance(payload.get("batch"), list) else 1
+        if self._payload_messages % PAYLOAD_SIZE_SAMPLE == 0:
+            size = len(json.dumps(payload, separators=(",", ":")))
+            self._payload_sampled_bytes += size
+            self._payload_sampled_events += events
+        else:
+            size = events * self._payload_sampled_bytes // max(self._payload_sampled_events, 1)
+        self._payload_messages += 1
+        return size + (len(data) if data else 0)
+
+    def _worker_loop(self):
+        """
+        Executor mode worker thread body. Handles queued messages in order until it receives None from _drain.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if item is _FLUSH_PARTIAL:
+                self._call_on_flush()
+                continue
+            try:
+                self._handle_message(*item)
+            except Exception:
+                sys.stderr.write(f"Error in {self.modulename} message handler:\n{traceback.format_exc()}")
+
+    def _drain(self):
+        """
+        Wait for the worker thread to handle every queued message, then stop it. No-op unless in executor mode.
+        """
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+            self._queue = None
+
+    def _handle_message(self, message, data):
+        """
+        The agent-side emit() helper sends events in batches of the form {"batch": [event, ...], "times": [timestamp, ...]}.
+        Unpack them and call on_message once per event, so modules see the same message as for a plain send().
+        Each event's timestamp, integer microseconds since the epoch taken in the target when it was emitted, is used by write_message.
+        Binary records from emitRecord() (see js/lib/records.js) are decoded and passed to on_message in the same way.
+        """
+        payload = message["payload"] if message["type"] == "send" else None
+        if isinstance(payload, dict) and "batch" in payload:
+            events = payload["batch"]
+            self._handle_events(zip(payload.get("times") or [None] * len(events), events), data)
+        elif isinstance(payload, dict) and "records" in payload:
+            if self._record_decoder is None:
+                self._record_decoder = RecordDecoder()
+            try:
+                events = self._record_decoder.decode(payload, data)
+            except (ValueError, KeyError, struct.error) as e:
+                print(f"Error: invalid records from {self.modulename}: {e}")
+                return
+            self._handle_events(events, None)
+        else:
+            self._call_on_message(message, data)
+
+    def _handle_events(self, events, data):
+        """
+        Pass unpacked events to on_message, or on_control_event for events from the agent libraries
+        events - iterable of (time, event dict). time is in microseconds since the epoch, or None to use the current time.
+        """
+        try:
+            for event_time, event in events:
+                self._event_time = event_time
+                if "__control__" in event:
+                    self.on_control_event(event)
+                else:
+                    self._call_on_message({"type": "send", "payload": event}, data)
+        finally:
+            self._event_time = None
+
+    def _call_on_message(self, message, data):
+        """
+        Call on_message, timing it if metrics are being collected
+        """
+        if self._metrics is None:
+            self.on_message(message, data)
+            return
+        start = time.perf_counter_ns()
+        try:
+            self.on_message(message, data)
+        finally:
+            self._metrics.observe(self.modulename, "handler_us", (time.perf_counter_ns() - start) // 1000)
+            self._metrics.increment(self.modulename, "events")
+
+    def on_control_event(self, event):
+        """
+        Handles events generated by the shared agent libraries rather than by the module's hooks. These are never passed to on_message.
+        event - dict with a "__control__" key naming the kind of event
+        """
+        if event["__control__"] == "suppressed":
+            self._suppressed.update(event["counts"])
+        elif event["__control__"] == "profile":
+            for hook, totals in event["hooks"].items():
+                merged = self._hook_profiles.setdefault(hook, {"calls": 0, "enter_us": 0, "leave_us": 0, "max_us": 0})
+                merge_hook_profile(merged, totals)
+            if self._metrics is not None:
+                self._metrics.add_hook_profiles(self.modulename, event["hooks"])
+
+    def flush_partial(self):
+        """
+        Called periodically by Winstrument while the target is running, when output is being followed live.
+        Calls on_flush between messages: in executor mode it is queued behind the messages already waiting for the worker.
+        """
+        if self._queue is not None:
+            self._queue.put(_FLUSH_PARTIAL)
+        else:
+            with self._handler_lock:
+                self._call_on_flush()
+
+    def _call_on_flush(self):
+        try:
+            self.on_flush()
+        except Exception:
+            sys.stderr.write(f"Error in {self.modulename} flush handler:\n{traceback.format_exc()}")
+
+    def on_flush(self):
+        """
+        Callback called periodically while the target is running, when output is being followed live (see flush_partial).
+        Modules that aggregate events on the host and only write them in on_finish should write out what they have so far here,
+        so long running targets produce output before they exit. Override in subclasses if desired.
+        """
+        pass
+
     def register_callbacks(self):
         """
         Callback called in load_script before the JS is injeted in the target.
         Hook frida events like 'message', 'detached' etc here as needed
         """
-        self._script.on("message", self.on_message)
+        self._script.on("message", self._dispatch_message)
 
 
+    def finalize(self):
+        """
+        Called by Winstrument after the target has been detached. Handles any messages still queued for the worker thread, then calls on_finish.
+        """
+        self._drain()
+        self.on_finish()
+        if sum(self._suppressed.values()) > 0:
+            #keep a record of what sampling dropped, so counts in the output can be interpreted honestly
+            self.write_message({"function": "(suppressed)", **self._suppressed})
+        for hook, totals in self._hook_profiles.items():
+            self.write_message({"function": "(profile)", "hook": hook, **totals})
+
     def on_finish(self):
         """
         Callback called after the target has been detached. Perform any desired cleanup operations here.
         """
         pass
+
+
+class CombinedAgent:
+    """
+    Loads the scripts of several instrumentations into a session as a single Frida script, instead of one script per module.
+    Each module's source runs in its own function scope with send() wrapped to tag messages with the module name,
+    and messages are routed back to the matching instrumentation on the host.
+    """
+    def __init__(self, session, instrumentations):
+        """
+        session - Frida session
+        instrumentations - list of BaseInstrumentation objects for the session
+        """
+        self._session = session
+        self._instrumentations = {instrumentation.modulename: instrumentation for instrumentation in instrumentations}
+        self._script = None
+
+    def get_script_source(self):
+        """
+        Returns the combined JS source for all instrumentations
+        """
+        parts = []
+        for modulename, instrumentation in self._instrumentations.items():
+            tagged_send = f"function (payload, data) {{ send({{ \"module\": {json.dumps(modulename)}, \"payload\": payload }}, data); }}"
+            parts.append(f"(function (send) {{\n{instrumentation.get_script_source()}\n}})({tagged_send});")
+        return "\n".join(parts)
+
+    def load(self):
+        """
+        Create and load the combined script, then call on_load for each instrumentation
+        """
+        self._script = create_script(self._session, self.get_script_source())
+        self._script.on("message", self.on_message)
+        for instrumentation in self._instrumentations.values():
+            instrumentation._script = self._script
+        self._script.load()
+        for instrumentation in self._instrumentations.values():
+            instrumentation.on_load()
+
+    def on_message(self, message, data):
+        """
+        Handler for frida's 'message' event. Routes tagged messages to the instrumentation for the module that sent them.
+        """
+        if message["type"] == "send":
+            payload = message["payload"]
+            instrumentation = self._instrumentations.get(payload.get("module"))
+            if instrumentation is not None:
+                instrumentation._dispatch_message({"type": "send", "payload": payload["payload"]}, data)
+                return
+        print(f"Error: {message}")
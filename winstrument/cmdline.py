@@ -16,7 +16,9 @@ import cmd2,sys
 from winstrument.winstrument import Winstrument
 from colorama import Fore, Back, Style
 from cmd2 import with_argument_list
+from cmd2.utils import strip_quotes
 import winstrument.utils as utils
+import json
 class FridaCmd(cmd2.Cmd):
     prompt = "> "
     def __init__(self, app):
@@ -108,58 +110,93 @@ class FridaCmd(cmd2.Cmd):
                 self.poutput(description)
             except (KeyError, AttributeError):
                 self.perror(f"No description for module {modulename}")
-    @with_argument_list
+    def _split_query(self, args):
+        """
+        Split command arguments into the arguments before a query, with quotes removed, and the parsed query
+        args - list of str, with quotes preserved
+        Returns (list of str, Query or None)
+        Raises QueryError if the query is invalid
+        """
+        from winstrument.query import is_query, parse_query #only needed by show and export, so not imported at startup
+        for index, arg in enumerate(args):
+            if is_query(arg):
+                return [strip_quotes(arg) for arg in args[:index]], parse_query(" ".join(args[index:]))
+        return [strip_quotes(arg) for arg in args], None
+
+    @with_argument_list(preserve_quotes=True)
     def do_show(self, arg):
-        """usage: show [modulename [format]]
+        """usage: show [modulename [format] [query]]
         Shows the output from modulename in the specified format
         Run without arguments to view available formats
+        The query filters and aggregates the output in the database, for example:
+            show file_rw where path like '%Temp%' group by path order by count desc
+        Shells treat > and | as output redirection, so write comparisons like 100 < bytes.
+        Output followed live splits the totals of open files and sockets across rows marked partial, so aggregate them for totals:
+            show file_rw select path, sum(bytes) group by path
         """
+        from winstrument.query import QueryError
+        try:
+            arg, query = self._split_query(arg)
+        except QueryError as e:
+            self.perror(f"Invalid query: {e}")
+            return
         if len(arg) > 2:
-            self.perror("usage: show [modulename [format]]")
+            self.perror("usage: show [modulename [format] [query]]")
         if len(arg) < 1:
             info = f"Available formatters:\n{self._get_formatter_list()}"
             self.poutput(info)
             return
 
         if len(arg) == 1:
-            self.print_format(arg[0], sys.stdout )
+            self.print_format(arg[0], sys.stdout, query=query)
             return
         elif len(arg) == 2:
-            self.print_format(arg[0], sys.stdout, arg[1])
+            self.print_format(arg[0], sys.stdout, arg[1], query=query)
 
 
-    def print_format(self, modulename, outfile, formatter=None):
+    def print_format(self, modulename, outfile, formatter=None, query=None):
         if formatter is not None:
             try:
                 style = utils.get_formatter(formatter)
             except ValueError:
                 print(f"Invalid format\nAvailable formatters:\n{self._get_formatter_list()}")
                 return
-            self._app.print_saved_output(modulename, style, output=outfile)
         else:
-            self._app.print_saved_output(modulename, output=outfile)
+            style = utils.format_table
+        import sqlite3
+        try:
+            self._app.print_saved_output(modulename, style, output=outfile, query=query)
+        except sqlite3.Error as e: #e.g. comparing with a value of the wrong type, or SQLite built without JSON support
+            self.perror(f"Query failed: {e}")
 
-    @with_argument_list
+    @with_argument_list(preserve_quotes=True)
     def do_export(self,args):
         """
-        usage: export <modulename> <filename> [format]
+        usage: export <modulename> <filename> [format] [query]
         Exports the stored output of module <modulename> to the file stored in filename in the given format
+        The query filters and aggregates the output in the same way as for show
         """
+        from winstrument.query import QueryError
+        try:
+            args, query = self._split_query(args)
+        except QueryError as e:
+            self.perror(f"Invalid query: {e}")
+            return
         if len(args) < 1:
-            self.perror("usage: export <modulename> <filename> [format]")
+            self.perror("usage: export <modulename> <filename> [format] [query]")
             info = f"Available formatters:\n{self._get_formatter_list()}"
             self.poutput(info)
             return
 
         if len(args) != 2 and len(args) != 3:
-            self.perror("usage: export <modulename> <filename> [format]")
+            self.perror("usage: export <modulename> <filename> [format] [query]")
             return
 
         with open(args[1], 'w+') as outfile:
             if len(args) == 2:
-                self.print_format(args[0], outfile)
+                self.print_format(args[0], outfile, query=query)
             elif len(args) == 3:
-                self.print_format(args[0], outfile, args[2])
+                self.print_format(args[0], outfile, args[2], query=query)
 
     @with_argument_list
     def do_exportall(self,args):
@@ -187,8 +224,69 @@ class FridaCmd(cmd2.Cmd):
                         style = utils.get_formatter(args[1])
                     except ValueError:
                         print(f"Invalid Formatter\nAvailable formatters:\n{self._get_formatter_list()}")
+                        return
                     self._app.export_all(outfile,formatter=style)
 
+    @with_argument_list
+    def do_runs(self, args):
+        """
+        usage: runs [run_id ...]
+        With no arguments, list the runs stored in the database. Runs shown by show/export are marked with *.
+        With one or more run IDs, show/export will display output from those runs.
+        """
+        if len(args) == 0:
+            from tabulate import tabulate #imported on first use, to keep startup fast
+            selected = self._app.get_selected_runs()
+            rows = []
+            for run in self._app.get_runs():
+                rows.append(["*" if run["run_id"] in selected else "", run["run_id"], run["target"], run["args"] or "",
+                    utils.format_timestamp(run["started"]), utils.format_timestamp(run["finished"]), run["messages"]])
+            self.poutput(tabulate(rows, headers=["", "run", "target", "args", "started", "finished", "messages"]))
+            return
+        try:
+            self._app.select_runs(args)
+        except ValueError as e:
+            self.perror(str(e))
+
+    @with_argument_list
+    def do_stats(self, args):
+        """
+        usage: stats [json [filename]]
+        Show message counts, handler and database timings, queue depths and memory use from the latest run.
+        With json, print them as JSON, or write them to filename, for comparing overhead between versions.
+        """
+        if len(args) == 0:
+            self.poutput(self._app.format_stats())
+        elif args[0].lower() == "json" and len(args) <= 2:
+            dump = json.dumps(self._app.get_stats(), indent=2)
+            if len(args) == 2:
+                with open(args[1], 'w') as outfile:
+                    outfile.write(dump + "\n")
+            else:
+                self.poutput(dump)
+        else:
+            self.perror("usage: stats [json [filename]]")
+
+    @with_argument_list
+    def do_replay(self, args):
+        """
+        usage: replay <recording> [modulename ...]
+        Feed a session recorded with the record setting back through the modules, without running the target.
+        The output is stored as a new run and can be viewed with show/export. Optionally only replay the named modules.
+        """
+        if len(args) < 1:
+            self.perror("usage: replay <recording> [modulename ...]")
+            return
+        modules = [module.lower() for module in args[1:]] or None
+        try:
+            count = self._app.replay(args[0], modules)
+        except (OSError, ValueError) as e:
+            self.perror(str(e))
+            return
+        self.poutput(f"Replayed {count} messages from {args[0]}")
+
+    complete_replay = cmd2.Cmd.path_complete
+
     def do_config(self,args):
         """
         usage: config [setting, [value]]
@@ -204,19 +302,34 @@ class FridaCmd(cmd2.Cmd):
         with no arguments: show settings
         with [setting]: show value of [setting]
         with [setting [value]]: set [setting] to [value]
+        Module settings are named <modulename>.<setting>, e.g. set dlls.executor false
         """
         if len(args) == 0:
             settings = self._app.settings_controller.get_module_settings(self._app.CORE_MODNAME)
             for key, value in settings.items():
                 self.poutput(f"{key}={value}")
+            for module in self._app.get_available_modules():
+                for key, value in self._app.settings_controller.get_module_settings(module).items():
+                    self.poutput(f"{module}.{key}={value}")
         elif len(args) == 1:
-            value = self._app.settings_controller.get_setting(self._app.CORE_MODNAME, args[0])
+            modname, key = self._split_setting(args[0])
+            value = self._app.settings_controller.get_setting(modname, key)
             self.poutput(f"{args[0]}={value}")
         elif len(args) == 2:
-            self._app.settings_controller.set_setting(self._app.CORE_MODNAME,args[0], args[1])
+            modname, key = self._split_setting(args[0])
+            self._app.settings_controller.set_setting(modname, key, args[1])
         else:
             pass
 
+    def _split_setting(self, name):
+        """
+        Splits a setting name of the form <modulename>.<setting> into (modulename, setting). Names without a module prefix are core settings.
+        """
+        modname, sep, key = name.partition(".")
+        if sep and modname.lower() in self._app.get_available_modules():
+            return modname.lower(), key
+        return self._app.CORE_MODNAME, name
+
     @with_argument_list
     def do_run(self,arg):
         """
@@ -230,6 +343,57 @@ class FridaCmd(cmd2.Cmd):
         else:
             print("Error: must specify target first")
 
+    @with_argument_list
+    def do_tail(self, args):
+        """
+        usage: tail <modulename> [format]
+        Spawn and instrument the target process like run, printing output from modulename as it is stored rather than when the target exits.
+        Modules that aggregate results, like file_rw, write out what they have so far every live_interval seconds.
+        """
+        if len(args) < 1 or len(args) > 2:
+            self.perror("usage: tail <modulename> [format]")
+            return
+        modulename = args[0].lower()
+        if modulename not in self._app.get_loaded_modules():
+            self.perror(f"{args[0]} is not loaded")
+            return
+        style = None
+        if len(args) == 2:
+            try:
+                style = utils.get_formatter(args[1])
+            except ValueError:
+                self.perror(f"Invalid format\nAvailable formatters:\n{self._get_formatter_list()}")
+                return
+        target = self._app.settings_controller.get_setting(self._app.CORE_MODNAME,"target")
+        run_args = self._app.settings_controller.get_setting(self._app.CORE_MODNAME,"args")
+        if target != "":
+            self._app.run(target, run_args, follow=[modulename], formatter=style)
+        else:
+            print("Error: must specify target first")
+
+    @with_argument_list
+    def do_scan(self, args):
+        """
+        usage: scan <listfile|dir> [restart]
+        Spawn and instrument every target in listfile (one path per line, optionally followed by a tab and arguments), or every .exe under dir, with the loaded modules.
+        Several targets run at once, each is killed after scan_timeout seconds, and the output of each is stored as its own run. See runs.
+        Scanning the same source again continues an interrupted scan, unless restart is given.
+        """
+        if len(args) < 1 or len(args) > 2 or (len(args) == 2 and args[1].lower() != "restart"):
+            self.perror("usage: scan <listfile|dir> [restart]")
+            return
+        if not self._app.get_loaded_modules():
+            self.perror("No modules loaded. Use load <modulename> first")
+            return
+        try:
+            progress = self._app.scan(args[0], restart=len(args) == 2)
+        except (OSError, ValueError) as e:
+            self.perror(str(e))
+            return
+        self.poutput(_format_scan_progress(progress))
+
+    complete_scan = cmd2.Cmd.path_complete
+
     def do_quit(self, arg):
         """
         Usage: quit
@@ -238,7 +402,44 @@ class FridaCmd(cmd2.Cmd):
         self._app.quit()
         return True
 
+def _format_scan_progress(progress):
+    """
+    Returns a one line summary of a scan's targets by status
+    progress - dict of status -> count, see Winstrument.scan
+    """
+    return "Scan finished: " + ", ".join(f"{count} {status}" for status, count in sorted(progress.items()))
+
+def scan_main(argv):
+    """
+    Entry point for "winstrument scan", which runs a batch scan without the interactive shell.
+    Output is stored in the archive database, so it can be viewed later with runs and show, and an interrupted scan can be resumed.
+    argv - list of command line arguments after "scan"
+    Returns the exit status
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="winstrument scan", description="Instrument every executable in a list file or directory, several at a time.")
+    parser.add_argument("source", help="text file with one target per line, optionally followed by a tab and arguments, or a directory searched for .exe files")
+    parser.add_argument("-m", "--module", dest="modules", action="append", help="module to load, can be repeated. Defaults to every available module.")
+    parser.add_argument("-j", "--concurrency", type=int, help="number of targets to run at once. Defaults to the scan_concurrency setting, or 4.")
+    parser.add_argument("-t", "--timeout", type=int, help="seconds before a target is killed. Defaults to the scan_timeout setting, or 60.")
+    parser.add_argument("--restart", action="store_true", help="scan every target again instead of continuing an earlier scan of the same source")
+    options = parser.parse_args(argv)
+    app = Winstrument(archive=True)
+    for module in options.modules or app.get_available_modules():
+        app.load_module(module.lower())
+    try:
+        progress = app.scan(options.source, restart=options.restart, concurrency=options.concurrency, timeout=options.timeout)
+    except (OSError, ValueError) as e:
+        print(f"{Fore.RED}{e}{Style.RESET_ALL}", file=sys.stderr)
+        return 1
+    finally:
+        app.quit()
+    print(_format_scan_progress(progress))
+    return 0
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "scan":
+        sys.exit(scan_main(sys.argv[2:]))
     app = Winstrument()
     cmd = FridaCmd(app)
     sys.exit(cmd.cmdloop())
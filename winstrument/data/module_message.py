@@ -12,22 +12,77 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from datetime import datetime
 import winstrument.utils as utils
 import os
+import time as _time
+
+#payload keys holding microseconds since the epoch, stored as integers and only formatted for display
+TIME_FIELDS = ["first_seen", "last_seen"]
+
+def timestamp_now():
+    """
+    Returns the current time as integer microseconds since the epoch, the format stored in the database
+    """
+    return _time.time_ns() // 1000
 
 class ModuleMessage():
-    def __init__(self, module, target, data, time=datetime.now().strftime("%Y-%m-%d %T")):
+    def __init__(self, module, target, data, time=None, pid=None, session=None, run_id=None, count=1, last_time=None):
+        """
+        module - str, name of the module that produced the message
+        target - str, path of the instrumented process
+        data - dict, message payload
+        time - int, microseconds since the epoch. Defaults to the current time.
+        pid - int, PID of the instrumented process
+        session - int, index of the Frida session within the run
+        run_id - str, unique ID of the run that produced the message
+        count - int, number of identical messages this one stands for. Only above 1 for messages stored in dedup mode.
+        last_time - int, microseconds since the epoch of the last identical message, for messages stored in dedup mode. None otherwise.
+        """
         self.module = module
-        self.time = time
+        self.time = time if time is not None else timestamp_now()
         self.target = target
         self.data = data
+        self.pid = pid
+        self.session = session
+        self.run_id = run_id
+        self.count = count
+        self.last_time = last_time
+
+    def format_time(self):
+        """
+        Returns the timestamp as a human readable local time string, with millisecond precision
+        """
+        return utils.format_timestamp(self.time)
+
+    def display_data(self):
+        """
+        Returns the payload with the TIME_FIELDS formatted as human readable local time strings
+        """
+        return {key: utils.format_timestamp(value) if key in TIME_FIELDS else value for key, value in self.data.items()}
+
     def flatten(self):
-        fulldata = {"module": self.module, "time": self.time, "target": self.target}
-        fulldata.update(self.data)
+        fulldata = {"module": self.module, "time": self.format_time()}
+        if self.target is not None: #rows aggregated by a query have no target
+            fulldata["target"] = self.target
+        if self.pid is not None:
+            fulldata["pid"] = self.pid
+        fulldata.update(self.display_data())
+        if self.last_time is not None: #stored in dedup mode
+            fulldata["count"] = self.count
+            fulldata["last_time"] = utils.format_timestamp(self.last_time)
         return fulldata
+
+    def copy(self, **changes):
+        """
+        Return a copy of the message, with any of the constructor arguments replaced by the given keyword arguments
+        """
+        fields = {"module": self.module, "target": self.target, "data": self.data, "time": self.time,
+                  "pid": self.pid, "session": self.session, "run_id": self.run_id, "count": self.count, "last_time": self.last_time}
+        fields.update(changes)
+        return ModuleMessage(**fields)
+
     def truncate_path(self):
         """
         Return a copy of the message with the target path elipsized
         """
-        return ModuleMessage(self.module, utils.elipsize_path(self.target), self.data, self.time)
\ No newline at end of file
+        return self.copy(target=utils.elipsize_path(self.target))
@@ -13,57 +13,493 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import sqlite3
-from winstrument.data.module_message import ModuleMessage
+from winstrument.data.module_message import ModuleMessage, timestamp_now
 import sys
 from datetime import datetime
+import hashlib
+import itertools
 import json
 import os
+import queue
+import threading
+import time
 import toml
+
+#Each entry upgrades the schema by one version; PRAGMA user_version records how many have been applied.
+SCHEMA_MIGRATIONS = [
+    #1: original unversioned schema
+    """CREATE TABLE IF NOT EXISTS output
+        (id INTEGER PRIMARY KEY,
+        modname TEXT NOT NULL,
+        time TEXT NOT NULL,
+        target TEXT NOT NULL,
+        message BLOB)""",
+    #2: integer timestamps (microseconds since the epoch), process/session/run columns and indexes
+    """CREATE TABLE output_v2
+        (id INTEGER PRIMARY KEY,
+        modname TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        target TEXT NOT NULL,
+        pid INTEGER,
+        session INTEGER,
+        run_id TEXT,
+        message BLOB);
+    INSERT INTO output_v2 (id, modname, time, target, message)
+        SELECT id, modname, COALESCE(CAST(strftime('%s', time, 'utc') AS INTEGER), 0) * 1000000, target, message FROM output;
+    DROP TABLE output;
+    ALTER TABLE output_v2 RENAME TO output;
+    CREATE INDEX output_modname ON output (modname);
+    CREATE INDEX output_target ON output (target);
+    CREATE INDEX output_time ON output (time);
+    CREATE INDEX output_pid ON output (pid);
+    CREATE INDEX output_run_id ON output (run_id);""",
+    #3: one row per run, so a persistent database can hold the output of many runs
+    """CREATE TABLE runs
+        (run_id TEXT PRIMARY KEY,
+        target TEXT,
+        args TEXT,
+        started INTEGER NOT NULL,
+        finished INTEGER);
+    INSERT INTO runs (run_id, started, finished)
+        SELECT run_id, MIN(time), MAX(time) FROM output WHERE run_id IS NOT NULL GROUP BY run_id;
+    CREATE INDEX runs_started ON runs (started);""",
+    #4: dedup mode. Identical messages share a row, identified by a digest of their content, with an occurrence count and last seen time.
+    """ALTER TABLE output ADD COLUMN count INTEGER NOT NULL DEFAULT 1;
+    ALTER TABLE output ADD COLUMN last_time INTEGER;
+    ALTER TABLE output ADD COLUMN digest TEXT;
+    CREATE UNIQUE INDEX output_digest ON output (digest) WHERE digest IS NOT NULL;""",
+    #5: batch scan queue, see scanner.py. One row per target of a scan, so an interrupted scan can be resumed.
+    """CREATE TABLE scan_queue
+        (id INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,
+        target TEXT NOT NULL,
+        args TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT 'pending',
+        run_id TEXT,
+        started INTEGER,
+        finished INTEGER,
+        UNIQUE (source, target, args));""",
+]
+
+INSERT_MESSAGE = """INSERT INTO "output" (modname, time, target, pid, session, run_id, message, count, last_time, digest) VALUES (?,?,?,?,?,?,?,?,?,?)"""
+#dedup mode. UPSERT needs SQLite 3.24+, so it is only used for messages that have a digest, and older versions store every message as its own row.
+SUPPORTS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+UPSERT_MESSAGE = INSERT_MESSAGE + """
+    ON CONFLICT (digest) WHERE digest IS NOT NULL
+    DO UPDATE SET count = count + excluded.count, last_time = MAX(last_time, excluded.last_time)"""
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
 class DBConnection():
 
-    def __init__(self,dbpath):
+    def __init__(self,dbpath, write_behind=False, batch_size=500, flush_interval=0.25, max_queue=10000, persistent=False, metrics=None):
+        """
+        dbpath: str - path to the sqlite database file
+        persistent: bool - if True, the database is kept when closed so it can archive many runs. Otherwise it is deleted on close.
+        write_behind: bool - if True, messages are queued and written in batches by a background writer thread instead of one commit per message
+        batch_size: int - maximum number of messages written in a single transaction in write-behind mode
+        flush_interval: float - maximum number of seconds a queued message waits before being written in write-behind mode
+        max_queue: int - maximum number of queued messages. write_message blocks when the queue is full.
+        metrics: MetricsRegistry or None - if set, write latencies and queue depth are reported to it under the "db" scope. See metrics.py
+        """
         self._db = sqlite3.connect(dbpath,check_same_thread=False)
+        self._metrics = metrics
         self._dbpath = dbpath
+        self._persistent = persistent
+        self._lock = threading.RLock()
         self._cursor = self._db.cursor()
-        self._cursor.execute("""CREATE TABLE IF NOT EXISTS output
-                            (id INTEGER PRIMARY KEY,
-                            modname TEXT NOT NULL,
-                            time TEXT NOT NULL,
-                            target TEXT NOT NULL,
-                            message BLOB)""")
-        self._db.commit()
+        #only takes effect on a new database, before any table is created. See apply_retention for existing ones.
+        self._cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._migrate()
+
+        self._write_behind = write_behind
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = None
+        self._writer = None
+        if write_behind:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._stop_writer = threading.Event()
+            self._writer = threading.Thread(target=self._writer_loop, name="winstrument-db-writer", daemon=True)
+            self._writer.start()
 
-    def write_message(self, message):
+    def _migrate(self):
+        """
+        Bring the database schema up to SCHEMA_VERSION, applying each pending migration in its own transaction
+        """
+        version = self._cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version, SCHEMA_VERSION):
+            #executescript commits any pending transaction first, so BEGIN/COMMIT make each step atomic
+            self._cursor.executescript(f"BEGIN; {SCHEMA_MIGRATIONS[number]}; PRAGMA user_version = {number + 1}; COMMIT;")
+
+    def _to_row(self, message, dedup=False):
+        data = json.dumps(message.data, sort_keys=dedup)
+        if not dedup or not SUPPORTS_UPSERT:
+            return (message.module, message.time, message.target, message.pid, message.session, message.run_id, data, message.count, message.last_time, None)
+        digest = hashlib.sha1(json.dumps([message.module, message.target, message.run_id, data]).encode()).hexdigest()
+        return (message.module, message.time, message.target, message.pid, message.session, message.run_id, data, message.count, message.last_time or message.time, digest)
+
+    def write_message(self, message, dedup=False):
         """
         Insert the given message into the sqlite DB output table
+        In write-behind mode the message is queued and written by the writer thread.
         message - ModuleMessage object
+        dedup - bool, if True and an identical message (same module, target, run and payload) is already stored, increment its count and last seen time instead of adding a row.
+                Ignored with SQLite versions before 3.24.
+        """
+        row = self._to_row(message, dedup)
+        if self._write_behind:
+            self._queue.put(row)
+            if self._metrics is not None:
+                self._metrics.set_gauge("db", "queue_depth", self._queue.qsize())
+            return
+        start = time.perf_counter_ns()
+        with self._lock:
+            self._cursor.execute(INSERT_MESSAGE if row[-1] is None else UPSERT_MESSAGE, row)
+            self._db.commit()
+        self._record_write(start, 1)
+
+    def _record_write(self, start, rows):
+        """
+        Report a write transaction to the metrics registry, if there is one
+        start - int, time.perf_counter_ns() when the write started
+        rows - int, number of rows written
+        """
+        if self._metrics is not None:
+            self._metrics.observe("db", "write_us", (time.perf_counter_ns() - start) // 1000)
+            self._metrics.increment("db", "rows_written", rows)
+
+    def _write_rows(self, rows):
+        """
+        Insert a batch of rows in a single transaction
+        rows - list of tuples as returned by _to_row
+        """
+        if not rows:
+            return
+        start = time.perf_counter_ns()
+        with self._lock:
+            #consecutive rows of the same kind share a statement, keeping rows in arrival order
+            for dedup, group in itertools.groupby(rows, key=lambda row: row[-1] is not None):
+                self._cursor.executemany(UPSERT_MESSAGE if dedup else INSERT_MESSAGE, group)
+            self._db.commit()
+        self._record_write(start, len(rows))
+
+    def _writer_loop(self):
+        """
+        Writer thread body. Collects queued rows until either batch_size rows are pending or flush_interval has elapsed, then writes them.
+        """
+        while not (self._stop_writer.is_set() and self._queue.empty()):
+            try:
+                rows = [self._queue.get(timeout=self._flush_interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self._flush_interval
+            while len(rows) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write_rows(rows)
+            except sqlite3.Error as e:
+                sys.stderr.write(f"Error writing {len(rows)} messages to the database: {e}\n")
+            for _ in rows:
+                self._queue.task_done()
+
+    def flush(self):
         """
-        self._cursor.execute("""INSERT INTO "output" (modname, time, target, message) VALUES (?,?,?,?)""", (message.module, message.time, message.target, json.dumps(message.data)))
-        self._db.commit()
+        Block until every queued message has been written to the database. No-op unless in write-behind mode.
+        """
+        if self._write_behind and self._writer.is_alive():
+            self._queue.join()
 
     def clear_output(self):
         """
         Truncates the output table
         """
-        self._cursor.execute('DELETE FROM "output"')
-        self._db.commit()
+        self.flush()
+        with self._lock:
+            self._cursor.execute('DELETE FROM "output"')
+            self._db.commit()
+
+    def iter_messages(self, modname, run_ids=None, chunk_size=1000, pid=None):
+        """
+        Generator yielding all messages for the given module name, reading chunk_size rows at a time so memory use stays constant
+        modname: str - Name of the module for which to retrieve messages
+        run_ids: list of str or None - only return messages from these runs. None returns messages from every run.
+        pid: int or None - only return messages from this process
+        Yields ModuleMessage objects
+        """
+        self.flush()
+        where, params = "modname = ?", [modname]
+        if pid is not None:
+            where, params = "modname = ? AND pid = ?", [modname, pid]
+        for _, message in self._iter_rows(where, params, run_ids, chunk_size):
+            yield message
+
+    def iter_messages_after(self, after_id, modname, run_ids=None, up_to=None, chunk_size=1000):
+        """
+        Generator yielding the messages for the given module name written after the row with ID after_id, oldest first.
+        Used to follow output while a run is in progress: pass the ID of the last row already shown, see get_last_id.
+        Unlike iter_messages, this doesn't wait for queued messages in write-behind mode. They are returned once written.
+        after_id: int - row ID watermark
+        modname: str - Name of the module for which to retrieve messages
+        run_ids: list of str or None - only return messages from these runs
+        up_to: int or None - if set, stop at the row with this ID, so several modules can be read up to the same point
+        Yields (row ID, ModuleMessage) tuples
+        """
+        where = "modname = ? AND id > ?"
+        params = [modname, after_id]
+        if up_to is not None:
+            where += " AND id <= ?"
+            params.append(up_to)
+        return self._iter_rows(where, params, run_ids, chunk_size)
+
+    def get_last_id(self):
+        """
+        Returns the ID of the newest row written to the output table, or 0 if it is empty. Row IDs only increase, so this is a watermark for iter_messages_after.
+        """
+        with self._lock:
+            last_id = self._cursor.execute('SELECT MAX(id) FROM "output"').fetchone()[0]
+        return last_id or 0
+
+    def iter_query(self, modname, query, run_ids=None, chunk_size=1000):
+        """
+        Generator yielding the messages for the given module name selected by a show/export query, which is run by SQLite so only matching
+        or aggregated rows are read. See query.py
+        modname: str - Name of the module for which to retrieve messages
+        query: Query - see query.parse_query
+        run_ids: list of str or None - only include messages from these runs
+        Yields ModuleMessage objects
+        """
+        self.flush()
+        sql, params = query.compile(modname, run_ids)
+        for row in self._iter_cursor(sql, params, chunk_size):
+            yield query.to_message(modname, row)
+
+    def _iter_cursor(self, sql, params, chunk_size):
+        """
+        Generator yielding the rows returned by a SELECT statement, fetching chunk_size rows at a time
+        """
+        cursor = self._db.cursor()
+        with self._lock:
+            cursor.execute(sql, params)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def _iter_rows(self, where, params, run_ids, chunk_size):
+        """
+        Generator yielding (row ID, ModuleMessage) for rows of the output table matching the where clause, in ID order, chunk_size rows at a time
+        where: str - SQL condition with ? placeholders
+        params: list - values for the placeholders
+        run_ids: list of str or None - only return messages from these runs
+        """
+        query = f"""SELECT "id", "modname", "time", "target", "pid", "session", "run_id", "message", "count", "last_time" FROM "output" WHERE {where}"""
+        params = list(params)
+        if run_ids is not None:
+            query += f""" AND run_id IN ({",".join("?" * len(run_ids))})"""
+            params.extend(run_ids)
+        for row_id, module, time, target, pid, session, run_id, message, count, last_time in self._iter_cursor(query + " ORDER BY id", params, chunk_size):
+            yield row_id, ModuleMessage(module,target,json.loads(message),time=time,pid=pid,session=session,run_id=run_id,count=count,last_time=last_time)
 
-    def read_messages(self, modname):
+    def read_messages(self, modname, run_ids=None):
         """
         Get a list of all messages for the given module name
         modname: str - Name of the module for which to retrieve messages
+        run_ids: list of str or None - only return messages from these runs
         Return: list of ModuleMessage objects
         """
-        self._cursor.execute("""SELECT "modname", "time", "target", "message" FROM "output" where modname= ? """,(modname,))
-        messages = []
-        for row in self._cursor.fetchall():
-            module = row[0]
-            time = row[1]
-            target = row[2]
-            data = json.loads(row[3])
-            messages.append(ModuleMessage(module,target,data,time=time))
-        return messages
+        return list(self.iter_messages(modname, run_ids))
+
+    def begin_run(self, run_id, target, args=None):
+        """
+        Record the start of a run
+        run_id: str - unique ID of the run, stored with each message written during it
+        target: str - path of the target process
+        args: str or None - arguments the target was spawned with
+        """
+        with self._lock:
+            self._cursor.execute("""INSERT OR REPLACE INTO "runs" (run_id, target, args, started) VALUES (?,?,?,?)""", (run_id, target, args, timestamp_now()))
+            self._db.commit()
+
+    def end_run(self, run_id):
+        """
+        Record the end of a run
+        run_id: str
+        """
+        self.flush()
+        with self._lock:
+            self._cursor.execute("""UPDATE "runs" SET finished = ? WHERE run_id = ?""", (timestamp_now(), run_id))
+            self._db.commit()
+
+    def get_runs(self):
+        """
+        Get all recorded runs, oldest first
+        Return: list of dicts with keys run_id, target, args, started, finished and messages. Times are microseconds since the epoch; finished is None for runs that never ended.
+        """
+        self.flush()
+        with self._lock:
+            self._cursor.execute("""SELECT runs.run_id, target, args, started, finished,
+                                    (SELECT COUNT(*) FROM output WHERE output.run_id = runs.run_id)
+                                    FROM runs ORDER BY started""")
+            rows = self._cursor.fetchall()
+        keys = ["run_id", "target", "args", "started", "finished", "messages"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get_size(self):
+        """
+        Returns the size of the database in bytes, not counting free pages
+        """
+        with self._lock:
+            page_size = self._cursor.execute("PRAGMA page_size").fetchone()[0]
+            page_count = self._cursor.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = self._cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def delete_run(self, run_id):
+        """
+        Delete a run and all of its output
+        run_id: str
+        """
+        self.flush()
+        with self._lock:
+            self._cursor.execute("""DELETE FROM "output" WHERE run_id = ?""", (run_id,))
+            self._cursor.execute("""DELETE FROM "runs" WHERE run_id = ?""", (run_id,))
+            self._db.commit()
+
+    def add_scan_targets(self, source, targets):
+        """
+        Queue targets for a scan. Targets already queued for the same scan keep their status.
+        source: str - the list file or directory the scan was started from, which identifies the scan
+        targets: list of (path, args) tuples. args is a str, empty for none.
+        """
+        with self._lock:
+            self._cursor.executemany("""INSERT OR IGNORE INTO "scan_queue" (source, target, args) VALUES (?,?,?)""",
+                [(source, target, args) for target, args in targets])
+            self._db.commit()
+
+    def requeue_interrupted_scan_targets(self, source):
+        """
+        Put targets left running by an interrupted scan back in the queue, deleting the output of their incomplete runs
+        source: str - see add_scan_targets
+        Return: number of targets requeued
+        """
+        with self._lock:
+            self._cursor.execute("""SELECT run_id FROM "scan_queue" WHERE source = ? AND status = 'running'""", (source,))
+            run_ids = [row[0] for row in self._cursor.fetchall()]
+        for run_id in run_ids:
+            self.delete_run(run_id)
+        with self._lock:
+            self._cursor.execute("""UPDATE "scan_queue" SET status = 'pending', run_id = NULL, started = NULL WHERE source = ? AND status = 'running'""", (source,))
+            self._db.commit()
+        return len(run_ids)
+
+    def claim_scan_target(self, source, run_id):
+        """
+        Take the next pending target of a scan and mark it as running
+        source: str - see add_scan_targets
+        run_id: str - ID of the run the target's output will be stored under
+        Return: dict with keys id, target and args, or None if no targets are pending
+        """
+        with self._lock:
+            row = self._cursor.execute("""SELECT id, target, args FROM "scan_queue" WHERE source = ? AND status = 'pending' ORDER BY id LIMIT 1""", (source,)).fetchone()
+            if row is None:
+                return None
+            self._cursor.execute("""UPDATE "scan_queue" SET status = 'running', run_id = ?, started = ? WHERE id = ?""", (run_id, timestamp_now(), row[0]))
+            self._db.commit()
+        return dict(zip(["id", "target", "args"], row))
+
+    def finish_scan_target(self, queue_id, status):
+        """
+        Record the outcome of a scanned target
+        queue_id: int - id returned by claim_scan_target
+        status: str - done, timed_out or failed
+        """
+        with self._lock:
+            self._cursor.execute("""UPDATE "scan_queue" SET status = ?, finished = ? WHERE id = ?""", (status, timestamp_now(), queue_id))
+            self._db.commit()
+
+    def get_scan_progress(self, source):
+        """
+        Count the targets of a scan by status
+        source: str - see add_scan_targets
+        Return: dict of status -> number of targets
+        """
+        with self._lock:
+            self._cursor.execute("""SELECT status, COUNT(*) FROM "scan_queue" WHERE source = ? GROUP BY status""", (source,))
+            return dict(self._cursor.fetchall())
+
+    def clear_scan(self, source):
+        """
+        Remove every target of a scan from the queue, so it starts over. Output from runs already completed is kept.
+        source: str - see add_scan_targets
+        """
+        with self._lock:
+            self._cursor.execute("""DELETE FROM "scan_queue" WHERE source = ?""", (source,))
+            self._db.commit()
+
+    def apply_retention(self, max_runs=None, max_age_days=None, max_bytes=None, keep=()):
+        """
+        Evict the oldest runs until the database is within all of the given limits, then return the freed pages to the filesystem.
+        max_runs: int or None - maximum number of runs to keep
+        max_age_days: float or None - runs started longer ago than this are evicted
+        max_bytes: int or None - evict runs until the database is no larger than this
+        keep: iterable of run IDs which must not be evicted, e.g. the run in progress
+        Return: list of evicted run IDs
+        """
+        all_runs = self.get_runs()
+        runs = [run for run in all_runs if run["run_id"] not in keep]
+        evicted = []
+        if max_age_days is not None:
+            cutoff = timestamp_now() - int(max_age_days * 24 * 60 * 60 * 1000000)
+            evicted.extend(run["run_id"] for run in runs if run["started"] < cutoff)
+        if max_runs is not None:
+            excess = len(all_runs) - len(evicted) - max_runs
+            remaining = [run for run in runs if run["run_id"] not in evicted]
+            evicted.extend(run["run_id"] for run in remaining[:max(excess, 0)])
+        for run_id in evicted:
+            self.delete_run(run_id)
+        if max_bytes is not None:
+            for run in runs:
+                if self.get_size() <= max_bytes:
+                    break
+                if run["run_id"] not in evicted:
+                    self.delete_run(run["run_id"])
+                    evicted.append(run["run_id"])
+        if evicted:
+            self._vacuum()
+        return evicted
+
+    def _vacuum(self):
+        """
+        Return free pages to the filesystem. Databases created before incremental vacuum was enabled are converted with a one-off full VACUUM.
+        """
+        with self._lock:
+            if self._cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2: #INCREMENTAL
+                #executescript steps the pragma to completion; execute would only free a single page
+                self._cursor.executescript("PRAGMA incremental_vacuum;")
+            else:
+                self._cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self._cursor.execute("VACUUM")
+            self._db.commit()
 
     def close(self):
+        """
+        Write any queued messages, then close the database. Non-persistent databases are deleted.
+        """
+        if self._write_behind:
+            self.flush()
+            self._stop_writer.set()
+            self._writer.join()
         self._db.close()
-        os.remove(self._dbpath)
+        if not self._persistent:
+            os.remove(self._dbpath)
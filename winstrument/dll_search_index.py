@@ -0,0 +1,137 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import os
+
+class DLLSearchIndex:
+    """
+    Case-insensitive index of the files in each directory of a DLL search path, built once from directory listings.
+    Resolving a DLL name is then a dict lookup instead of an os.path.exists call per directory, for names that are found and names that aren't.
+    The first lookup of a name missing from the index re-lists any directory modified since it was listed, so DLLs created later are still found.
+    After that the miss is cached, and is only updated when another missing name re-lists the directories.
+    Has no Windows dependencies, so the search path and KnownDLLs are supplied by the caller.
+    """
+    def __init__(self, search_dirs, known_dlls=(), known_dlls_dir=None):
+        """
+        search_dirs - list of directory paths, in search order. Later duplicates of a directory are ignored.
+        known_dlls - iterable of DLL names from the KnownDLLs registry key. These bypass the search order.
+        known_dlls_dir - str, directory KnownDLLs are loaded from, normally the system directory
+        """
+        self._search_dirs = []
+        seen = set()
+        for dirpath in search_dirs:
+            key = os.path.normcase(os.path.normpath(dirpath))
+            if key not in seen:
+                seen.add(key)
+                self._search_dirs.append(dirpath)
+        self._known_dlls = {name.lower() for name in known_dlls}
+        self._known_dlls_dir = known_dlls_dir
+        #lowercase file name -> indexes into _search_dirs of every directory containing it, in search order. Empty for names looked up and not found.
+        self._locations = {}
+        #the same for names with a relative directory component, which are checked on disk instead
+        self._relative_locations = {}
+        #index into _search_dirs -> modification time of the directory when it was listed, or None if it couldn't be read
+        self._mtimes = {}
+        for index in range(len(self._search_dirs)):
+            self._list_dir(index, self._get_mtime(index))
+
+    def _get_mtime(self, index):
+        try:
+            return os.stat(self._search_dirs[index]).st_mtime_ns
+        except OSError: #missing or unreadable directories on PATH are common
+            return None
+
+    def _list_dir(self, index, mtime):
+        """
+        Add the files in a search directory to the index
+        index - int, index into _search_dirs
+        mtime - int or None, modification time of the directory as returned by _get_mtime
+        """
+        self._mtimes[index] = mtime
+        if mtime is None:
+            return
+        try:
+            entries = os.listdir(self._search_dirs[index])
+        except OSError:
+            self._mtimes[index] = None
+            return
+        for entry in entries:
+            bisect.insort(self._locations.setdefault(entry.lower(), []), index)
+
+    def _refresh(self):
+        """
+        List again every search directory whose modification time changed since it was last listed
+        """
+        for index in range(len(self._search_dirs)):
+            mtime = self._get_mtime(index)
+            if mtime == self._mtimes.get(index):
+                continue
+            for locations in self._locations.values():
+                if index in locations:
+                    locations.remove(index)
+            self._list_dir(index, mtime)
+
+    def get_search_dirs(self):
+        """
+        Returns the deduplicated list of directories in search order
+        """
+        return self._search_dirs.copy()
+
+    def is_known_dll(self, dllname):
+        """
+        Returns True if dllname is listed in KnownDLLs
+        """
+        return dllname.lower() in self._known_dlls
+
+    def _find(self, dllname):
+        """
+        Returns the indexes of the search directories containing dllname, in search order
+        """
+        key = dllname.lower()
+        if os.path.basename(dllname) != dllname:
+            #names with a relative directory component aren't in the listings, so check each directory once
+            found = self._relative_locations.get(key)
+            if found is None:
+                found = [index for index, dirpath in enumerate(self._search_dirs) if os.path.exists(os.path.join(dirpath, dllname))]
+                self._relative_locations[key] = found
+            return found
+        found = self._locations.get(key)
+        if found is not None:
+            return found
+        self._refresh()
+        #cached when still missing, so later lookups of the name don't touch the disk
+        return self._locations.setdefault(key, [])
+
+    def resolve(self, dllname):
+        """
+        Returns the directory the loader would load dllname from, or None if no directory on the search path contains it
+        dllname - str, file name as passed to LoadLibrary
+        """
+        if self.is_known_dll(dllname):
+            return self._known_dlls_dir
+        found = self._find(dllname)
+        return self._search_dirs[found[0]] if found else None
+
+    def searched_dirs(self, dllname):
+        """
+        Returns the directories the loader searches for dllname, up to and including the one it resolves to.
+        A DLL planted in any of these directories would be loaded instead. Empty for KnownDLLs.
+        dllname - str
+        """
+        if self.is_known_dll(dllname):
+            return []
+        found = self._find(dllname)
+        last = found[0] + 1 if found else len(self._search_dirs)
+        return self._search_dirs[:last]
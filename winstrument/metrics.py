@@ -0,0 +1,228 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import ctypes
+import os
+import sys
+import threading
+
+class Histogram:
+    """
+    Distribution of non-negative integer samples, such as latencies in microseconds, in constant memory.
+    Samples are counted in buckets a quarter of a power of two wide, so reported percentiles are within about 20% of the true value.
+    """
+    def __init__(self):
+        self._buckets = {} #bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def _bucket(value):
+        if value < 4:
+            return value
+        shift = value.bit_length() - 3
+        return (shift << 2) + (value >> shift)
+
+    @staticmethod
+    def _bucket_upper(index):
+        if index < 4:
+            return index
+        shift = (index >> 2) - 1
+        return (((index & 3) | 4) + 1 << shift) - 1
+
+    def record(self, value):
+        """
+        value - int >= 0
+        """
+        value = max(int(value), 0)
+        index = self._bucket(value)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Returns an upper bound for the given fraction (0-1) of samples, or None if there are no samples
+        """
+        if self.count == 0:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= target:
+                return min(self._bucket_upper(index), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "min": self.min, "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5), "p95": self.percentile(0.95), "p99": self.percentile(0.99)}
+
+class MetricsRegistry:
+    """
+    Thread-safe collection of counters, gauges and histograms, grouped by scope (a module name, or "db").
+    Updates are cheap enough to make on every message.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scopes = {} #scope -> {name -> int counter, Histogram, or [current, max] gauge}
+        self._hooks = {} #module name -> {hook name -> totals}, see add_hook_profiles
+
+    def _get(self, scope, name, factory):
+        metrics = self._scopes.setdefault(scope, {})
+        metric = metrics.get(name)
+        if metric is None:
+            metric = metrics[name] = factory()
+        return metric
+
+    def increment(self, scope, name, amount=1):
+        """
+        Add amount to a counter
+        """
+        with self._lock:
+            metrics = self._scopes.setdefault(scope, {})
+            metrics[name] = metrics.get(name, 0) + amount
+
+    def observe(self, scope, name, value):
+        """
+        Record a sample in a histogram
+        value - int >= 0, e.g. a latency in microseconds
+        """
+        with self._lock:
+            self._get(scope, name, Histogram).record(value)
+
+    def set_gauge(self, scope, name, value):
+        """
+        Set the current value of a gauge, such as a queue depth. The maximum value seen is kept too.
+        """
+        with self._lock:
+            gauge = self._get(scope, name, lambda: [0, 0])
+            gauge[0] = value
+            gauge[1] = max(gauge[1], value)
+
+    def add_hook_profiles(self, modulename, hooks):
+        """
+        Add hook timings reported by the in-target profiler (js/lib/profiler.js) for a module
+        modulename - str
+        hooks - dict of hook name -> {"calls", "enter_us", "leave_us", "max_us"}
+        """
+        with self._lock:
+            module_hooks = self._hooks.setdefault(modulename, {})
+            for hook, totals in hooks.items():
+                merge_hook_profile(module_hooks.setdefault(hook, {"calls": 0, "enter_us": 0, "leave_us": 0, "max_us": 0}), totals)
+
+    def reset(self):
+        with self._lock:
+            self._scopes = {}
+            self._hooks = {}
+
+    def snapshot(self):
+        """
+        Returns a JSON serializable dict of every metric: {"scopes": {scope: {name: value}}, "hooks": {module: {hook: totals}}, "rss_bytes": int or None}
+        Counters are ints, histograms dicts (see Histogram.to_dict) and gauges {"current": int, "max": int}
+        """
+        with self._lock:
+            scopes = {}
+            for scope, metrics in self._scopes.items():
+                values = {}
+                for name, metric in metrics.items():
+                    if isinstance(metric, Histogram):
+                        values[name] = metric.to_dict()
+                    elif isinstance(metric, list):
+                        values[name] = {"current": metric[0], "max": metric[1]}
+                    else:
+                        values[name] = metric
+                scopes[scope] = values
+            hooks = {modulename: {hook: totals.copy() for hook, totals in module_hooks.items()} for modulename, module_hooks in self._hooks.items()}
+        return {"scopes": scopes, "hooks": hooks, "rss_bytes": get_rss()}
+
+def merge_hook_profile(merged, totals):
+    """
+    Add one report of a hook's totals from js/lib/profiler.js into merged, in place
+    """
+    for key in ("calls", "enter_us", "leave_us"):
+        merged[key] += totals.get(key, 0)
+    merged["max_us"] = max(merged["max_us"], totals.get("max_us", 0))
+
+def get_rss():
+    """
+    Returns the resident set size of this process in bytes, or None if it can't be determined on this platform
+    """
+    if sys.platform == "win32":
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+        psapi = ctypes.windll.psapi
+        psapi.GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), ctypes.c_ulong]
+        if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def format_stats(snapshot):
+    """
+    Format a MetricsRegistry snapshot as human readable tables: one row per scope, then one row per profiled hook, most expensive first
+    snapshot - dict, see MetricsRegistry.snapshot
+    Returns str
+    """
+    from tabulate import tabulate #imported on first use, to keep startup fast
+    def histogram_field(metrics, name, field):
+        histogram = metrics.get(name)
+        return histogram[field] if histogram else ""
+
+    rows = []
+    for scope, metrics in sorted(snapshot["scopes"].items()):
+        queue_depth = metrics.get("queue_depth")
+        payload_bytes = metrics.get("payload_bytes")
+        rows.append([scope, metrics.get("messages", ""), metrics.get("events", ""),
+            round(payload_bytes / 1024, 1) if payload_bytes is not None else "",
+            histogram_field(metrics, "handler_us", "p50"), histogram_field(metrics, "handler_us", "p99"), histogram_field(metrics, "handler_us", "max"),
+            metrics.get("rows_written", ""),
+            histogram_field(metrics, "write_us", "p50"), histogram_field(metrics, "write_us", "p99"), histogram_field(metrics, "write_us", "max"),
+            queue_depth["max"] if queue_depth else ""])
+    tables = []
+    if rows:
+        tables.append(tabulate(rows, headers=["scope", "messages", "events", "payload KB", "handler p50 us", "handler p99 us", "handler max us",
+            "rows written", "write p50 us", "write p99 us", "write max us", "max queue"]))
+    hook_rows = []
+    for modulename, hooks in snapshot.get("hooks", {}).items():
+        for hook, totals in hooks.items():
+            total_us = totals["enter_us"] + totals["leave_us"]
+            hook_rows.append([modulename, hook, totals["calls"], round(total_us / 1000, 1),
+                round(total_us / totals["calls"], 1) if totals["calls"] else "", totals["max_us"]])
+    if hook_rows:
+        #most expensive hooks first
+        hook_rows.sort(key=lambda row: row[3], reverse=True)
+        tables.append(tabulate(hook_rows, headers=["module", "hook", "calls", "total ms", "mean us", "max us"]))
+    rss = snapshot.get("rss_bytes")
+    tables.append(f"Host RSS: {rss / (1024 * 1024):.1f} MB" if rss is not None else "Host RSS: unknown")
+    return "\n\n".join(tables)
@@ -16,6 +16,7 @@
 from winstrument.base_module import BaseInstrumentation
 class ComHijack(BaseInstrumentation):
     modulename = "com_hijack"
+    dedup_output = True
     def __init__(self,*args,**kwargs):
         self._output = []
         super().__init__(*args,**kwargs)
@@ -27,6 +28,3 @@ class ComHijack(BaseInstrumentation):
         elif message["type"] == "send":
             payload = message["payload"]
             self.write_message(payload)
-
-    def get_output(self):
-        return self._output
\ No newline at end of file
@@ -22,17 +22,34 @@ import pywintypes
 import collections
 import os
 import uuid
+import functools
 from winstrument.base_module import BaseInstrumentation
+from winstrument.utils import TTLCache
+from winstrument.dll_search_index import DLLSearchIndex
+
+@functools.lru_cache(maxsize=None)
+def _get_current_user():
+    """
+    DOMAIN\\user name of the account running winstrument. Doesn't change during the process lifetime, so it is only looked up once.
+    """
+    return f"{win32api.GetDomainName()}\\{win32api.GetUserName()}"
 
 class DLLs(BaseInstrumentation):
 
     modulename="dlls"
+    use_executor = True #ACL and account lookups are slow
+    #writeability verdicts are shared by every DLLs instance in a run, since child processes search mostly the same directories
+    WRITEABLE_CACHE_SIZE = 1024
+    WRITEABLE_CACHE_TTL = 300 #seconds, so ACL changes made during a long run are eventually noticed
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._dll_paths = []
         self._loaded_dlls = set()
         self._known_dlls = None
+        self._search_index = None
         self._dll_perms = {}
+        self._writeable_cache = self._shared.setdefault("dlls.writeable", TTLCache(self.WRITEABLE_CACHE_SIZE, self.WRITEABLE_CACHE_TTL))
+        self._principal_cache = self._shared.setdefault("dlls.principals", TTLCache(self.WRITEABLE_CACHE_SIZE, self.WRITEABLE_CACHE_TTL))
 
     def _parse_ace_entry(self, ace):
 #        ace_types = {win32security.ACCESS_ALLOWED_ACE_TYPE: "ACCESS_ALOWED_ACE",
@@ -60,19 +77,33 @@ class DLLs(BaseInstrumentation):
             flag_const = getattr(win32security,flag)
             if ace_flags & flag_const == flag_const:
                 flags.add(flag)
+        flagstr = ','.join([flag for flag in flags]) if len(flags) != 0 else 'N/A'
+        perms = ",".join([perm for perm in permlist]) if len(permlist) != 0 else 'NONE'
+        principal = self._lookup_principal(sid)
+        AceEntry = collections.namedtuple("AceEntry", "sid principalname perms flags")
+        return AceEntry(sid=sid,principalname=principal,perms=perms,flags=flagstr)
+
+    def _lookup_principal(self, sid):
+        """
+        Returns the DOMAIN\\name of the account with the given SID, or the SID string if it can't be resolved.
+        Results are cached, since the same few SIDs appear in the ACL of almost every directory.
+        sid - PySID
+        """
+        key = str(sid)
+        principal = self._principal_cache.get(key)
+        if principal is not None:
+            return principal
         try:
             name,domain, _ = win32security.LookupAccountSid(None,sid)
         except pywintypes.error:
             name = None
             domain = None
-        flagstr = ','.join([flag for flag in flags]) if len(flags) != 0 else 'N/A'
-        perms = ",".join([perm for perm in permlist]) if len(permlist) != 0 else 'NONE'
         if name and domain:
             principal = f"{domain}\\{name}"
         else:
-            principal = str(sid)
-        AceEntry = collections.namedtuple("AceEntry", "sid principalname perms flags")
-        return AceEntry(sid=sid,principalname=principal,perms=perms,flags=flagstr)
+            principal = key
+        self._principal_cache.set(key, principal)
+        return principal
 
     def _get_users_with_write_perms(self,filepath):
         users = set()
@@ -137,37 +168,44 @@ class DLLs(BaseInstrumentation):
         dirs.extend(pathdirs)
         return dirs
 
+    def _get_search_index(self):
+        """
+        Returns the DLLSearchIndex for this process, building it from the search path and KnownDLLs on first use
+        """
+        if self._search_index is None:
+            if not self._known_dlls:
+                self._known_dlls = self._get_known_dlls()
+            self._search_index = DLLSearchIndex(self._get_dll_search_path(), self._known_dlls, win32api.GetSystemDirectory())
+        return self._search_index
+
     def _resolve_relative_dll_path(self, dllpath):
         #ignore any duplicate loads
         if not dllpath.lower().endswith(".dll"):
             dllpath = dllpath + ".dll"
         if dllpath.lower() in self._loaded_dlls:
             return
-        searched = []
-        if not self._known_dlls:
-            self._known_dlls = self._get_known_dlls()
-        if dllpath.lower() in self._known_dlls:
-            dll_abspath = os.path.join(win32api.GetSystemDirectory(),dllpath) #known dlls should be here
-            self._loaded_dlls.add(dllpath.lower())
-            found = True
-            return
-        dirs = self._get_dll_search_path()
-        found = False
-        for dirpath in dirs:
-            if found:
-                break
-            dll_abspath = os.path.join(dirpath,dllpath)
-            searched.append(dirpath)
-            if os.path.exists(dll_abspath):
-                self._loaded_dlls.add(dllpath.lower())
-                found = True
-
-        for path in searched:
+        #DLLs that don't resolve are only reported once as well
+        self._loaded_dlls.add(dllpath.lower())
+        #empty for KnownDLLs
+        for path in self._get_search_index().searched_dirs(dllpath):
             if self._is_path_writeable(path):
                 data = {"dll": dllpath, "writeable_path": path }
                 self.write_message(data)
     def _is_path_writeable(self, path):
-        current_user = f"{win32api.GetDomainName()}\\{win32api.GetUserName()}"
+        """
+        Returns True if the current user or a low privileged group can write to path.
+        Verdicts are cached per normalized path and shared across the run.
+        path - str
+        """
+        key = os.path.normcase(os.path.normpath(path))
+        writeable = self._writeable_cache.get(key)
+        if writeable is None:
+            writeable = self._check_path_writeable(path)
+            self._writeable_cache.set(key, writeable)
+        return writeable
+
+    def _check_path_writeable(self, path):
+        current_user = _get_current_user()
         auth_users = "NT AUTHORITY\\Authenticated Users"
         all_users = "BUILTIN\\USERS"
         write_users = self._get_users_with_write_perms(path)
@@ -12,18 +12,24 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-
+import collections
 import frida
 import sys
 from winstrument.base_module import BaseInstrumentation
 
 class FileRW(BaseInstrumentation):
     modulename = "file_rw"
+    #Default for the max_handles setting: the most open handles tracked at once. The agent enforces it, releasing the least recently used
+    #handle with an EvictHandle event, so the host's tables stay within it as well.
+    max_handles = 4096
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args,**kwargs)
         self._file_handles = {}
-        self.files_read = {}
-        self.files_written = {}
+        #open handles -> record for the file, least recently used first. Records are written out and removed when the handle is closed.
+        self.files_read = collections.OrderedDict()
+        self.files_written = collections.OrderedDict()
+        self._max_handles = self.get_setting_int("max_handles", self.max_handles)
 
 
         self.modes = {
@@ -43,57 +49,100 @@ class FileRW(BaseInstrumentation):
         if message["type"] == "error":
             print("Error: {0}".format(message))
             return
-        date=None
         payload = message["payload"]
 
         function = payload["function"]
-        if function == "CreateFileW":
+        if function == "CreateFileW" or function == "CreateFileA":
             modenum = payload["mode"]
             modename = self. modes.get(payload["mode"], modenum)
             fh = payload["fh"]
-            if fh == 0xffffffff: #INVALID HANDLE
-                fh = "INVALID_HANDLE_VALUE"
-            if modename == "GENERIC_READ":
-                if not fh in self.files_read: 
-                  data = {"function": function, "fh": fh, "path": payload["path"], "mode": modename}
-                  self.files_read[fh] = data
-            elif modename == "GENERIC_WRITE":
-                if not fh in self.files_written:
-                  data = {"function": function, "fh": fh, "path": payload["path"], "mode": modename}
-                  self.files_written[fh] = data
-            else: #both
-                if not fh in self.files_read: 
-                  data = {"function": function, "fh": fh, "path": payload["path"], "mode": modename}
-                  self.files_read[fh] = data
-                if not fh in self.files_written:
-                  data = {"function": function, "fh": fh, "path": payload["path"], "mode": modename}
-                  self.files_written[fh] = data
-        elif function == "WriteFile":
-            fh = payload["fh"]
-            numbytes = payload["bytes_written"]
-            if fh in self.files_written:
-                prevbytes = self.files_written[fh].get("bytes",0)
-                self.files_written[fh]["function"] = function
-                self.files_written[fh]["bytes"] = prevbytes + numbytes
-              #  path = self.files_written[fh]["path"]
-              #  data = {"function": function, "fh": fh, "path": path, "bytes": numbytes}
-   
-        elif function == "ReadFile" or function == "ReadFileEx":
-            fh = payload["fh"]
-            numbytes = payload.get("bytes_read",payload["bytes_to_read"]) #no bytes_read for ReadFileEx
-            if fh in self.files_read:
-               prevbytes= self.files_read[fh].get("bytes",0)
-               self.files_read[fh]["function"] = function
-               self.files_read[fh]["bytes"] = prevbytes + numbytes
-               # path = self._file_handles[fh]["path"]
-               # data = {"function" : function, "fh": fh, "path":path, "bytes":numbytes}
-        # 
-      #  if data:
-          #  self.write_message(data)
+            if int(fh, 16) in (0xffffffff, 0xffffffffffffffff): #INVALID_HANDLE_VALUE, never read or written
+                return
+            #a handle value still in the tables belongs to a file whose close wasn't seen, so finish that file before reusing it
+            self._close_handle(fh)
+            if modename != "GENERIC_WRITE":
+                self._track_handle(self.files_read, fh, {"function": function, "fh": fh, "path": payload["path"], "mode": modename})
+            if modename != "GENERIC_READ":
+                self._track_handle(self.files_written, fh, {"function": function, "fh": fh, "path": payload["path"], "mode": modename})
+        elif function == "summary":
+            #byte counts accumulated in the target since the last summary, keyed by file handle
+            for fh, counts in payload["handles"].items():
+                self._add_counts(fh, counts)
+        elif function == "handle_summary": #the same counts for a single handle, sent as a binary record
+            self._add_counts(payload["fh"], payload)
+        elif function == "CloseHandle" or function == "EvictHandle": #with the counts since the last summary
+            self._add_counts(payload["fh"], payload)
+            self._close_handle(payload["fh"])
+
+    def get_agent_config(self):
+        config = super().get_agent_config()
+        config["max_handles"] = self._max_handles
+        return config
+
+    def _track_handle(self, table, fh, record):
+        """
+        Start tracking a newly opened handle in files_read or files_written.
+        The agent releases handles before the limit is reached, so the eviction here is only a safeguard against lost release events.
+        """
+        table[fh] = record
+        while len(table) > self._max_handles:
+            _, evicted = table.popitem(last=False)
+            self._write_record(evicted)
+
+    def _close_handle(self, fh):
+        """
+        Write out the records for a handle and stop tracking it
+        fh - str, file handle
+        """
+        for table in (self.files_read, self.files_written):
+            record = table.pop(fh, None)
+            if record is not None:
+                self._write_record(record)
+
+    def _write_record(self, record):
+        """
+        Write a file's record to the database, if anything was read or written
+        """
+        if record.get("bytes",0) > 0:
+            self.write_message(record)
+
+    def _add_counts(self, fh, counts):
+        """
+        Merge the byte counts reported by the agent for a file handle into its records
+        fh - str, file handle
+        counts - dict with read, written, read_function and written_function keys
+        """
+        if counts["read"] > 0 and fh in self.files_read:
+            self._add_bytes(self.files_read[fh], counts["read_function"], counts["read"])
+            self.files_read.move_to_end(fh)
+        if counts["written"] > 0 and fh in self.files_written:
+            self._add_bytes(self.files_written[fh], counts["written_function"], counts["written"])
+            self.files_written.move_to_end(fh)
+
+    def _add_bytes(self, record, function, numbytes):
+        """
+        Merge a byte count reported by the agent into the record for a file handle
+        record - dict stored in files_read or files_written
+        function - str, name of the last function that read or wrote the handle
+        numbytes - int
+        """
+        record["function"] = function
+        record["bytes"] = record.get("bytes",0) + numbytes
+
+    def on_flush(self):
+        #write the bytes counted so far for files still open, so their rows show up while the target runs. Each row holds the bytes since the previous one,
+        #and is marked partial; the row written when the file is closed holds the rest.
+        for table in (self.files_read, self.files_written):
+            for record in table.values():
+                if record.get("bytes",0) > 0:
+                    self.write_message(dict(record, partial=True))
+                    record["bytes"] = 0
+
     def on_finish(self):
-        for fh in self.files_read.values():
-            if fh.get("bytes",0) > 0:
-                self.write_message(fh)
-        for fh in self.files_written.values():
-            if fh.get("bytes",0) > 0:
-                self.write_message(fh)
\ No newline at end of file
+        #files still open when the process exited
+        for record in self.files_read.values():
+            self._write_record(record)
+        for record in self.files_written.values():
+            self._write_record(record)
+        self.files_read.clear()
+        self.files_written.clear()
@@ -17,6 +17,7 @@ import win32security
 
 class Impersonate(BaseInstrumentation):
     modulename = "impersonate"
+    use_executor = True #token and account lookups are slow
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -25,7 +26,7 @@ class Impersonate(BaseInstrumentation):
             print(message)
         else:
             payload = message["payload"]
-            token = message["token"]
+            token = payload["token"]
             sid = win32security.GetTokenInformation(token, win32security.TokenUser)[0]
             name,domain, _ = win32security.LookupAccountSid(None,sid)
             user = f"{domain}\\{name}"
@@ -19,7 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
     Interceptor.attach(Module.getExportByName('kernel32.dll', name), {
         onEnter: function (args) {
             var lib_filename = args[0].readUtf16String();
-            send({ "function": name, "lib_filename": lib_filename });
+            emit({ "function": name, "lib_filename": lib_filename });
 
         }
 
@@ -31,7 +31,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
     Interceptor.attach(Module.getExportByName('kernel32.dll', name), {
         onEnter: function (args) {
             var lib_filename = args[0].readAnsiString();
-            send({ "function": name, "lib_filename": lib_filename });
+            emit({ "function": name, "lib_filename": lib_filename });
 
         }
 
@@ -14,58 +14,137 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
-Interceptor.attach(Module.getExportByName('kernel32.dll', 'WriteFile'), {
-    onEnter: function (args) {
-        var data = {
-            function: "WriteFile",
-            fh: args[0].toString(),
-            bytes_to_write: args[2].toInt32(),
-            bytes_written_ptr: args[3]
+//Byte counts are accumulated here per file handle and reported to the host as periodic summaries,
+//instead of sending a message for every ReadFile/WriteFile call.
+var SUMMARY_INTERVAL_MS = 1000;
+
+//Most handles tracked at once, from the file_rw.max_handles setting. Beyond this the least recently used handle is released.
+var MAX_HANDLES = AGENT_CONFIG["max_handles"] || 4096;
+
+//handles returned by CreateFile, keyed by handle string, least recently used first
+var trackedHandles = {};
+var trackedCount = 0;
+//bytes read/written per handle since the last summary
+var handleCounts = {};
+
+defineRecord("handle_summary", [["fh", "str"], ["read", "int"], ["written", "int"], ["read_function", "str"], ["written_function", "str"]]);
+
+function countBytes(fh, direction, functionName, numBytes) {
+    if (!(fh in trackedHandles)) {
+        return;
+    }
+    var counts = handleCounts[fh];
+    if (counts === undefined) {
+        counts = { "read": 0, "written": 0 };
+        handleCounts[fh] = counts;
+    }
+    counts[direction] += numBytes;
+    counts[direction + "_function"] = functionName;
+}
+
+function reportCounts() {
+    var handles = handleCounts;
+    if (Object.keys(handles).length === 0) {
+        return;
+    }
+    handleCounts = {};
+    for (var active in handles) {
+        //move handles with activity to the end, so eviction picks idle ones. Done once per summary rather than on every read/write.
+        if (active in trackedHandles) {
+            delete trackedHandles[active];
+            trackedHandles[active] = true;
+        }
+    }
+    if (binaryRecords) {
+        //one fixed-size record per handle, see lib/records.js
+        for (var fh in handles) {
+            handles[fh]["fh"] = fh;
+            emitRecord("handle_summary", handles[fh]);
+        }
+    }
+    else {
+        emitUnsampled({ "function": "summary", "handles": handles });
+    }
+}
+
+setInterval(reportCounts, SUMMARY_INTERVAL_MS);
+onUnload(reportCounts);
+
+//Stop tracking a handle and tell the host, with the counts not yet reported, so it can write the file's record and forget the handle.
+//reason is CloseHandle when the target closed it, or EvictHandle when it was dropped to stay within MAX_HANDLES.
+function releaseHandle(fh, reason) {
+    if (binaryRecords) {
+        //earlier counts for the handle may still be buffered as records, and must arrive first
+        flushRecords();
+    }
+    var counts = handleCounts[fh] || { "read": 0, "written": 0 };
+    delete handleCounts[fh];
+    delete trackedHandles[fh];
+    trackedCount--;
+    emitUnsampled({ "function": reason, "fh": fh, "read": counts["read"], "written": counts["written"],
+        "read_function": counts["read_function"], "written_function": counts["written_function"] });
+}
+
+//Start tracking a handle returned by CreateFile. Call before sending the open event, so the host sees any release first.
+function trackHandle(fh) {
+    if (fh in trackedHandles) {
+        //the handle value was reused without its close being seen, so finish the previous file
+        releaseHandle(fh, "CloseHandle");
+    }
+    else if (trackedCount >= MAX_HANDLES) {
+        for (var oldest in trackedHandles) {
+            releaseHandle(oldest, "EvictHandle");
+            break;
+        }
+    }
+    trackedHandles[fh] = true;
+    trackedCount++;
+}
 
+Interceptor.attach(Module.getExportByName('kernel32.dll', 'CloseHandle'), {
+    //called for every kind of handle, so only do work for files opened with CreateFile
+    onEnter: function (args) {
+        var fh = args[0].toString();
+        if (fh in trackedHandles) {
+            releaseHandle(fh, "CloseHandle");
         }
-        this.data = data
+    }
+});
+
+Interceptor.attach(Module.getExportByName('kernel32.dll', 'WriteFile'), {
+    onEnter: function (args) {
+        this.fh = args[0].toString();
+        this.bytesToWrite = args[2].toInt32();
+        this.bytesWrittenPtr = args[3];
     },
     onLeave: function (ret) {
-        if (this.data["bytes_written_ptr"].toInt32() !== 0) {
-            this.data["bytes_written"] = this.data["bytes_written_ptr"].readU32()
+        var bytesWritten = this.bytesToWrite;
+        if (!this.bytesWrittenPtr.isNull()) {
+            bytesWritten = this.bytesWrittenPtr.readU32();
         }
-        else {
-            this.data["bytes_written"] = this.data["bytes_to_write"]
-        }
-        send(this.data)
+        countBytes(this.fh, "written", "WriteFile", bytesWritten);
     }
 });
 
 Interceptor.attach(Module.getExportByName('kernel32.dll', 'ReadFile'), {
     onEnter: function (args) {
-        var data = {
-            function: "ReadFile",
-            fh: args[0].toString(),
-            bytes_to_read: args[2].toInt32(),
-            bytes_read_ptr: args[3]
-        }
-        this.data = data;
+        this.fh = args[0].toString();
+        this.bytesToRead = args[2].toInt32();
+        this.bytesReadPtr = args[3];
     },
     onLeave: function (ret) {
-        if (this.data["bytes_read_ptr"].toInt32() !== 0) {
-
-            this.data["bytes_read"] = this.data["bytes_read_ptr"].readU32();
+        var bytesRead = this.bytesToRead;
+        if (!this.bytesReadPtr.isNull()) {
+            bytesRead = this.bytesReadPtr.readU32();
         }
-        else {
-            this.data["bytes_read"] = this.data["bytes_to_read"]
-        }
-        send(this.data);
+        countBytes(this.fh, "read", "ReadFile", bytesRead);
     }
 
 });
 Interceptor.attach(Module.getExportByName('kernel32.dll', 'ReadFileEx'), {
     onEnter: function (args) {
-        var data = {
-            function: "ReadFileEx",
-            fh: args[0].toString(),
-            bytes_to_read: args[2].toInt32()
-        }
-        send(data)
+        //asynchronous, so the requested size is the best available count
+        countBytes(args[0].toString(), "read", "ReadFileEx", args[2].toInt32());
     }
 });
 Interceptor.attach(Module.getExportByName('kernel32.dll', 'CreateFileW'), { //Unicode Version, need to handle encoding differently for ansi one, but otherwise identical
@@ -81,8 +160,14 @@ Interceptor.attach(Module.getExportByName('kernel32.dll', 'CreateFileW'), { //Un
             "mode": this.mode,
             "fh": ret.toString()
         }
-
-        send(data)
+        if (ret.toInt32() !== -1) { //INVALID_HANDLE_VALUE
+            trackHandle(data["fh"]);
+            //never sampled: the host needs the open event to attribute the handle's byte counts
+            emitUnsampled(data);
+        }
+        else {
+            emit(data);
+        }
     }
 });
 Interceptor.attach(Module.getExportByName('kernel32.dll', 'CreateFileA'), { //ANSI Version
@@ -98,7 +183,13 @@ Interceptor.attach(Module.getExportByName('kernel32.dll', 'CreateFileA'), { //AN
             "mode": this.mode,
             "fh": ret.toString()
         }
-
-        send(data)
+        if (ret.toInt32() !== -1) { //INVALID_HANDLE_VALUE
+            trackHandle(data["fh"]);
+            //never sampled: the host needs the open event to attribute the handle's byte counts
+            emitUnsampled(data);
+        }
+        else {
+            emit(data);
+        }
     }
 });
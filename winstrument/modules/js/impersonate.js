@@ -17,7 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Interceptor.attach(Module.getExportByName("advapi32.dll", "ImpersonateLoggedOnUser"), {
     onEnter: function (args) {
         this.token = args[0].readInt();
-        send({ "function": "ImpersonateLoggedOnUser", "token": this.token });
+        emit({ "function": "ImpersonateLoggedOnUser", "token": this.token });
     }
 
 });
\ No newline at end of file
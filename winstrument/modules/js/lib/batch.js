@@ -0,0 +1,93 @@
+/*
+Copyright (C) 2019  NCC Group
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+//Agent-side event batching shared by every module script. Module code calls emit() instead of send().
+//emit() may be wrapped by later libraries, e.g. sampling.js. Aggregates that must always reach the host,
+//such as periodic summaries, should use emitUnsampled() instead.
+//Events are buffered and sent to the host as a single {"batch": [...], "times": [...]} payload once a count or size
+//threshold is reached, after a short delay, or when the script is unloaded.
+//times[i] is when batch[i] was emitted, in integer microseconds since the epoch (see epochMicros in clock.js),
+//so events are timestamped at hook time rather than when the host receives them.
+var BATCH_MAX_EVENTS = 256;
+var BATCH_MAX_BYTES = 64 * 1024;
+var BATCH_FLUSH_MS = 50;
+
+var _batch = [];
+var _batchTimes = [];
+var _batchBytes = 0;
+var _batchTimer = null;
+
+//Rough serialized size of an event, without paying for JSON.stringify on every call
+function _estimateSize(event) {
+    var size = 2;
+    for (var key in event) {
+        var value = event[key];
+        size += key.length + 4;
+        size += (typeof value === "string") ? value.length : 8;
+    }
+    return size;
+}
+
+function flush() {
+    if (_batchTimer !== null) {
+        clearTimeout(_batchTimer);
+        _batchTimer = null;
+    }
+    if (_batch.length === 0) {
+        return;
+    }
+    var events = _batch;
+    var times = _batchTimes;
+    _batch = [];
+    _batchTimes = [];
+    _batchBytes = 0;
+    send({ "batch": events, "times": times });
+}
+
+function emitUnsampled(event) {
+    _batch.push(event);
+    _batchTimes.push(epochMicros());
+    _batchBytes += _estimateSize(event) + 16;
+    if (_batch.length >= BATCH_MAX_EVENTS || _batchBytes >= BATCH_MAX_BYTES) {
+        flush();
+    }
+    else if (_batchTimer === null) {
+        _batchTimer = setTimeout(flush, BATCH_FLUSH_MS);
+    }
+}
+
+var emit = emitUnsampled;
+
+var _unloadHandlers = [];
+
+//Register a function to run when the script is unloaded, before the final flush.
+//Use it to emit any state the module is still aggregating.
+function onUnload(handler) {
+    _unloadHandlers.push(handler);
+}
+
+//rpc.exports.dispose is called by Frida when the script is unloaded, including when the target exits
+var _previousDispose = rpc.exports.dispose;
+rpc.exports.dispose = function () {
+    _unloadHandlers.forEach(function (handler) {
+        handler();
+    });
+    flush();
+    if (_previousDispose) {
+        _previousDispose();
+    }
+};
@@ -0,0 +1,59 @@
+/*
+Copyright (C) 2019  NCC Group
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+//Monotonic clock with microsecond resolution for timing inside the target.
+//Uses QueryPerformanceCounter where it can be found, otherwise falls back to Date.now() with millisecond resolution.
+var _qpc = null;
+var _qpcBuffer = null;
+var _qpcTicksPerMicro = 0;
+
+(function () {
+    try {
+        var counter = Module.findExportByName("kernel32.dll", "QueryPerformanceCounter");
+        var frequency = Module.findExportByName("kernel32.dll", "QueryPerformanceFrequency");
+        if (counter === null || frequency === null) {
+            return;
+        }
+        _qpcBuffer = Memory.alloc(8);
+        new NativeFunction(frequency, "int", ["pointer"])(_qpcBuffer);
+        _qpcTicksPerMicro = _qpcBuffer.readU64().toNumber() / 1000000;
+        if (_qpcTicksPerMicro > 0) {
+            _qpc = new NativeFunction(counter, "int", ["pointer"]);
+        }
+    }
+    catch (e) {
+        _qpc = null;
+    }
+})();
+
+//Microseconds since an arbitrary fixed point. Only differences between two readings are meaningful.
+function clockMicros() {
+    if (_qpc === null) {
+        return Date.now() * 1000;
+    }
+    _qpc(_qpcBuffer);
+    return _qpcBuffer.readU64().toNumber() / _qpcTicksPerMicro;
+}
+
+//Offset from clockMicros() to microseconds since the Unix epoch, fixed when the script loads
+var _epochOffsetMicros = Date.now() * 1000 - clockMicros();
+
+//Microseconds since the Unix epoch as an integer, the format timestamps are stored in on the host.
+//Advances with clockMicros(), so it is monotonic and has its resolution, unlike Date.now().
+function epochMicros() {
+    return Math.round(_epochOffsetMicros + clockMicros());
+}
@@ -0,0 +1,113 @@
+/*
+Copyright (C) 2019  NCC Group
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+//Opt-in hook profiler, enabled by AGENT_CONFIG["profile"].
+//Wraps the onEnter/onLeave callbacks passed to Interceptor.attach to count calls and time spent in each hooked function's callbacks,
+//and reports the totals to the host as {"__control__": "profile", "hooks": {name: {calls, enter_us, leave_us, max_us}}}
+//every PROFILE_REPORT_MS milliseconds and when the script is unloaded.
+var PROFILE_REPORT_MS = 2000;
+
+var _hookProfiles = {};
+
+//Scripts loaded by CombinedAgent share Interceptor, so every module replaces attach with either its own wrapper or the original.
+//Hooks are attached while each module's script runs, so each is attributed to the module that attached it.
+var _unprofiledAttach = Interceptor._winstrumentUnprofiledAttach || Interceptor.attach;
+Interceptor._winstrumentUnprofiledAttach = _unprofiledAttach;
+
+function _hookName(target) {
+    try {
+        var symbol = DebugSymbol.fromAddress(target);
+        if (symbol.name) {
+            return (symbol.moduleName ? symbol.moduleName + "!" : "") + symbol.name;
+        }
+    }
+    catch (e) {
+    }
+    return target.toString();
+}
+
+function _getHookProfile(name) {
+    var profile = _hookProfiles[name];
+    if (profile === undefined) {
+        profile = _hookProfiles[name] = { "calls": 0, "enter_us": 0, "leave_us": 0, "max_us": 0 };
+    }
+    return profile;
+}
+
+function _profileCallback(profile, callback, field, countsCall) {
+    return function () {
+        var start = clockMicros();
+        try {
+            return callback.apply(this, arguments);
+        }
+        finally {
+            var elapsed = clockMicros() - start;
+            profile[field] += elapsed;
+            if (elapsed > profile["max_us"]) {
+                profile["max_us"] = elapsed;
+            }
+            if (countsCall) {
+                profile["calls"]++;
+            }
+        }
+    };
+}
+
+function _reportHookProfiles() {
+    var hooks = {};
+    var any = false;
+    for (var name in _hookProfiles) {
+        var profile = _hookProfiles[name];
+        if (profile["calls"] === 0) {
+            continue;
+        }
+        hooks[name] = { "calls": profile["calls"], "enter_us": Math.round(profile["enter_us"]),
+            "leave_us": Math.round(profile["leave_us"]), "max_us": Math.round(profile["max_us"]) };
+        profile["calls"] = profile["enter_us"] = profile["leave_us"] = profile["max_us"] = 0;
+        any = true;
+    }
+    if (any) {
+        emitUnsampled({ "__control__": "profile", "hooks": hooks });
+    }
+}
+
+if (AGENT_CONFIG["profile"]) {
+    Interceptor.attach = function (target, callbacks) {
+        //native callbacks, e.g. from a CModule, can't be wrapped
+        if (typeof callbacks !== "object" || callbacks === null) {
+            return _unprofiledAttach.call(Interceptor, target, callbacks);
+        }
+        var profile = _getHookProfile(_hookName(target));
+        var wrapped = {};
+        for (var key in callbacks) {
+            wrapped[key] = callbacks[key];
+        }
+        var hasEnter = typeof callbacks.onEnter === "function";
+        if (hasEnter) {
+            wrapped.onEnter = _profileCallback(profile, callbacks.onEnter, "enter_us", true);
+        }
+        if (typeof callbacks.onLeave === "function") {
+            wrapped.onLeave = _profileCallback(profile, callbacks.onLeave, "leave_us", !hasEnter);
+        }
+        return _unprofiledAttach.call(Interceptor, target, wrapped);
+    };
+    setInterval(_reportHookProfiles, PROFILE_REPORT_MS);
+    onUnload(_reportHookProfiles);
+}
+else {
+    Interceptor.attach = _unprofiledAttach;
+}
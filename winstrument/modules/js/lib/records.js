@@ -0,0 +1,170 @@
+/*
+Copyright (C) 2019  NCC Group
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+//Compact binary records, an alternative to emitUnsampled() for numeric-heavy events such as periodic aggregates.
+//A module declares a fixed layout once with defineRecord(name, fields), where fields is a list of [field name, type] pairs. Types:
+//  "u8", "u16", "u32", "i32", "f64" - stored as is. null or undefined is stored as 0.
+//  "int" - a whole number up to 2^53, stored as an f64 and decoded on the host as an int
+//  "str" - an interned string. A string is sent as JSON the first time it is seen and as a u32 ID after that.
+//emitRecord(name, values) then reports an event with those fields, taken from the values object.
+//With AGENT_CONFIG["binary"] set, records are packed into an ArrayBuffer per layout and sent as the data argument of
+//  send({"records": {"layout": name, "fields": [...], "types": [...], "count": n}, "strings": {id: string}, "strings_reset": bool}, buffer)
+//with each record prefixed by its emit time (see epochMicros) as an f64. The host decodes them back into the same
+//{"function": name, field: value, ...} events that are sent as JSON when binary is off, so module code on both sides is unchanged.
+var RECORDS_MAX_BYTES = 64 * 1024;
+var RECORDS_FLUSH_MS = 50;
+var RECORDS_MAX_STRINGS = 65536;
+var RECORDS_NULL_STRING = 0xffffffff;
+
+var binaryRecords = !!AGENT_CONFIG["binary"];
+
+var _recordTypeSizes = { "u8": 1, "u16": 2, "u32": 4, "i32": 4, "f64": 8, "int": 8, "str": 4 };
+var _recordLayouts = {};
+var _recordTimer = null;
+var _stringIds = {};
+var _stringCount = 0;
+var _pendingStrings = {};
+var _stringsReset = false;
+var _stringTables = 1; //number of string tables started, see _internString
+
+function defineRecord(name, fields) {
+    var size = 8; //emit time
+    var names = [];
+    var types = [];
+    fields.forEach(function (field) {
+        if (!(field[1] in _recordTypeSizes)) {
+            throw new Error("Unknown record field type " + field[1]);
+        }
+        names.push(field[0]);
+        types.push(field[1]);
+        size += _recordTypeSizes[field[1]];
+    });
+    _recordLayouts[name] = { "name": name, "fields": names, "types": types, "size": size, "buffer": null, "view": null, "used": 0, "count": 0 };
+}
+
+function _internString(value) {
+    if (value === null || value === undefined) {
+        return RECORDS_NULL_STRING;
+    }
+    value = String(value);
+    var id = _stringIds[value];
+    if (id === undefined) {
+        if (_stringCount >= RECORDS_MAX_STRINGS) {
+            //bound memory use: send everything that refers to the current table, then start a new one
+            flushRecords();
+            _stringIds = {};
+            _stringCount = 0;
+            _stringsReset = true;
+            _stringTables++;
+        }
+        id = _stringCount++;
+        _stringIds[value] = id;
+        _pendingStrings[id] = value;
+    }
+    return id;
+}
+
+function _writeRecordField(view, offset, type, value) {
+    switch (type) {
+        case "u8": view.setUint8(offset, value || 0); break;
+        case "u16": view.setUint16(offset, value || 0, true); break;
+        case "u32": view.setUint32(offset, value || 0, true); break;
+        case "i32": view.setInt32(offset, value || 0, true); break;
+        case "f64": case "int": view.setFloat64(offset, value || 0, true); break;
+        case "str": view.setUint32(offset, value, true); break; //already interned
+    }
+    return offset + _recordTypeSizes[type];
+}
+
+function _flushLayout(layout) {
+    if (layout.count === 0) {
+        return;
+    }
+    var payload = {
+        "records": { "layout": layout.name, "fields": layout.fields, "types": layout.types, "count": layout.count },
+        "strings": _pendingStrings,
+        "strings_reset": _stringsReset
+    };
+    var data = layout.buffer.slice(0, layout.used);
+    //keep records in order with events emitted before them, which the host may need first, e.g. the event that opened a handle
+    _flushEvents();
+    _pendingStrings = {};
+    _stringsReset = false;
+    layout.used = 0;
+    layout.count = 0;
+    send(payload, data);
+}
+
+//Send all buffered records now, after any events emitted before them
+function flushRecords() {
+    if (_recordTimer !== null) {
+        clearTimeout(_recordTimer);
+        _recordTimer = null;
+    }
+    for (var name in _recordLayouts) {
+        _flushLayout(_recordLayouts[name]);
+    }
+}
+
+function emitRecord(name, values) {
+    var layout = _recordLayouts[name];
+    if (!binaryRecords) {
+        var event = { "function": name };
+        layout.fields.forEach(function (field) {
+            event[field] = values[field];
+        });
+        emitUnsampled(event);
+        return;
+    }
+    //intern strings first, as starting a new string table flushes every layout.
+    //If that happens part way through, IDs from the old table are no longer valid, so intern them again.
+    var fieldValues;
+    var stringTable;
+    do {
+        stringTable = _stringTables;
+        fieldValues = [];
+        for (var i = 0; i < layout.fields.length; i++) {
+            var value = values[layout.fields[i]];
+            fieldValues.push(layout.types[i] === "str" ? _internString(value) : value);
+        }
+    } while (stringTable !== _stringTables);
+    if (layout.buffer === null) {
+        layout.buffer = new ArrayBuffer(Math.max(RECORDS_MAX_BYTES, layout.size));
+        layout.view = new DataView(layout.buffer);
+    }
+    if (layout.used + layout.size > layout.buffer.byteLength) {
+        _flushLayout(layout);
+    }
+    var offset = layout.used;
+    layout.view.setFloat64(offset, epochMicros(), true);
+    offset += 8;
+    for (var j = 0; j < layout.fields.length; j++) {
+        offset = _writeRecordField(layout.view, offset, layout.types[j], fieldValues[j]);
+    }
+    layout.used = offset;
+    layout.count++;
+    if (_recordTimer === null) {
+        _recordTimer = setTimeout(flushRecords, RECORDS_FLUSH_MS);
+    }
+}
+
+//Records are also sent whenever events are flushed, including the final flush when the script unloads
+var _flushEvents = flush;
+flush = function () {
+    _flushEvents();
+    flushRecords();
+};
@@ -0,0 +1,92 @@
+/*
+Copyright (C) 2019  NCC Group
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+*/
+
+//Volume controls for emit(), configured per module through AGENT_CONFIG:
+//  sample     - pass only 1 in every N events
+//  rate_limit - token bucket, at most this many events per second on average...
+//  rate_burst - ...with bursts of up to this many events
+//  dedup_ms   - drop events identical to one passed within the last dedup_ms milliseconds
+//Suppressed events are counted and reported to the host so totals stay honest.
+var SAMPLING_REPORT_MS = 1000;
+var DEDUP_MAX_KEYS = 10000;
+
+var _sampleEvery = AGENT_CONFIG["sample"] || 1;
+var _rateLimit = AGENT_CONFIG["rate_limit"] || 0;
+var _rateBurst = AGENT_CONFIG["rate_burst"] || _rateLimit;
+var _dedupMs = AGENT_CONFIG["dedup_ms"] || 0;
+
+var _sampleCounter = 0;
+var _tokens = _rateBurst;
+var _lastRefill = Date.now();
+var _lastSeen = {};
+var _lastSeenCount = 0;
+var _suppressed = { "sampled": 0, "rate_limited": 0, "deduplicated": 0 };
+
+function _takeToken() {
+    var now = Date.now();
+    _tokens = Math.min(_rateBurst, _tokens + (now - _lastRefill) * _rateLimit / 1000);
+    _lastRefill = now;
+    if (_tokens < 1) {
+        return false;
+    }
+    _tokens -= 1;
+    return true;
+}
+
+function _isDuplicate(event) {
+    var key = JSON.stringify(event);
+    var now = Date.now();
+    var seen = _lastSeen[key];
+    if (seen !== undefined && now - seen < _dedupMs) {
+        return true;
+    }
+    if (seen === undefined && ++_lastSeenCount > DEDUP_MAX_KEYS) {
+        _lastSeen = {}; //bound memory use, at the cost of forgetting recent events
+        _lastSeenCount = 1;
+    }
+    _lastSeen[key] = now;
+    return false;
+}
+
+function _reportSuppressed() {
+    if (_suppressed["sampled"] + _suppressed["rate_limited"] + _suppressed["deduplicated"] === 0) {
+        return;
+    }
+    var counts = _suppressed;
+    _suppressed = { "sampled": 0, "rate_limited": 0, "deduplicated": 0 };
+    emitUnsampled({ "__control__": "suppressed", "counts": counts });
+}
+
+if (_sampleEvery > 1 || _rateLimit > 0 || _dedupMs > 0) {
+    emit = function (event) {
+        if (_sampleEvery > 1 && (_sampleCounter++ % _sampleEvery) !== 0) {
+            _suppressed["sampled"]++;
+            return;
+        }
+        if (_dedupMs > 0 && _isDuplicate(event)) {
+            _suppressed["deduplicated"]++;
+            return;
+        }
+        if (_rateLimit > 0 && !_takeToken()) {
+            _suppressed["rate_limited"]++;
+            return;
+        }
+        emitUnsampled(event);
+    };
+    setInterval(_reportSuppressed, SAMPLING_REPORT_MS);
+    onUnload(_reportSuppressed);
+}
@@ -25,7 +25,7 @@ Interceptor.attach(Module.getExportByName("Kernel32.dll", "CreateNamedPipeA"), {
 
         this.fh = ret.toInt32();
         pipes[this.fh] = this.pipename
-        send({ "function": "CreateNamedPipeA", "fh": this.fh, "pipename": this.pipename, "openmode": this.openmode, "pipemode": this.pipemode });
+        emit({ "function": "CreateNamedPipeA", "fh": this.fh, "pipename": this.pipename, "openmode": this.openmode, "pipemode": this.pipemode });
     }
 
 });
@@ -36,7 +36,7 @@ Interceptor.attach(Module.getExportByName("Kernel32.dll", "ConnectNamedPipe"), {
         this.pipename = pipes[this.fh];
 
         this.fh = ret.toInt32();
-        send({ "function": "ConnectNamedPipe", "fh": this.fh, "pipename": this.pipename });
+        emit({ "function": "ConnectNamedPipe", "fh": this.fh, "pipename": this.pipename });
     }
 
 });
@@ -50,6 +50,6 @@ Interceptor.attach(Module.getExportByName("Kernel32.dll", "CallNamedPipeA"), {
     },
     onLeave: function (ret) {
         this.read = this.readptr.readInt();
-        send({ "function": "CallNamedPipeA", "pipename": this.name, "written": this.written, read: this.read });
+        emit({ "function": "CallNamedPipeA", "pipename": this.name, "written": this.written, read: this.read });
     }
 });
@@ -18,7 +18,7 @@ Interceptor.attach(Module.getExportByName('kernel32.dll', "CreateProcessW"), {
     onEnter: function (args) {
         var application = args[0].readUtf16String();
         var cmdline = args[1].readUtf16String();
-        send({ "function": "CreateProcessW", "application": application, "args": cmdline });
+        emit({ "function": "CreateProcessW", "application": application, "args": cmdline });
 
     }
 });
@@ -27,7 +27,7 @@ Interceptor.attach(Module.getExportByName('kernel32.dll', "CreateProcessA"), {
     onEnter: function (args) {
         var application = args[0].readAnsiString();
         var cmdline = args[1].readAnsiString();
-        send({ "function": "CreateProcessA", "application": application, "args": cmdline });
+        emit({ "function": "CreateProcessA", "application": application, "args": cmdline });
 
     }
 });
\ No newline at end of file
@@ -22,7 +22,7 @@ var hkeys = {};
             this.hkey = args[0].toString();
             this.subkey = args[1].readUtf16String();
             this.hsubkey = args[4];
-            send({ "function": name, "hkey": this.hkey, "subkey": this.subkey });
+            emit({ "function": name, "hkey": this.hkey, "subkey": this.subkey });
 
         },
         onLeave: function (ret) {
@@ -39,7 +39,7 @@ var hkeys = {};
             this.hkey = args[0].toString();
             this.subkey = args[1].readUtf16String();
             this.value = args[2].readUtf16String();
-            send({ "function": name, "hkey": this.hkey, "subkey": this.subkey, "value": this.value });
+            emit({ "function": name, "hkey": this.hkey, "subkey": this.subkey, "value": this.value });
         },
     })
 });
@@ -51,7 +51,7 @@ Interceptor.attach(Module.getExportByName("KernelBase.dll", "RegQueryValueExW"),
             if (val) {
                 var hkey = args[0].toInt32();
                 var path = hkeys[hkey];
-                send({
+                emit({
                     "function": "RegQueryValueExW",
                     "subkey": path,
                     "value": val
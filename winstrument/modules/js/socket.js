@@ -14,28 +14,128 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 */
-var functions = ['connect', 'recv', 'send'];
-functions.forEach(function (name) {
+//Socket activity is aggregated per socket into flow records, instead of sending one message per connect/send/recv call.
+//Sockets with activity report what happened since their previous report as a flow_update every SUMMARY_INTERVAL_MS,
+//and the rest as a flow when the socket is closed or the script unloads. The host merges them into one record per socket.
+var SUMMARY_INTERVAL_MS = 1000;
+
+//fd -> {type, address, port}. Socket.type/peerAddress are syscalls, so they aren't repeated on every send/recv.
+var socketInfo = {};
+//fd -> counts since the socket's last report
+var flows = {};
+
+//sent as binary records when the binary setting is on, see lib/records.js. An unknown port is sent as 0 in that case.
+var FLOW_FIELDS = [["fd", "int"], ["connect", "u32"], ["send", "u32"], ["recv", "u32"], ["bytes_sent", "int"], ["bytes_received", "int"],
+    ["first_seen", "int"], ["last_seen", "int"], ["type", "str"], ["address", "str"], ["port", "u16"]];
+defineRecord("flow", FLOW_FIELDS);
+defineRecord("flow_update", FLOW_FIELDS);
+
+//Look up the peer address of a socket that doesn't have one yet: when it is first seen, after connect and when its activity is reported.
+//It is null until connected, or while connect is still in progress on a non-blocking socket.
+function lookUpAddress(info, fd) {
+    if (info["address"] !== null) {
+        return;
+    }
+    var addr = Socket.peerAddress(fd);
+    if (addr !== null) {
+        info["address"] = addr.ip;
+        info["port"] = addr.port;
+    }
+}
+
+function getSocketInfo(fd) {
+    var info = socketInfo[fd];
+    if (info === undefined) {
+        info = { "type": Socket.type(fd), "address": null, "port": null };
+        lookUpAddress(info, fd);
+        socketInfo[fd] = info;
+    }
+    return info;
+}
+
+function getFlow(fd) {
+    var flow = flows[fd];
+    if (flow === undefined) {
+        var now = epochMicros();
+        flow = {
+            "fd": fd,
+            "connect": 0,
+            "send": 0,
+            "recv": 0,
+            "bytes_sent": 0,
+            "bytes_received": 0,
+            "first_seen": now,
+            "last_seen": now
+        };
+        flows[fd] = flow;
+    }
+    return flow;
+}
+
+//Send the socket's counts since its last report, as a flow_update while it is open or a flow once it is closed
+function reportFlow(fd, name) {
+    var flow = flows[fd];
+    var info = socketInfo[fd];
+    if (info === undefined) {
+        if (flow === undefined) {
+            return;
+        }
+        info = getSocketInfo(fd);
+    }
+    if (flow === undefined) {
+        if (name !== "flow") {
+            return;
+        }
+        //closed without activity since the last update, the host still needs to know the socket is finished
+        flow = getFlow(fd);
+    }
+    lookUpAddress(info, fd);
+    flow["type"] = info["type"];
+    flow["address"] = info["address"];
+    flow["port"] = info["port"];
+    emitRecord(name, flow);
+    delete flows[fd];
+}
+
+setInterval(function () {
+    Object.keys(flows).forEach(function (fd) {
+        reportFlow(parseInt(fd), "flow_update");
+    });
+}, SUMMARY_INTERVAL_MS);
+
+onUnload(function () {
+    Object.keys(socketInfo).forEach(function (fd) {
+        reportFlow(parseInt(fd), "flow");
+    });
+});
+
+var byteCounters = { "send": "bytes_sent", "recv": "bytes_received" };
+['connect', 'recv', 'send'].forEach(function (name) {
     Interceptor.attach(Module.getExportByName('ws2_32.dll', name), {
         onEnter: function (args) {
-            var fd = args[0].toInt32()
-            var type = Socket.type(fd)
-            var addr = Socket.peerAddress(fd)
-            var ip = null;
-            var port = null;
-            if (addr !== null) {
-                ip = addr.ip;
-                port = addr.port;
+            this.fd = args[0].toInt32();
+        },
+        onLeave: function (ret) {
+            var info = getSocketInfo(this.fd);
+            if (name === "connect") {
+                lookUpAddress(info, this.fd);
+            }
+            var flow = getFlow(this.fd);
+            flow[name]++;
+            flow["last_seen"] = epochMicros();
+            var result = ret.toInt32();
+            if (name in byteCounters && result > 0) {
+                flow[byteCounters[name]] += result;
             }
-            var data = {
-                "function": name,
-                "type": type,
-                "address": ip,
-                "port": port
-
-            };
-            send(data);
-
         }
     })
 });
+
+Interceptor.attach(Module.getExportByName('ws2_32.dll', 'closesocket'), {
+    onEnter: function (args) {
+        var fd = args[0].toInt32();
+        reportFlow(fd, "flow");
+        //the descriptor can be reused for an unrelated socket
+        delete socketInfo[fd];
+    }
+});
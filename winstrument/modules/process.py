@@ -17,6 +17,7 @@ import win32con
 from winstrument.base_module import BaseInstrumentation
 class Process(BaseInstrumentation):
     modulename = "process"
+    dedup_output = True
     def __init__(self,*args, **kwargs):
         self._output = []
         super().__init__(*args,**kwargs)
@@ -17,6 +17,7 @@ import win32con
 from winstrument.base_module import BaseInstrumentation
 class Registry(BaseInstrumentation):
     modulename = "registry"
+    dedup_output = True
     HKEY_CONSTANTS = {win32con.HKEY_CURRENT_USER: "HKEY_CURRENT_USER",win32con.HKEY_LOCAL_MACHINE: "HKEY_LOCAL_MACHINE",win32con.HKEY_CLASSES_ROOT: "HKEY_CLASSES_ROOT",win32con.HKEY_USERS: "HKEY_USERS",win32con.HKEY_CURRENT_CONFIG: "HKEY_CURRENT_CONFIG"}
     def __init__(self,*args, **kwargs):
         self._output = []
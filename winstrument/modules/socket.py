@@ -20,8 +20,65 @@ class Socket(BaseInstrumentation):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sockets = []
+        #fd -> flow for each open socket, merged from the agent's flow_update reports until its final flow arrives
+        self._open_flows = {}
 
     def on_message(self, message, data):
-        if message["type"] == "send":
+        if message["type"] == "error":
+            print(f"Error: {message}")
+            return
+        elif message["type"] == "send":
+            #activity aggregated per socket in the target, see js/socket.js
+            #first_seen/last_seen are microseconds since the epoch, formatted for display by ModuleMessage
             payload = message["payload"]
-            self.write_message(payload)
\ No newline at end of file
+            function = payload.pop("function", None)
+            flow = self._merge_flow(payload)
+            if function == "flow": #the socket was closed, or the process is exiting
+                del self._open_flows[payload["fd"]]
+                self._write_flow(flow)
+
+    def _merge_flow(self, counts):
+        """
+        Add the activity the agent reported for a socket to its open flow, and return the flow
+        counts - dict, flow or flow_update payload with the counts since the socket's previous report
+        """
+        fd = counts["fd"]
+        flow = self._open_flows.get(fd)
+        if flow is None:
+            flow = self._open_flows[fd] = {"function": "flow", "fd": fd, "connect": 0, "send": 0, "recv": 0, "bytes_sent": 0, "bytes_received": 0,
+                                           "first_seen": None, "last_seen": None}
+        for key in ("connect", "send", "recv", "bytes_sent", "bytes_received"):
+            flow[key] += counts[key]
+        if flow["first_seen"] is None:
+            flow["first_seen"] = counts["first_seen"]
+        flow["last_seen"] = counts["last_seen"]
+        for key in ("type", "address", "port"):
+            if counts.get(key) is not None:
+                flow[key] = counts[key]
+        return flow
+
+    def _write_flow(self, flow, partial=False):
+        """
+        Write a flow to the database, unless nothing happened on the socket since its last row
+        partial - bool, True for the activity so far on a socket that is still open
+        """
+        if flow["first_seen"] is None:
+            return
+        record = dict(flow)
+        if partial:
+            record["partial"] = True
+        self.write_message(record)
+
+    def on_flush(self):
+        #write the activity so far on sockets still open, so they show up while the target runs. Each row holds the activity since the previous one.
+        for flow in self._open_flows.values():
+            self._write_flow(flow, partial=True)
+            for key in ("connect", "send", "recv", "bytes_sent", "bytes_received"):
+                flow[key] = 0
+            flow["first_seen"] = flow["last_seen"] = None
+
+    def on_finish(self):
+        #sockets whose final flow never arrived, e.g. because the process was killed
+        for flow in self._open_flows.values():
+            self._write_flow(flow)
+        self._open_flows.clear()
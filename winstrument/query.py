@@ -0,0 +1,401 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+import re
+from datetime import datetime
+from winstrument.data.module_message import ModuleMessage, TIME_FIELDS
+import winstrument.utils as utils
+
+#Query syntax for show/export, compiled to SQL over the output table so filtering and aggregation happen in SQLite:
+#   [select <item>, ...] [where <condition>] [group by <field>, ...] [order by <item> [asc|desc], ...] [limit <n>]
+#Fields are keys of the module's payload, read with json_extract, or one of the promoted output columns below.
+
+#output table columns that can be used as fields directly
+PROMOTED_COLUMNS = ["time", "target", "pid", "session", "run_id", "count", "last_time"]
+#columns holding microseconds since the epoch, which can be compared with date strings, as can the payload's TIME_FIELDS
+TIME_COLUMNS = ["time", "last_time"]
+AGGREGATES = ["count", "sum", "min", "max", "avg"]
+KEYWORDS = ["select", "where", "group", "order", "by", "limit", "asc", "desc", "and", "or", "not", "like", "in", "is", "null", "true", "false"]
+#words which can start a query, so callers can tell where arguments end and the query begins
+CLAUSE_KEYWORDS = ["select", "where", "group", "order", "limit"]
+COMPARISONS = ["=", "==", "!=", "<>", "<", "<=", ">", ">="]
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<number>-?\d+(?:\.\d+)?(?![\w.]))
+    |(?P<op><=|>=|!=|<>|==|=|<|>|\(|\)|,|\*)
+    |(?P<word>[A-Za-z_][\w.]*)
+    |(?P<quoted>`[^`]+`)
+    )""", re.VERBOSE)
+
+class QueryError(ValueError):
+    pass
+
+def tokenize(text):
+    """
+    Split query text into a list of (kind, value) tuples. kind is string, number, op, word (lowercased if it is a keyword) or field.
+    Strings are quoted with ' or ", and a quote is escaped by doubling it or with a backslash. Other backslashes are kept as is, for Windows paths.
+    Backquoted words are field names, for payload keys that aren't plain identifiers.
+    """
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_RE.match(text, position)
+        if match is None:
+            raise QueryError(f"Unexpected character at '{text[position:].strip()[:20]}'")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            quote = value[0]
+            value = re.sub(r"\\([\\'\"])", r"\1", value[1:-1].replace(quote * 2, quote))
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "quoted":
+            kind, value = "field", value[1:-1]
+        elif kind == "word":
+            if value.lower() in KEYWORDS or value.lower() in AGGREGATES:
+                value = value.lower()
+            else:
+                kind = "field"
+        tokens.append((kind, value))
+    return tokens
+
+class Query:
+    """
+    A parsed show/export query. See parse_query.
+    """
+    def __init__(self, select=None, where=None, group_by=None, order_by=None, limit=None):
+        """
+        select - list of (aggregate or None, field or None) tuples, or None to return whole messages. (count, None) is count(*).
+        where - condition tree, see _Parser.parse_condition, or None
+        group_by - list of field names
+        order_by - list of (item, descending) tuples. item is a field name, or an (aggregate, field) tuple.
+        limit - int or None
+        """
+        self.select = select
+        self.where = where
+        self.group_by = group_by or []
+        self.order_by = order_by or []
+        self.limit = limit
+
+    @property
+    def aggregated(self):
+        """
+        True if the query returns one row per group rather than one per message
+        """
+        return bool(self.group_by) or any(aggregate is not None for aggregate, _ in self.select or [])
+
+    def compile(self, modname, run_ids=None):
+        """
+        Build the SQL statement for the query over the output of one module
+        modname - str
+        run_ids - list of str or None, only include messages from these runs
+        Returns (sql, params)
+        """
+        params = [modname]
+        conditions = ["modname = ?"]
+        if run_ids is not None:
+            conditions.append(f"""run_id IN ({",".join("?" * len(run_ids))})""")
+            params.extend(run_ids)
+        where_params = []
+        if self.where is not None:
+            conditions.append(f"({self._compile_condition(self.where, where_params)})")
+        if self.aggregated:
+            #first time seen in each group, for the ModuleMessage returned
+            columns = ['MIN("time")']
+        else:
+            columns = ['"time"', '"target"', '"pid"', '"session"', '"run_id"', '"message"', '"count"', '"last_time"']
+        for aggregate, field in self._select_items():
+            columns.append(self._compile_item(aggregate, field))
+        sql = f"""SELECT {", ".join(columns)} FROM "output" WHERE {" AND ".join(conditions)}"""
+        params.extend(where_params)
+        if self.group_by:
+            sql += " GROUP BY " + ", ".join(self._compile_field(field) for field in self.group_by)
+        order = []
+        for item, descending in self.order_by:
+            aggregate, field = item if isinstance(item, tuple) else (None, item)
+            if self.aggregated and aggregate is None and field == "count":
+                expression = 'SUM("count")' #order groups by their number of occurrences
+            else:
+                expression = self._compile_item(aggregate, field)
+            order.append(expression + (" DESC" if descending else ""))
+        if not order:
+            order = ['MIN("time")'] if self.aggregated else ["id"]
+        sql += " ORDER BY " + ", ".join(order)
+        if self.limit is not None:
+            sql += " LIMIT ?"
+            params.append(self.limit)
+        return sql, params
+
+    def to_message(self, modname, row):
+        """
+        Convert a row returned by the compiled query into a ModuleMessage.
+        Aggregated rows hold only the selected items as their payload, or the group by fields and count(*) without select, and the first
+        time a message in the group was seen. They have no target unless target is one of the items.
+        An aggregate without group by returns a row even when no messages match, with count(*) 0 and no time.
+        """
+        items = self._select_items()
+        values = row[-len(items):] if items else []
+        data = {}
+        for (aggregate, field), value in zip(items, values):
+            if (field in TIME_COLUMNS or field in TIME_FIELDS) and aggregate in (None, "min", "max"):
+                value = utils.format_timestamp(value)
+            data[self._label(aggregate, field)] = value
+        if self.aggregated:
+            message = ModuleMessage(modname, None, data, time=row[0])
+            if row[0] is None: #no messages matched, show an empty time rather than the current one
+                message.time = None
+            return message
+        time, target, pid, session, run_id, message, count, last_time = row[:8]
+        if self.select is None:
+            data = json.loads(message)
+        return ModuleMessage(modname, target, data, time=time, pid=pid, session=session, run_id=run_id, count=count, last_time=last_time)
+
+    def _select_items(self):
+        if self.select is not None:
+            return self.select
+        #the number of messages in each group is shown by default
+        return [(None, field) for field in self.group_by] + ([("count", None)] if self.group_by else [])
+
+    def _label(self, aggregate, field):
+        if aggregate is None:
+            return field
+        return f"{aggregate}({field or '*'})"
+
+    def _compile_item(self, aggregate, field):
+        if aggregate is None:
+            return self._compile_field(field)
+        if field is None: #count(*), 0 rather than NULL when no messages match
+            return 'COALESCE(SUM("count"), 0)'
+        return f"{aggregate.upper()}({self._compile_field(field)})"
+
+    def _compile_field(self, field):
+        if field in PROMOTED_COLUMNS:
+            return f'"{field}"'
+        #the JSON path is inlined rather than bound, so identical expressions in SELECT and GROUP BY are recognised as the same
+        path = "$." + ".".join('"' + part.replace('"', '\\"') + '"' for part in field.split("."))
+        return "json_extract(message, '" + path.replace("'", "''") + "')"
+
+    def _compile_value(self, operand, other, params):
+        kind, value = operand
+        if kind == "field":
+            return self._compile_field(value)
+        if kind == "string" and other is not None and other[0] == "field" and (other[1] in TIME_COLUMNS or other[1] in TIME_FIELDS):
+            value = parse_time(value)
+        params.append(value)
+        return "?"
+
+    def _compile_condition(self, condition, params):
+        kind = condition[0]
+        if kind in ("and", "or"):
+            return f"({self._compile_condition(condition[1], params)} {kind.upper()} {self._compile_condition(condition[2], params)})"
+        if kind == "not":
+            return f"NOT ({self._compile_condition(condition[1], params)})"
+        if kind == "is":
+            _, operand, negated = condition
+            return f"{self._compile_value(operand, None, params)} IS {'NOT ' if negated else ''}NULL"
+        if kind == "in":
+            _, operand, values, negated = condition
+            left = self._compile_value(operand, None, params)
+            right = ", ".join(self._compile_value(value, operand, params) for value in values)
+            return f"{left} {'NOT ' if negated else ''}IN ({right})"
+        if kind == "like":
+            _, left, right, negated = condition
+            return f"{self._compile_value(left, right, params)} {'NOT ' if negated else ''}LIKE {self._compile_value(right, left, params)}"
+        _, op, left, right = condition
+        op = {"==": "=", "<>": "!="}.get(op, op)
+        return f"{self._compile_value(left, right, params)} {op} {self._compile_value(right, left, params)}"
+
+def parse_time(value):
+    """
+    Convert a local date and time string such as 2019-08-19 07:03:07 into microseconds since the epoch, for comparing with time columns
+    """
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000000)
+    except ValueError:
+        raise QueryError(f"Invalid time '{value}', expected e.g. 2019-08-19 07:03:07")
+
+def parse_query(text):
+    """
+    Parse a show/export query:
+        [select <item>, ...] [where <condition>] [group by <field>, ...] [order by <item> [asc|desc], ...] [limit <n>]
+    Items are fields, or count(*), sum(field), min(field), max(field) or avg(field).
+    Conditions compare fields and values with =, !=, <, <=, >, >=, like, in (...) and is [not] null, combined with and, or, not and parentheses.
+    Fields are payload keys, with . for nested keys, or the time, target, pid, session, run_id, count and last_time columns.
+    text - str
+    Returns a Query
+    Raises QueryError if the query is invalid
+    """
+    return _Parser(tokenize(text)).parse()
+
+def is_query(argument):
+    """
+    Returns True if a command argument is the first word of a query, see parse_query
+    """
+    return argument.lower() in CLAUSE_KEYWORDS
+
+class _Parser:
+    """
+    Recursive descent parser for parse_query
+    """
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._position = 0
+
+    def _peek(self, offset=0):
+        if self._position + offset < len(self._tokens):
+            return self._tokens[self._position + offset]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise QueryError("Unexpected end of query")
+        self._position += 1
+        return token
+
+    def _accept(self, *values):
+        """
+        Consume the next token if it is one of the given keywords or operators, returning its value, otherwise return None
+        """
+        kind, value = self._peek()
+        if kind in ("word", "op") and value in values:
+            self._position += 1
+            return value
+        return None
+
+    def _expect(self, value):
+        if self._accept(value) is None:
+            raise QueryError(f"Expected '{value}' but found '{self._describe(self._peek())}'")
+
+    def _describe(self, token):
+        return "end of query" if token[0] is None else token[1]
+
+    def parse(self):
+        query = Query()
+        if self._accept("select"):
+            query.select = self._parse_list(self._parse_item)
+        if self._accept("where"):
+            query.where = self.parse_condition()
+        if self._accept("group"):
+            self._expect("by")
+            query.group_by = self._parse_list(self._parse_field)
+        if self._accept("order"):
+            self._expect("by")
+            query.order_by = self._parse_list(self._parse_order)
+        if self._accept("limit"):
+            kind, value = self._next()
+            if kind != "number" or not isinstance(value, int) or value < 0:
+                raise QueryError(f"Invalid limit '{value}'")
+            query.limit = value
+        if self._peek()[0] is not None:
+            raise QueryError(f"Unexpected '{self._describe(self._peek())}'")
+        if not query.aggregated and any(isinstance(item, tuple) for item, _ in query.order_by):
+            raise QueryError("Ordering by an aggregate needs group by")
+        return query
+
+    def _parse_list(self, parse_element):
+        elements = [parse_element()]
+        while self._accept(","):
+            elements.append(parse_element())
+        return elements
+
+    def _parse_field(self):
+        kind, value = self._next()
+        if kind == "field":
+            return value
+        if kind == "word" and value in AGGREGATES: #a field with the name of an aggregate, such as the count column
+            return value
+        raise QueryError(f"Expected a field name but found '{value}'")
+
+    def _parse_item(self):
+        """
+        item := field | aggregate ( field ) | count ( * ). Returns (aggregate or None, field or None)
+        """
+        kind, value = self._peek()
+        if kind == "word" and value in AGGREGATES and self._peek(1) == ("op", "("):
+            self._position += 2
+            field = None
+            if not (value == "count" and self._accept("*")):
+                field = self._parse_field()
+            self._expect(")")
+            return (value, field)
+        return (None, self._parse_field())
+
+    def _parse_order(self):
+        aggregate, field = self._parse_item()
+        descending = self._accept("desc") is not None
+        if not descending:
+            self._accept("asc")
+        return ((aggregate, field) if aggregate else field, descending)
+
+    def parse_condition(self):
+        """
+        Parse a where condition into a tree of tuples:
+        ("or"/"and", left, right), ("not", condition), ("is", operand, negated), ("in", operand, [operand, ...], negated),
+        ("like", left, right, negated) or ("compare", op, left, right). Operands are (kind, value) tokens.
+        """
+        condition = self._parse_and()
+        while self._accept("or"):
+            condition = ("or", condition, self._parse_and())
+        return condition
+
+    def _parse_and(self):
+        condition = self._parse_not()
+        while self._accept("and"):
+            condition = ("and", condition, self._parse_not())
+        return condition
+
+    def _parse_not(self):
+        if self._accept("not"):
+            return ("not", self._parse_not())
+        if self._accept("("):
+            condition = self.parse_condition()
+            self._expect(")")
+            return condition
+        return self._parse_comparison()
+
+    def _parse_operand(self):
+        kind, value = self._next()
+        if kind in ("field", "string", "number"):
+            return (kind, value)
+        if kind == "word" and value in ("true", "false"):
+            return ("number", 1 if value == "true" else 0) #how json_extract returns JSON booleans
+        if kind == "word" and value in AGGREGATES:
+            return ("field", value)
+        raise QueryError(f"Expected a field or value but found '{value}'")
+
+    def _parse_comparison(self):
+        left = self._parse_operand()
+        if self._accept("is"):
+            negated = self._accept("not") is not None
+            self._expect("null")
+            return ("is", left, negated)
+        negated = self._accept("not") is not None
+        if self._accept("like"):
+            return ("like", left, self._parse_operand(), negated)
+        if self._accept("in"):
+            self._expect("(")
+            values = self._parse_list(self._parse_operand)
+            self._expect(")")
+            return ("in", left, values, negated)
+        if negated:
+            raise QueryError(f"Expected 'like' or 'in' after 'not' but found '{self._describe(self._peek())}'")
+        op = self._accept(*COMPARISONS)
+        if op is None:
+            raise QueryError(f"Expected a comparison but found '{self._describe(self._peek())}'")
+        return ("compare", op, left, self._parse_operand())
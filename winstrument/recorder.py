@@ -0,0 +1,85 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import base64
+import gzip
+import json
+import threading
+
+#Bump when the layout of recording files changes
+RECORDING_VERSION = 1
+
+class Recorder:
+    """
+    Writes every raw message received from one Frida session to a gzip compressed, newline delimited JSON file, so the session can be replayed later without the target.
+    The first line is a header describing the session. Each following line is one message: {"module": str, "message": dict, "data": base64 str or null}
+    """
+    def __init__(self, path, target, pid, run_id):
+        """
+        path - str, file to create
+        target - str, path of the target process
+        pid - int, PID of the target process
+        run_id - str, ID of the run the session belongs to
+        """
+        self._lock = threading.Lock() #modules can receive messages on different threads
+        self._file = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+        header = {"recording": RECORDING_VERSION, "target": target, "pid": pid, "run_id": run_id}
+        self._file.write(json.dumps(header) + "\n")
+
+    def record(self, modulename, message, data):
+        """
+        Append one message as received by the module's Frida 'message' handler
+        modulename - str
+        message - dict, Frida message
+        data - bytes or None, binary data sent with the message
+        """
+        line = json.dumps({"module": modulename, "message": message, "data": base64.b64encode(data).decode("ascii") if data is not None else None})
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_recording(path):
+    """
+    Open a file written by Recorder
+    path - str
+    Returns (header dict, generator of (modulename, message, data) tuples). The generator closes the file when exhausted.
+    Raises ValueError if the file is not a recording
+    """
+    recording = gzip.open(path, "rt", encoding="utf-8")
+    try:
+        header = json.loads(recording.readline())
+    except (OSError, ValueError, EOFError):
+        recording.close()
+        raise ValueError(f"{path} is not a Winstrument recording")
+    if not isinstance(header, dict) or header.get("recording") != RECORDING_VERSION:
+        recording.close()
+        raise ValueError(f"{path} is not a Winstrument recording, or was made by an incompatible version")
+
+    def records():
+        with recording:
+            try:
+                for line in recording:
+                    record = json.loads(line)
+                    data = base64.b64decode(record["data"]) if record["data"] is not None else None
+                    yield record["module"], record["message"], data
+            except (EOFError, OSError, ValueError):
+                #a session cut off mid-write leaves a truncated file, so replay what was recorded before that point
+                return
+    return header, records()
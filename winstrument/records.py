@@ -0,0 +1,78 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Decoding of the binary records sent by js/lib/records.js. See that file for the wire format.
+"""
+import struct
+
+#struct format character for each field type in js/lib/records.js. Every record starts with its emit time as an f64.
+TYPE_FORMATS = {"u8": "B", "u16": "H", "u32": "I", "i32": "i", "f64": "d", "int": "d", "str": "I"}
+NULL_STRING = 0xffffffff
+
+class RecordDecoder:
+    """
+    Turns binary record messages from one agent back into the event dicts the module would have received as JSON.
+    Holds the agent's string table, so use one decoder per script.
+    """
+    def __init__(self):
+        self._strings = {} #string ID -> str
+        self._layouts = {} #(layout name, fields, types) -> (struct.Struct, converter)
+
+    def _get_layout(self, name, fields, types):
+        """
+        Returns (struct.Struct, function converting an unpacked tuple to (time, event dict)) for a layout, building it the first time the layout is seen
+        """
+        key = (name, tuple(fields), tuple(types))
+        layout = self._layouts.get(key)
+        if layout is not None:
+            return layout
+        record_struct = struct.Struct("<d" + "".join(TYPE_FORMATS[field_type] for field_type in types))
+        strings = self._strings
+        #positions in the unpacked tuple, which starts with the time
+        string_positions = [position for position, field_type in enumerate(types, 1) if field_type == "str"]
+        int_positions = [position for position, field_type in enumerate(types, 1) if field_type == "int"]
+        keys = ("function",) + tuple(fields)
+
+        def convert(values):
+            values = list(values)
+            for position in string_positions:
+                values[position] = strings.get(values[position]) #NULL_STRING is never in the table, so becomes None
+            for position in int_positions:
+                values[position] = int(values[position])
+            event_time = int(values[0])
+            values[0] = name
+            return event_time, dict(zip(keys, values))
+
+        layout = self._layouts[key] = (record_struct, convert)
+        return layout
+
+    def decode(self, payload, data):
+        """
+        Decode one binary record message
+        payload - dict, the message payload: {"records": {...}, "strings": {...}, "strings_reset": bool}
+        data - bytes, the packed records
+        Returns a list of (time, event) tuples in the order the records were emitted. time is integer microseconds since the epoch.
+        Raises ValueError if data doesn't match the layout
+        """
+        if payload.get("strings_reset"):
+            self._strings.clear()
+        for string_id, value in payload.get("strings", {}).items():
+            self._strings[int(string_id)] = value
+        records = payload["records"]
+        record_struct, convert = self._get_layout(records["layout"], records["fields"], records["types"])
+        expected = record_struct.size * records["count"]
+        if data is None or len(data) != expected:
+            raise ValueError(f"Expected {expected} bytes of {records['layout']} records, got {len(data) if data is not None else 0}")
+        return [convert(values) for values in record_struct.iter_unpack(memoryview(data))]
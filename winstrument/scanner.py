@@ -0,0 +1,137 @@
+# Copyright (C) 2019  NCC Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import uuid
+
+#Seconds to wait for the processes of a timed out target to exit after being killed, before detaching from them
+KILL_GRACE_SECONDS = 5
+
+def read_scan_targets(source):
+    """
+    Returns the targets to scan from source, as a list of (path, args) tuples. args is a str, empty for none.
+    source - str, either a directory, which is searched recursively for .exe files, or a text file with one target per line.
+        Each line holds the path of an executable, optionally followed by a tab and the arguments to spawn it with.
+        Blank lines and lines starting with # are ignored.
+    Raises OSError if source can't be read, or ValueError if it holds no targets
+    """
+    targets = []
+    if os.path.isdir(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(".exe"):
+                    targets.append((os.path.join(dirpath, filename), ""))
+    else:
+        with open(source, 'r') as listfile:
+            for line in listfile:
+                line = line.rstrip("\r\n")
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                path, _, args = line.partition("\t")
+                targets.append((path.strip(), args.strip()))
+    if not targets:
+        raise ValueError(f"No targets found in {source}")
+    return targets
+
+class Scanner:
+    """
+    Runs the queued targets of a batch scan, up to concurrency at a time, each as its own run in the database.
+    Targets still running after timeout seconds are killed, along with their child processes.
+    The queue is kept in the database (see DBConnection.add_scan_targets), so targets are claimed one at a time and a scan
+    that is interrupted can carry on from where it stopped. See Winstrument.scan.
+    Every method is called on the Frida reactor thread.
+    """
+    def __init__(self, app, source, concurrency=4, timeout=60):
+        """
+        app - Winstrument instance that spawns and instruments the targets
+        source - str, identifies the scan in the queue
+        concurrency - int, maximum number of targets running at once
+        timeout - int, seconds a target may run before it is killed
+        """
+        self._app = app
+        self._db = app._db
+        self._source = source
+        self._concurrency = concurrency
+        self._timeout = timeout
+        self._active = {} #run ID -> queue entry of the target running in it
+        self._timed_out = set() #run IDs of targets that were killed
+        self.run_ids = [] #runs started by this scan
+
+    def start(self):
+        """
+        Helper function used with Frida reactor. Starts the first targets, or stops the reactor if none are pending.
+        """
+        self._fill()
+
+    def on_run_exited(self, run_id):
+        """
+        Called by Winstrument when every process in a run has exited and been finalized. Records the target's outcome and starts the next one.
+        run_id: str
+        """
+        if run_id not in self._active:
+            return
+        self._finish(run_id, "timed_out" if run_id in self._timed_out else "done")
+        self._fill()
+
+    def _fill(self):
+        """
+        Start pending targets until concurrency targets are running. Stops the reactor once nothing is left to run.
+        """
+        while len(self._active) < self._concurrency and not self._app._stop_requested.is_set():
+            run_id = uuid.uuid4().hex
+            entry = self._db.claim_scan_target(self._source, run_id)
+            if entry is None:
+                break
+            args = entry["args"] or None
+            self._db.begin_run(run_id, entry["target"], args)
+            self.run_ids.append(run_id)
+            self._active[run_id] = entry
+            if self._app._spawn(entry["target"], args, run_id) is None:
+                self._finish(run_id, "failed")
+                continue
+            self._app._reactor.schedule(lambda run_id=run_id: self._on_timeout(run_id), delay=self._timeout)
+        if not self._active:
+            self._app.stop()
+
+    def _finish(self, run_id, status):
+        """
+        Record the outcome of a target and print the scan's progress
+        run_id: str
+        status: str - done, timed_out or failed
+        """
+        entry = self._active.pop(run_id)
+        self._timed_out.discard(run_id)
+        self._db.end_run(run_id)
+        self._db.finish_scan_target(entry["id"], status)
+        progress = self._db.get_scan_progress(self._source)
+        finished = sum(count for target_status, count in progress.items() if target_status not in ("pending", "running"))
+        print(f"[{finished}/{sum(progress.values())}] {entry['target']}: {status}")
+
+    def _on_timeout(self, run_id):
+        """
+        Helper function used with Frida reactor. Kills a target that is still running after the timeout.
+        """
+        if run_id not in self._active:
+            return
+        self._timed_out.add(run_id)
+        self._app._kill_run(run_id)
+        self._app._reactor.schedule(lambda: self._on_kill_timeout(run_id), delay=KILL_GRACE_SECONDS)
+
+    def _on_kill_timeout(self, run_id):
+        """
+        Helper function used with Frida reactor. Detaches from processes that outlived being killed, so the scan doesn't wait on them forever.
+        """
+        if run_id in self._active:
+            self._app._detach_run(run_id)
@@ -12,6 +12,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import math
 import os
 import toml
 class SettingsController:
@@ -87,10 +88,24 @@ class SettingsController:
         val=self.settings[modname].get(key,None)
         try:
             num = int(val)
-        except TypeError:
+        except (TypeError, ValueError):
             num = None
         return num
 
+    def get_setting_float(self, modname, key):
+        """
+        Gets the float representation of the setting stored in the given key.
+        modname - str
+        key - str
+        Returns the setting value as float. Returns None if the setting isn't parsable to a finite float or does not exist.
+        """
+        val=self.settings[modname].get(key,None)
+        try:
+            num = float(val)
+        except (TypeError, ValueError):
+            return None
+        return num if math.isfinite(num) else None
+
     def get_setting_boolean(self, modname, key):
         """
         Gets the boolean representation of the string setting stored in key for modname
@@ -101,7 +116,7 @@ class SettingsController:
 
         """
 
-        val = self.settings[modname].get(key,"").lower()
+        val = str(self.settings[modname].get(key,"")).lower()
         if val == "yes" or val == "true":
             return True
         elif val == "no" or val == "false":
@@ -12,20 +12,73 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from winstrument.data.module_message import ModuleMessage
-from tabulate import tabulate
+import csv
+import io
 import json
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from datetime import datetime
 import os
+import threading
+import time
 
 
 def format_table(messagelist, verbosity=0):
+    from tabulate import tabulate #imported on first use, to keep startup fast
     if verbosity < 1:
         return tabulate([elipsize_message(message).flatten() for message in messagelist],headers="keys")
     else:
         return tabulate([message.flatten() for message in messagelist],headers="keys")
 def format_json(messagelist,verbosity=0):
-    return json.dumps([message.flatten() for message in messagelist])
+    return _format_with_writer(write_json, messagelist, verbosity)
+
+def format_ndjson(messagelist, verbosity=0):
+    return _format_with_writer(write_ndjson, messagelist, verbosity)
+
+def format_csv(messagelist, verbosity=0):
+    return _format_with_writer(write_csv, messagelist, verbosity)
+
+def _format_with_writer(writer, messagelist, verbosity):
+    """
+    Run a streaming writer into a string, for callers that want the formatted output as a single str
+    """
+    buffer = io.StringIO()
+    writer(messagelist, buffer, verbosity)
+    return buffer.getvalue().rstrip("\n")
+
+def write_json(messages, outfile, verbosity=0):
+    """
+    Write messages to outfile as a single JSON array, one element at a time
+    messages - iterable of ModuleMessage objects, e.g. a generator from DBConnection.iter_messages
+    outfile - file stream object
+    """
+    outfile.write("[")
+    separator = ""
+    for message in messages:
+        outfile.write(separator)
+        outfile.write(json.dumps(message.flatten()))
+        separator = ", "
+    outfile.write("]\n")
+
+def write_ndjson(messages, outfile, verbosity=0):
+    """
+    Write messages to outfile as newline delimited JSON, one object per line
+    messages - iterable of ModuleMessage objects
+    outfile - file stream object
+    """
+    for message in messages:
+        outfile.write(json.dumps(message.flatten()))
+        outfile.write("\n")
+
+def write_csv(messages, outfile, verbosity=0):
+    """
+    Write messages to outfile as CSV. Modules emit differently shaped payloads, so the payload is stored as a JSON object in the data column
+    messages - iterable of ModuleMessage objects
+    outfile - file stream object
+    """
+    writer = csv.writer(outfile, lineterminator="\n")
+    writer.writerow(["module", "time", "target", "pid", "count", "last_time", "data"])
+    for message in messages:
+        writer.writerow([message.module, message.format_time(), message.target, message.pid, message.count, format_timestamp(message.last_time), json.dumps(message.display_data())])
 
 
 def mask_to_str(mask, enum_map):
@@ -42,15 +95,34 @@ def mask_to_str(mask, enum_map):
     return " | ".join(flags_set)
 
 def format_grep(messagelist, verbosity = 0):
+    return _format_with_writer(write_grep, messagelist, verbosity)
 
-    outlines = []
+def write_grep(messages, outfile, verbosity=0):
+    """
+    Write messages to outfile as |-separated lines, one line per message
+    messages - iterable of ModuleMessage objects
+    outfile - file stream object
+    """
     sep = "|"
-    for message in messagelist:
-        outline = f"{message.module}{sep}{message.time}{sep}{message.target}"
-        for k,v in message.data.items():
+    for message in messages:
+        outline = f"{message.module}{sep}{message.format_time()}{sep}{message.target or ''}"
+        for k,v in message.display_data().items():
             outline += f"{sep}{k}:{v}"
-        outlines.append(outline)
-    return "\n".join(outlines)
+        if message.last_time is not None: #stored in dedup mode
+            outline += f"{sep}count:{message.count}{sep}last_time:{format_timestamp(message.last_time)}"
+        outfile.write(outline+"\n")
+
+def format_timestamp(timestamp):
+    """
+    Converts a timestamp as stored in the database into a human readable local time string, with millisecond precision
+    timestamp - int, microseconds since the epoch. Strings are returned unchanged.
+    Return - str
+    """
+    if timestamp is None:
+        return ""
+    if isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp / 1000000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
 def elipsize_path(path):
     """
@@ -66,8 +138,56 @@ def elipsize_message(message):
     """
     Creates a new message from the original with the target path shortend
     """
-    new_target = elipsize_path(message.target)
-    return ModuleMessage(message.module,new_target,message.data,time=message.time)
+    if message.target is None:
+        return message
+    return message.copy(target=elipsize_path(message.target))
+
+class TTLCache:
+    """
+    Thread-safe key-value cache. Entries expire ttl seconds after being set, and the least recently used entry is evicted once max_size is reached.
+    """
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        max_size - int, maximum number of entries
+        ttl - float or None, seconds before an entry expires. None means entries only leave the cache by eviction.
+        """
+        self._entries = OrderedDict()
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Cache value under key, evicting the least recently used entries if the cache is full
+        """
+        expires = time.monotonic() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
 
 def get_formatters():
     """
@@ -75,11 +195,14 @@ def get_formatters():
     Fields:
     name - human readable name for use in command arguments etc
     function - function object to the formatter
+    writer - function which writes an iterable of messages directly to a file stream, or None if the format needs every message up front
     """
-    Formatter = namedtuple("Formatter","name function")
-    formatters = [Formatter(name="table",function=format_table),
-    Formatter(name="json",function=format_json),
-    Formatter(name="grep",function=format_grep)]
+    Formatter = namedtuple("Formatter","name function writer")
+    formatters = [Formatter(name="table",function=format_table,writer=None),
+    Formatter(name="json",function=format_json,writer=write_json),
+    Formatter(name="grep",function=format_grep,writer=write_grep),
+    Formatter(name="ndjson",function=format_ndjson,writer=write_ndjson),
+    Formatter(name="csv",function=format_csv,writer=write_csv)]
     return formatters
 
 def get_formatter(name):
@@ -92,3 +215,12 @@ def get_formatter(name):
         if name.lower() == formatter.name.lower():
             return formatter.function
     raise ValueError(f"No formatter {name}")
+
+def get_writer(formatter_function):
+    """
+    Returns the streaming writer for the given formatter callback, or None if it has no streaming writer
+    """
+    for formatter in get_formatters():
+        if formatter.function == formatter_function:
+            return formatter.writer
+    return None
@@ -13,54 +13,208 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import sys,os
-import frida
+import glob
+import collections
+import itertools
 import winstrument.utils as utils
 from colorama import Fore, Back, Style
 import threading
-from frida_tools.application import Reactor
 import importlib, pkgutil
-import sqlite3
 import json
-import toml
-from winstrument.db_connection import DBConnection
+import uuid
 from winstrument.settings_controller import SettingsController
 from winstrument.data.module_message import ModuleMessage
+from winstrument.recorder import Recorder, read_recording
+from winstrument.metrics import MetricsRegistry, format_stats
 from datetime import datetime
 
 class Winstrument():
     #adapted from https://github.com/frida/frida-python/blob/master/examples/child_gating.py
     CORE_MODNAME = "core"
 
-    def __init__(self):
+    def __init__(self, archive=None):
+        """
+        archive: bool or None - overrides the archive setting for this instance when set
+        """
+        #Startup is kept cheap so the CLI is quick to open: frida, the Frida device, the database and the module metadata
+        #are only loaded the first time something needs them. See the properties below.
         appdata_path = os.environ["appdata"]
         data_path = os.path.join(appdata_path,"winstrument")
 
         if not os.path.exists(data_path):
             os.mkdir(data_path)
 
+        self._data_path = data_path
         settings_path = os.path.join(data_path, "settings.toml")
 
-        #unique temporary storage for each instance of the program
-        self._db = DBConnection(os.path.join(data_path,f"db_{datetime.now().timestamp()}.sqlite3"))
         self.settings_controller = SettingsController(settings_path)
         default_settings = {'target': 'C:\\Windows\\System32\\Calc.exe' , "verbosity": 0}
         #settings won't exist on first run
         if self.settings_controller.get_module_settings(self.CORE_MODNAME) == {}:
             self.settings_controller.set_module_settings(self.CORE_MODNAME, default_settings)
 
-        self.metadata = self.get_metadata()
+        if archive is None:
+            archive = self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "archive") or False
+        self._archive = archive
+        self.metrics = MetricsRegistry() #reset at the start of each run
+        self._db_connection = None #see _db
+        self._run_ids = [] #runs shown by show/export
+
+        self._metadata = None #see metadata
+        self._metadata_loaded = False
         self._stop_requested = threading.Event()
-        self._reactor = Reactor(run_until_return=lambda reactor: self._stop_requested.wait())
-        self._device = frida.get_local_device()
-        self._sessions = set()
+        self._reactor_instance = None #see _reactor
+        self._device_instance = None #see _device
+        self._attach_pool_instance = None #see _attach_pool
+        self._sessions = {} #pid -> Frida session
+        self._recorders = {} #pid -> Recorder, when the record setting is on
+        self._pid_runs = {} #pid -> ID of the run the process belongs to. Child processes belong to their parent's run.
+        self._session_counts = collections.Counter() #run ID -> number of processes instrumented in the run
+        self._run_states = {} #run ID -> dict shared by all instrumentations in the run, see BaseInstrumentation
+        self._pending_attaches = 0 #child processes being instrumented by the attach pool
+        self._registry_lock = threading.Lock() #guards _sessions, _instrumentations, _recorders, _pid_runs, _session_counts, _run_states and _pending_attaches
+        self._run_id = None
+        self._scanner = None #Scanner running several runs at once, see scan
+        self._watermark = 0 #ID of the newest output row printed during the run, see print_new_output
+        self._follow = None #modules whose output is printed during the run, None for every module
+        self._follow_formatter = utils.format_table
 
-        self._device.on("child-added", lambda child: self._reactor.schedule(lambda: self._on_child_added(child)))
-        self._device.on("child-removed", lambda child: self._reactor.schedule(lambda: self._on_child_removed(child)))
-        self._base_module = importlib.import_module("winstrument.base_module",None)
         self._modules_to_load=[]
-        self._available_modules = self._enumerate_modules()
+        self._available_modules = None #see get_available_modules
         self._loaded_modules = []
-        self._instrumentations = []
+        self._instrumentations = {} #pid -> list of BaseInstrumentation objects for that process
+
+    @property
+    def _db(self):
+        """
+        The DBConnection output is stored in, opened on first use
+        """
+        if self._db_connection is None:
+            self._db_connection = self._open_database()
+        return self._db_connection
+
+    def _open_database(self):
+        """
+        Create the DBConnection according to the write_behind, db_batch_size, db_flush_ms and archive settings
+        """
+        from winstrument.db_connection import DBConnection
+        write_behind = self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "write_behind") or False
+        db_options = {}
+        batch_size = self.settings_controller.get_setting_int(self.CORE_MODNAME, "db_batch_size")
+        if batch_size:
+            db_options["batch_size"] = batch_size
+        flush_ms = self.settings_controller.get_setting_int(self.CORE_MODNAME, "db_flush_ms")
+        if flush_ms:
+            db_options["flush_interval"] = flush_ms / 1000
+        self._remove_stale_databases(self._data_path)
+        if self._archive:
+            #one persistent database shared by every run
+            dbpath = os.path.join(self._data_path, "archive.sqlite3")
+        else:
+            #unique temporary storage for each instance of the program
+            dbpath = os.path.join(self._data_path,f"db_{datetime.now().timestamp()}.sqlite3")
+        db = DBConnection(dbpath, write_behind=write_behind, persistent=self._archive, metrics=self.metrics, **db_options)
+        if self._archive:
+            self._db_connection = db
+            self._apply_retention()
+        return db
+
+    @property
+    def _reactor(self):
+        """
+        The frida_tools Reactor that runs Frida callbacks, created on first use
+        """
+        if self._reactor_instance is None:
+            from frida_tools.application import Reactor
+            self._reactor_instance = Reactor(run_until_return=lambda reactor: self._stop_requested.wait())
+        return self._reactor_instance
+
+    @property
+    def _device(self):
+        """
+        The local Frida device, created on first use
+        """
+        if self._device_instance is None:
+            import frida
+            device = frida.get_local_device()
+            device.on("child-added", lambda child: self._reactor.schedule(lambda: self._on_child_added(child)))
+            device.on("child-removed", lambda child: self._reactor.schedule(lambda: self._on_child_removed(child)))
+            self._device_instance = device
+        return self._device_instance
+
+    @property
+    def _attach_pool(self):
+        """
+        Thread pool used to instrument child processes, created on first use
+        """
+        if self._attach_pool_instance is None:
+            import concurrent.futures
+            attach_workers = self.settings_controller.get_setting_int(self.CORE_MODNAME, "attach_workers") or 4
+            self._attach_pool_instance = concurrent.futures.ThreadPoolExecutor(max_workers=attach_workers, thread_name_prefix="winstrument-attach")
+        return self._attach_pool_instance
+
+    @property
+    def _base_module(self):
+        return importlib.import_module("winstrument.base_module")
+
+    @property
+    def metadata(self):
+        """
+        Module metadata from metadata.toml, parsed on first use. See get_metadata
+        """
+        if not self._metadata_loaded:
+            self._metadata = self.get_metadata()
+            self._metadata_loaded = True
+        return self._metadata
+
+    def _remove_stale_databases(self, data_path):
+        """
+        Delete temporary databases left behind by instances that crashed before closing them.
+        Databases still open in a running instance can't be deleted on Windows, so those are skipped.
+        data_path: str - directory containing the databases
+        """
+        for dbpath in glob.glob(os.path.join(data_path, "db_*.sqlite3*")):
+            try:
+                os.remove(dbpath)
+            except OSError:
+                pass
+
+    def _apply_retention(self):
+        """
+        Evict old runs from the archive database according to the archive_max_runs, archive_max_age_days and archive_max_mb settings
+        """
+        max_mb = self.settings_controller.get_setting_int(self.CORE_MODNAME, "archive_max_mb")
+        evicted = self._db.apply_retention(max_runs=self.settings_controller.get_setting_int(self.CORE_MODNAME, "archive_max_runs"),
+            max_age_days=self.settings_controller.get_setting_float(self.CORE_MODNAME, "archive_max_age_days"),
+            max_bytes=max_mb * 1024 * 1024 if max_mb else None,
+            keep=[self._run_id] if self._run_id else [])
+        self._run_ids = [run_id for run_id in self._run_ids if run_id not in evicted]
+
+    def get_runs(self):
+        """
+        Gets the runs stored in the database, oldest first
+        returns a list of dicts, see DBConnection.get_runs
+        """
+        return self._db.get_runs()
+
+    def get_selected_runs(self):
+        """
+        Gets the IDs of the runs whose output is shown by show/export
+        returns a list of run IDs
+        """
+        return self._run_ids.copy()
+
+    def select_runs(self, run_ids):
+        """
+        Choose which stored runs show/export display. Runs started afterwards are added to the selection.
+        run_ids: list of str - run IDs, see get_runs
+        Raises ValueError if a run ID is not in the database
+        """
+        known = {run["run_id"] for run in self._db.get_runs()}
+        for run_id in run_ids:
+            if run_id not in known:
+                raise ValueError(f"No run {run_id}")
+        self._run_ids = list(run_ids)
 
     def get_metadata(self, filename="metadata.toml"):
         """
@@ -68,6 +222,7 @@ class Winstrument():
         Returns dict of metadata, or None if the file is not present or invalid.
         """
 
+        import toml
         metadata_filepath = os.path.join(os.path.dirname(__file__),"modules",filename)
         try:
             metadata = toml.load(metadata_filepath)
@@ -82,6 +237,8 @@ class Winstrument():
         Gets a list of all available modules (from modules/metadata.toml)
         returns a list with module names
         """
+        if self._available_modules is None:
+            self._available_modules = self._enumerate_modules()
         return self._available_modules.copy()
 
     def get_loaded_modules(self):
@@ -102,19 +259,57 @@ class Winstrument():
         for module in self.get_available_modules():
             self.print_saved_output(module,formatter,outfile)
 
-    def print_saved_output(self, modulename, formatter=utils.format_table, output=sys.stdout):
+    def print_saved_output(self, modulename, formatter=utils.format_table, output=sys.stdout, query=None):
         """
         Write the output for the given module to the given output stream in the desired format.
         modulename - str
         formatter - callable which takes a list of ModuleMessage objects and returns a string to output. See utils.py
         output - file stream object. This could be a normal file or sys.stdout
+        query - Query or None. If set, only the rows it selects or aggregates are written. See query.parse_query
+        Formatters with a streaming writer (see utils.get_formatters) are fed rows straight from the database cursor.
         No return, but writes the output stream
         """
-        messages = self._db.read_messages(modulename)
+        #the runs chosen with select_runs, or every run started by this instance. A temporary database holds nothing else.
+        run_ids = self._run_ids
+        if query is not None:
+            messages = self._db.iter_query(modulename, query, run_ids)
+        else:
+            messages = self._db.iter_messages(modulename, run_ids)
         if formatter is None:
             formatter = utils.format_table
         verbosity = self.settings_controller.get_setting_int(self.CORE_MODNAME,"verbosity") or 0
-        output.write(formatter(messages,verbosity)+"\n")
+        writer = utils.get_writer(formatter)
+        if writer:
+            #stream rows from the database straight to the output
+            writer(messages, output, verbosity)
+        else:
+            output.write(formatter(list(messages),verbosity)+"\n")
+
+    def print_new_output(self, modules=None, formatter=utils.format_table, output=sys.stdout):
+        """
+        Write the output stored by the current run since the last call, then advance the watermark so the same rows aren't printed again.
+        modules - list of module names, or None for every module
+        formatter - callable which takes a list of ModuleMessage objects and returns a string to output. See utils.py
+        output - file stream object
+        No return, but writes the output stream
+        """
+        up_to = self._db.get_last_id()
+        if up_to <= self._watermark:
+            return
+        verbosity = self.settings_controller.get_setting_int(self.CORE_MODNAME,"verbosity") or 0
+        writer = utils.get_writer(formatter)
+        for module in modules or self.get_available_modules():
+            rows = self._db.iter_messages_after(self._watermark, module, [self._run_id], up_to=up_to)
+            first = next(rows, None)
+            if first is None: #nothing new, don't print an empty table
+                continue
+            messages = (message for _, message in itertools.chain([first], rows))
+            if writer:
+                writer(messages, output, verbosity)
+            else:
+                output.write(formatter(list(messages),verbosity)+"\n")
+        self._watermark = up_to
+        output.flush()
 
     def unload_module(self, module):
         """
@@ -126,7 +321,7 @@ class Winstrument():
             self._loaded_modules.remove(module)
         except ValueError:
             print (f"Can't unload because {module} wasn't loaded")
-        if module not in self._available_modules:
+        if module not in self.get_available_modules():
             self._available_modules.append(module)
         self._initialize_modules()
 
@@ -168,11 +363,14 @@ class Winstrument():
                 self._modules_to_load.remove(modulename)
                 continue
 
-    def run(self,target=None,arglist=None):
+    def run(self,target=None,arglist=None,follow=None,formatter=None):
         """
         Schedule frida to spawn the target process, then instrument it.
+        Output is printed as it is stored if follow is given or the live setting is on, otherwise once every process has exited.
         target: str - path to target to spawn
         arglist: list - arguments to pass to target when spawned
+        follow: list of str or None - module names whose output is printed as it is stored while the target runs
+        formatter: callable or None - formatter for printed output, see utils.py. Defaults to the table formatter.
         """
         if target:
             process = target
@@ -180,8 +378,26 @@ class Winstrument():
         else:
             process = self.settings_controller.get_setting(self.CORE_MODNAME,"target")
             args = self.settings_controller.get_setting(self.CORE_MODNAME,"args")
+        self._run_id = uuid.uuid4().hex
+        self._run_ids.append(self._run_id)
+        self.metrics.reset()
+        self._follow = follow
+        self._follow_formatter = formatter or utils.format_table
+        self._db.flush()
+        self._watermark = self._db.get_last_id()
+        self._db.begin_run(self._run_id, process, args)
+        self._stop_requested.clear()
         self._reactor.schedule(lambda: self._start(process,args))
+        if follow is not None or self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "live"):
+            live_interval = self.settings_controller.get_setting_int(self.CORE_MODNAME, "live_interval") or 1
+            self._reactor.schedule(lambda: self._follow_output(live_interval), delay=live_interval)
+        stats_interval = self.settings_controller.get_setting_int(self.CORE_MODNAME, "stats_interval")
+        if stats_interval:
+            self._reactor.schedule(lambda: self._print_stats_periodically(stats_interval), delay=stats_interval)
         self._reactor.run()
+        self._db.end_run(self._run_id)
+        if self._archive:
+            self._apply_retention()
 
     def _start(self,target,args=None):
         """
@@ -194,6 +410,19 @@ class Winstrument():
             sys.stderr.write(f"{Fore.RED} No target set. Use 'set target <target> to specify a program to instrument.\n{Style.RESET_ALL}")
             self.stop()
             return
+        if self._spawn(target, args, self._run_id) is None:
+            self.stop()
+
+    def _spawn(self, target, args, run_id):
+        """
+        Spawn the target process and instrument it as part of the given run.
+        If it can't be spawned, write a warning to STDERR.
+        target: str - Path to the process to spawn
+        args: str or None - command line arguments to use with the target
+        run_id: str - ID of the run the process and its children belong to
+        Returns the PID, or None if the target couldn't be spawned
+        """
+        import frida
         cmd = [target]
         if args:
 
@@ -202,79 +431,361 @@ class Winstrument():
             pid = self._device.spawn(cmd)
         except frida.ExecutableNotFoundError:
             sys.stderr.write(f"{Fore.RED}Target {target} not found! Make sure the path is correct.\n{Style.RESET_ALL}")
-            self.stop()
-            return
+            return None
+        except (frida.NotSupportedError, frida.PermissionDeniedError, frida.InvalidArgumentError, frida.TimedOutError, frida.TransportError) as e:
+            sys.stderr.write(f"{Fore.RED}Can't spawn {target}: {e}\n{Style.RESET_ALL}")
+            return None
         print("Spawned " + str(pid))
+        with self._registry_lock:
+            self._pid_runs[pid] = run_id
         self._instrument(pid, target)
+        return pid
 
     def _stop_if_idle(self):
         """
-        Helper function used with Frida reactor. Stops the reactor if there are no queued child sessions.
+        Helper function used with Frida reactor. Prints the output not yet printed and stops the reactor if there are no sessions left and no child processes waiting to be instrumented.
         """
-        if len(self._sessions) == 0:
+        with self._registry_lock:
+            idle = len(self._sessions) == 0 and self._pending_attaches == 0
+        if idle and self._scanner is None and not self._stop_requested.is_set(): #a scan stops the reactor itself when its queue is empty
+            self._db.flush()
+            self.print_new_output(self._follow, self._follow_formatter)
             self.stop()
 
+    def _follow_output(self, interval):
+        """
+        Helper function used with Frida reactor. Every interval seconds until the run stops, asks the followed modules to write out
+        partial results (see BaseInstrumentation.flush_partial), then prints the rows stored since the last time.
+        interval: int - seconds
+        """
+        if self._stop_requested.is_set():
+            return
+        with self._registry_lock:
+            instrumentations = [instrumentation for pid_instrumentations in self._instrumentations.values() for instrumentation in pid_instrumentations]
+        for instrumentation in instrumentations:
+            if self._follow is None or instrumentation.modulename in self._follow:
+                instrumentation.flush_partial()
+        self.print_new_output(self._follow, self._follow_formatter)
+        self._reactor.schedule(lambda: self._follow_output(interval), delay=interval)
+
+    def _print_stats_periodically(self, interval):
+        """
+        Helper function used with Frida reactor. Prints the current metrics every interval seconds until the run stops.
+        interval: int - seconds
+        """
+        if self._stop_requested.is_set():
+            return
+        print(self.format_stats())
+        self._reactor.schedule(lambda: self._print_stats_periodically(interval), delay=interval)
+
+    def get_stats(self):
+        """
+        Gets the metrics collected during the latest run, as a JSON serializable dict. See MetricsRegistry.snapshot
+        """
+        return self.metrics.snapshot()
+
+    def format_stats(self):
+        """
+        Returns the metrics collected during the latest run as a human readable table
+        """
+        return format_stats(self.get_stats())
+
     def stop(self):
         """
         Signal that the Frida reactor has been requested to stop, then stop it.
         """
         self._stop_requested.set()
-        self._reactor.stop()
+        if self._reactor_instance is not None:
+            self._reactor_instance.stop()
 
     def quit(self):
         """
-        Save settings to settings file.
+        Save settings to settings file, then write any queued output and close the database.
         """
         self.settings_controller.save_settings()
-        self._db.close()
+        if self._attach_pool_instance is not None:
+            self._attach_pool_instance.shutdown()
+        with self._registry_lock:
+            recorders = list(self._recorders.values())
+            self._recorders.clear()
+        for recorder in recorders:
+            recorder.close()
+        if self._db_connection is not None:
+            self._db_connection.close()
 
     def _instrument(self, pid, path):
         """
         Iterates over currently loaded modules and performs instrumentation on the target process for each.
+        Safe to call from several threads at once, so child processes can be instrumented concurrently.
         pid: int - PID of the spawned process
         path: str - filesystem path to the spawned process executable.
         """
+        import frida
         try:
             session = self._device.attach(pid)
         except frida.TransportError as e:
             sys.stderr.write(f"{Fore.RED} Got exception {repr(e)} when attaching to {pid}\n{Style.RESET_ALL}")
+            self._resume(pid) #don't leave a gated child suspended
+            with self._registry_lock:
+                run_id = self._pid_runs.pop(pid, None)
+            self._reactor.schedule(lambda: self._check_run_exited(run_id))
             return
 
-        session.on('detached',lambda reason: self._reactor.schedule(lambda: self._on_detach(pid, session, reason)))
-        session.enable_child_gating() #pause child processes until manually resumed
+        with self._registry_lock:
+            run_id = self._pid_runs.setdefault(pid, self._run_id)
+        recorder = None
+        if self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "record"):
+            recorder = self._create_recorder(pid, path, run_id)
+        with self._registry_lock:
+            self._session_counts[run_id] += 1
+            session_id = self._session_counts[run_id]
+            run_state = self._run_states.setdefault(run_id, {})
+        instrumentations = []
         for moduleclass in self._base_module.BaseInstrumentation.__subclasses__():
             if moduleclass.modulename in self._loaded_modules: # module might have been unloaded by user
-                instrumentation = moduleclass(session, path, self._db)
-                self._instrumentations.append(instrumentation)
-                instrumentation.load_script()
+                settings = self.settings_controller.get_module_settings(moduleclass.modulename)
+                instrumentation = moduleclass(session, path, self._db, settings=settings, pid=pid, session_id=session_id, run_id=run_id, shared=run_state, recorder=recorder, metrics=self.metrics)
+                instrumentations.append(instrumentation)
+        with self._registry_lock:
+            #registered before the detached handler and the scripts, so _on_detach always finds everything it has to finalize
+            self._sessions[pid] = session
+            self._instrumentations[pid] = instrumentations
+            if recorder is not None:
+                self._recorders[pid] = recorder
+        session.on('detached',lambda reason: self._reactor.schedule(lambda: self._on_detach(pid, session, reason)))
+        try:
+            session.enable_child_gating() #pause child processes until manually resumed
+            if self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "combined_agent"):
+                #one script and message channel for all modules in the session
+                self._base_module.CombinedAgent(session, instrumentations).load()
+            else:
+                for instrumentation in instrumentations:
+                    instrumentation.load_script()
+        except (frida.InvalidOperationError, frida.TransportError) as e: #process exited while being instrumented
+            sys.stderr.write(f"{Fore.RED} Got exception {repr(e)} when loading scripts into {pid}\n{Style.RESET_ALL}")
+            #the session may have detached before the handler was connected, in which case it never fires. Finalize here unless it has.
+            self._reactor.schedule(lambda: self._on_detach(pid, session, "process-terminated"))
         print(f"instrumented process with pid: {pid} and path: {path}")
-        self._device.resume(pid)
-        self._sessions.add(session)
+        self._resume(pid)
+
+    def _create_recorder(self, pid, path, run_id):
+        """
+        Create a Recorder for a new session, in the recordings directory next to the database
+        pid: int - PID of the process
+        path: str - filesystem path to the process executable
+        run_id: str - ID of the run the process belongs to
+        Returns the Recorder, or None if the file can't be created
+        """
+        recordings_path = os.path.join(self._data_path, "recordings")
+        try:
+            os.makedirs(recordings_path, exist_ok=True)
+            recording_path = os.path.join(recordings_path, f"{run_id}_{pid}.ndjson.gz")
+            recorder = Recorder(recording_path, path, pid, run_id)
+        except OSError as e:
+            sys.stderr.write(f"{Fore.RED} Can't record session for {pid}: {e}\n{Style.RESET_ALL}")
+            return None
+        print(f"Recording messages from {pid} to {recording_path}")
+        return recorder
+
+    def scan(self, source, restart=False, concurrency=None, timeout=None):
+        """
+        Spawn and instrument every target listed in source with the loaded modules, several at a time. The output of each target is stored as its own run.
+        The queue of targets is kept in the database, so scanning the same source again after an interruption continues where it stopped.
+        With a temporary database, this only holds until Winstrument exits, so use the archive setting for long scans.
+        source: str - directory or list file, see scanner.read_scan_targets
+        restart: bool - if True, scan every target again even if an earlier scan of source completed it
+        concurrency: int or None - maximum number of targets running at once. Defaults to the scan_concurrency setting, or 4.
+        timeout: int or None - seconds a target may run before it and its children are killed. Defaults to the scan_timeout setting, or 60.
+        Raises OSError if source can't be read, or ValueError if it lists no targets
+        Returns a dict of status -> number of targets in the scan, see DBConnection.get_scan_progress
+        """
+        from winstrument.scanner import Scanner, read_scan_targets
+        targets = read_scan_targets(source)
+        source = os.path.abspath(source)
+        if restart:
+            self._db.clear_scan(source)
+        self._db.add_scan_targets(source, targets)
+        requeued = self._db.requeue_interrupted_scan_targets(source)
+        progress = self._db.get_scan_progress(source)
+        pending, total = progress.get("pending", 0), sum(progress.values())
+        if pending == 0:
+            print(f"Every target in {source} has already been scanned. Scan it with restart to start over.")
+        elif pending < total:
+            print(f"Resuming scan of {source}: {pending} of {total} targets left, {requeued} of them interrupted")
+        concurrency = concurrency or self.settings_controller.get_setting_int(self.CORE_MODNAME, "scan_concurrency") or 4
+        timeout = timeout or self.settings_controller.get_setting_int(self.CORE_MODNAME, "scan_timeout") or 60
+        self._scanner = Scanner(self, source, concurrency, timeout)
+        self.metrics.reset()
+        self._stop_requested.clear()
+        self._reactor.schedule(self._scanner.start)
+        try:
+            self._reactor.run()
+        finally:
+            self._run_ids.extend(self._scanner.run_ids)
+            self._scanner = None
+        if self._archive:
+            self._apply_retention()
+        return self._db.get_scan_progress(source)
+
+    def replay(self, recording_path, modules=None):
+        """
+        Feed a recording made with the record setting back through the module classes, as if the recorded session was running now.
+        The output is stored as a new run in the database, and can be viewed with show/export.
+        recording_path: str - path to a recording file
+        modules: list of str or None - only replay messages for these modules. By default every recorded module is replayed.
+        Raises ValueError if the file is not a recording
+        Returns the number of messages replayed
+        """
+        header, records = read_recording(recording_path)
+        run_id = uuid.uuid4().hex
+        self._run_ids.append(run_id)
+        self.metrics.reset()
+        self._db.begin_run(run_id, header["target"], f"replay of {recording_path}")
+        run_state = {}
+        instrumentations = {} #modulename -> instrumentation, or None if the module can't be replayed
+        count = 0
+        for modulename, message, data in records:
+            if modules is not None and modulename not in modules:
+                continue
+            if modulename not in instrumentations:
+                instrumentations[modulename] = self._create_replay_instrumentation(modulename, header, run_id, run_state)
+            instrumentation = instrumentations[modulename]
+            if instrumentation is not None:
+                instrumentation._dispatch_message(message, data)
+                count += 1
+        for instrumentation in instrumentations.values():
+            if instrumentation is not None:
+                instrumentation.finalize()
+        self._db.end_run(run_id)
+        return count
+
+    def _create_replay_instrumentation(self, modulename, header, run_id, run_state):
+        """
+        Create an instrumentation of the named module with no Frida session, to handle replayed messages
+        modulename: str
+        header: dict - recording header, see Recorder
+        Returns the instrumentation, or None if the module can't be imported
+        """
+        try:
+            importlib.import_module(f"winstrument.modules.{modulename}")
+        except ImportError as e:
+            sys.stderr.write(f"{Fore.RED} Skipping messages for module {modulename}: {e}\n{Style.RESET_ALL}")
+            return None
+        for moduleclass in self._base_module.BaseInstrumentation.__subclasses__():
+            if moduleclass.modulename == modulename:
+                settings = self.settings_controller.get_module_settings(modulename)
+                return moduleclass(None, header["target"], self._db, settings=settings, pid=header["pid"], session_id=1, run_id=run_id, shared=run_state, metrics=self.metrics)
+        return None
+
+    def _resume(self, pid):
+        """
+        Resume a spawned or gated process, ignoring processes that have already gone away
+        pid: int
+        """
+        import frida
+        try:
+            self._device.resume(pid)
+        except (frida.InvalidArgumentError, frida.InvalidOperationError, frida.ProcessNotFoundError, frida.TransportError):
+            pass
 
     def _on_detach(self, pid, session, reason):
         """
         Callback called when the Frdia becomes detached froma  process.
-        Calls the on_finish method for any loaded instrumentations, removes the old session and prints output, if verbosity is high enough.
+        Finalizes only the instrumentations for the detached process and removes its session. Output is printed once every session has ended.
+        Also called by _instrument when loading the scripts fails, in case the process exited before the detached handler was connected, so later calls for the same session do nothing.
         pid: int - PID of detached process
         session: Frida Session object - session corresponded to the detached process
         reason: str - Reason provided by Frida for why the target terminated
         """
+        with self._registry_lock:
+            if self._sessions.get(pid) is not session: #already handled, as both the detached signal and _instrument can call this
+                return
+            instrumentations = self._instrumentations.pop(pid, [])
+            self._sessions.pop(pid, None)
+            recorder = self._recorders.pop(pid, None)
+            run_id = self._pid_runs.pop(pid, None)
         print (f"detached from {pid} for reason {reason}")
-        for instrumentation in self._instrumentations:
-            instrumentation.on_finish()
-        self._instrumentations.clear() #reset for next session, if any
-        self._sessions.remove(session)
-        verbosity = self.settings_controller.get_setting_int(self.CORE_MODNAME,"verbosity") or 0
-        self.export_all(sys.stdout)
+        for instrumentation in instrumentations:
+            instrumentation.finalize()
+        if recorder is not None:
+            recorder.close()
+        if self.settings_controller.get_setting_boolean(self.CORE_MODNAME, "stats"):
+            print(self.format_stats())
+        self._check_run_exited(run_id)
 
         self._reactor.schedule(self._stop_if_idle, delay=0.5)
 
+    def _check_run_exited(self, run_id):
+        """
+        Helper function used with Frida reactor. Once no process in the run is left, drops the run's shared state and tells the scanner, if there is one.
+        run_id: str or None
+        """
+        with self._registry_lock:
+            if run_id is None or run_id in self._pid_runs.values():
+                return
+            self._run_states.pop(run_id, None)
+            self._session_counts.pop(run_id, None)
+        if self._scanner is not None:
+            self._scanner.on_run_exited(run_id)
+
+    def _get_run_pids(self, run_id):
+        """
+        Returns the PIDs of the processes in the given run that are still running or being instrumented
+        """
+        with self._registry_lock:
+            return [pid for pid, pid_run_id in self._pid_runs.items() if pid_run_id == run_id]
+
+    def _kill_run(self, run_id):
+        """
+        Kill every process in the given run. Their sessions detach and are finalized as usual.
+        run_id: str
+        """
+        import frida
+        for pid in self._get_run_pids(run_id):
+            try:
+                self._device.kill(pid)
+            except (frida.InvalidArgumentError, frida.InvalidOperationError, frida.ProcessNotFoundError, frida.PermissionDeniedError, frida.TransportError) as e:
+                sys.stderr.write(f"{Fore.RED} Can't kill {pid}: {e}\n{Style.RESET_ALL}")
+
+    def _detach_run(self, run_id):
+        """
+        Detach from every process in the given run, for processes that survived _kill_run
+        run_id: str
+        """
+        for pid in self._get_run_pids(run_id):
+            with self._registry_lock:
+                session = self._sessions.get(pid)
+            if session is not None:
+                session.detach()
+
     def _on_child_added(self, child):
         """
         Callback called by Frida reactor when a new child is spawned from the target process.
+        The child is instrumented on the attach pool, so many children can be attached and loaded concurrently without blocking the reactor.
+        child - object
+        """
+        with self._registry_lock:
+            self._pending_attaches += 1
+            self._pid_runs[child.pid] = self._pid_runs.get(child.parent_pid, self._run_id) #children belong to their parent's run
+        self._attach_pool.submit(self._instrument_child, child)
+
+    def _instrument_child(self, child):
+        """
+        Attach pool task for _on_child_added
         child - object
         """
-        self._instrument(child.pid,child.path)
+        try:
+            self._instrument(child.pid,child.path)
+        except Exception as e:
+            sys.stderr.write(f"{Fore.RED} Got exception {repr(e)} when instrumenting child {child.pid}\n{Style.RESET_ALL}")
+            self._resume(child.pid)
+            with self._registry_lock:
+                run_id = None if child.pid in self._sessions else self._pid_runs.pop(child.pid, None)
+            self._reactor.schedule(lambda: self._check_run_exited(run_id))
+        finally:
+            with self._registry_lock:
+                self._pending_attaches -= 1
+            self._reactor.schedule(self._stop_if_idle, delay=0.5)
 
     def _on_child_removed(self,child):
         """